@@ -19,10 +19,47 @@ import json
 
 REPORTS_IN_ZIP = "raw_data adapter ccs control loading".split()
 
+# Bump this if the layout of the record made by extract_cell_record() changes
+CELL_RECORD_VERSION = 1
+
 def main(args):
 
     L.basicConfig(level=(L.DEBUG if args.debug else L.WARNING), stream=sys.stderr)
 
+    if args.record:
+        # Everything from reports.zip, metadata.xml, sts.xml and lima_counts.txt was
+        # already extracted by a previous run with --make_record
+        if args.reports_zip or args.metaxml or args.stsxml or args.lima_counts or \
+                any( getattr(args, f"{r}_report") for r in REPORTS_IN_ZIP ):
+            exit("--record cannot be combined with options to load the individual files.")
+        record = load_cell_record(args.record)
+    else:
+        record = extract_cell_record_from_args(args)
+
+    if args.make_record:
+        json.dump(record, sys.stdout, indent=1)
+        print()
+        return
+
+    # Build the links to the files.
+    info = gen_info(args)
+
+    if args.extract_ids:
+        if record['metadata_xml']:
+            # FIXME - actually there may be, because if we are re-running on the results
+            # of manual de-multiplexing in SMRTLink then potentially the ws_name and ws_desc
+            # could change? But how much do we care?
+            exit("There's no point in using -x if we are loading metadata.xml directly.")
+        info.update(extract_ids_multi(args.bcfiles))
+
+    if record['reports']:
+        info.update(compile_cell_record(record))
+
+    dump_yaml(info, fh=sys.stdout)
+
+def extract_cell_record_from_args(args):
+    """Load all the per-cell files given in args and extract the cell record.
+    """
     # Load the JSON files from reports.zip. No interpretation is made yet.
     json_reports = load_reports_zip(vars(args))
 
@@ -44,24 +81,10 @@ def main(args):
     if args.lima_counts:
         lima_counts = load_lima_counts(args.lima_counts)
 
-    # Build the links to the files.
-    info = gen_info(args)
-
-    if args.extract_ids:
-        if metadata_xml_info:
-            # FIXME - actually there may be, because if we are re-running on the results
-            # of manual de-multiplexing in SMRTLink then potentially the ws_name and ws_desc
-            # could change? But how much do we care?
-            exit("There's no point in using -x if we are loading metadata.xml directly.")
-        info.update(extract_ids_multi(args.bcfiles))
-
-    if json_reports:
-        info.update(compile_json_reports( json_reports,
-                                          metadata_xml = metadata_xml_info,
-                                          sts_xml = sts_xml_info,
-                                          lima_counts = lima_counts ))
-
-    dump_yaml(info, fh=sys.stdout)
+    return extract_cell_record( json_reports,
+                                metadata_xml = metadata_xml_info,
+                                sts_xml = sts_xml_info,
+                                lima_counts = lima_counts )
 
 def load_reports_zip(args_dict):
     """Load the various JSON files directly from reports.zip. If any --foo_report
@@ -92,13 +115,67 @@ def load_reports_zip(args_dict):
 
     return res
 
+def extract_cell_record(reports_dict, metadata_xml=None, sts_xml=None, lima_counts=None):
+    """Flatten everything we might want from the JSON reports into a single record
+       which can be saved as JSON and re-loaded quickly.
+
+       The attribute and table column IDs in the reports are already prefixed by the
+       report name (eg. 'ccs2.mean_npasses') so these are all put into one dict
+       of {id: value} and another of {column_id: [values]}.
+    """
+    record = dict( version = CELL_RECORD_VERSION,
+                   reports = [ r for r in reports_dict ],
+                   comments = {},
+                   attributes = {},
+                   columns = {},
+                   metadata_xml = metadata_xml,
+                   sts_xml = sts_xml,
+                   lima_counts = lima_counts )
+
+    for r, report in reports_dict.items():
+        if '_comment' in report:
+            record['comments'][r] = report['_comment']
+        for a in report.get('attributes', []):
+            record['attributes'][a['id']] = a['value']
+        for t in report.get('tables', []):
+            for c in t['columns']:
+                record['columns'][c['id']] = c['values']
+
+    return record
+
+def load_cell_record(filename):
+    """Load a record as saved by "compile_cell_info.py --make_record"
+    """
+    with open(filename) as fh:
+        record = json.load(fh)
+
+    if record.get('version') != CELL_RECORD_VERSION:
+        raise RuntimeError(f"{filename} has version {record.get('version')} but"
+                           f" we need version {CELL_RECORD_VERSION}")
+
+    return record
+
 def compile_json_reports(reports_dict, metadata_xml, sts_xml=None, lima_counts=None):
+    """Shortcut for compile_cell_record(extract_cell_record(...))
+    """
+    return compile_cell_record( extract_cell_record( reports_dict,
+                                                     metadata_xml = metadata_xml,
+                                                     sts_xml = sts_xml,
+                                                     lima_counts = lima_counts ) )
+
+def compile_cell_record(record):
     """This attempts to aggregate all the per-cell QC items wanted for the sign-off
        spreadsheet. The results will be arranged in a dictionary mimicking the current
        spreadsheet headings.
 
-       We also bring in info from metadata_xml and sts_xml.
+       We also bring in info from metadata_xml and sts_xml, which are in the record.
     """
+    metadata_xml = record['metadata_xml']
+    sts_xml = record['sts_xml']
+    lima_counts = record['lima_counts']
+    attr = record['attributes']
+    cols = record['columns']
+
     reports = { 'Run': {},
                 'Sample Loaded': {},
                 'Raw Data': {},
@@ -133,20 +210,18 @@ def compile_json_reports(reports_dict, metadata_xml, sts_xml=None, lima_counts=N
     reports['Sample Loaded']['% of  recovery (anticipated)'] = None
     reports['Sample Loaded']['% of  recovery (real)'] = "to be calculated"
 
-    # This is coming from reports_dict['raw_data']
-    rd = { a['id']: a['value'] for a in reports_dict['raw_data']['attributes'] }
-    reports['Raw Data']['Polymerase Read Bases (Gb)'] = "{:.1f}".format(rd['raw_data_report.nbases'] / 1e9)
-    reports['Raw Data']['Polymerase Reads (M)'] = "{:.1f}".format(rd['raw_data_report.nreads'] / 1e6)
-    reports['Raw Data']['Polymerase Read N50'] = "{}".format(rd['raw_data_report.read_n50'])
-    reports['Raw Data']['Longest Subread N50'] = "{}".format(rd['raw_data_report.insert_n50'])
-    reports['Raw Data']['Unique Molecular Yield (Gb)'] = "{:.1f}".format(rd['raw_data_report.unique_molecular_yield'] / 1e9)
-
-    # This one from reports_dict['loading'], aside from OPLC which we don't have
-    ld = { v['id']: v['value'] for v in reports_dict['loading']['attributes'] }
-    productive_zmws = ld['loading_xml_report.productive_zmws']
+    # This is coming from the raw_data report
+    reports['Raw Data']['Polymerase Read Bases (Gb)'] = "{:.1f}".format(attr['raw_data_report.nbases'] / 1e9)
+    reports['Raw Data']['Polymerase Reads (M)'] = "{:.1f}".format(attr['raw_data_report.nreads'] / 1e6)
+    reports['Raw Data']['Polymerase Read N50'] = "{}".format(attr['raw_data_report.read_n50'])
+    reports['Raw Data']['Longest Subread N50'] = "{}".format(attr['raw_data_report.insert_n50'])
+    reports['Raw Data']['Unique Molecular Yield (Gb)'] = "{:.1f}".format(attr['raw_data_report.unique_molecular_yield'] / 1e9)
+
+    # This one from the loading report, aside from OPLC which we don't have
+    productive_zmws = attr['loading_xml_report.productive_zmws']
     for n in ["0", "1", "2"]:
         if productive_zmws:
-            productivity_pct = (ld[f'loading_xml_report.productivity_{n}_n'] / productive_zmws) * 100
+            productivity_pct = (attr[f'loading_xml_report.productivity_{n}_n'] / productive_zmws) * 100
             reports['Loading'][f'P{n} %'] = "{:.2f}".format(productivity_pct)
         else:
             reports['Loading'][f'P{n} %'] = "0.0"
@@ -154,63 +229,59 @@ def compile_json_reports(reports_dict, metadata_xml, sts_xml=None, lima_counts=N
     reports['Loading']['OPLC (pM), On-Plate Loading Conc.'] = metadata_xml['on_plate_loading_conc']
     reports['Loading']['Real OPLC (pM), after clean-up'] = "to be calculated"
 
-    # This is under reports_dict['ccs'] and yes these really are HiFi numbers
-    ccsd = { a['id']: a['value'] for a in reports_dict['ccs']['attributes'] }
-    reports['HiFi Data']['HiFi Reads (M)'] = "{:.2f}".format(ccsd['ccs2.number_of_ccs_reads'] / 1e6)
-    reports['HiFi Data']['HiFi Yield (Gb)'] = "{:.2f}".format(ccsd['ccs2.total_number_of_ccs_bases'] / 1e6)
-    reports['HiFi Data']['HiFi Read Length (mean, bp)'] = "{}".format(ccsd['ccs2.mean_ccs_readlength'])
-    reports['HiFi Data']['HiFi Read Length (median, bp)'] = "{}".format(ccsd['ccs2.median_ccs_readlength'])
-    reports['HiFi Data']['HiFi Read Quality (median)'] = ccsd['ccs2.median_accuracy']
-    reports['HiFi Data']['HiFi Bases Quality ≥Q30 (%)'] = "{:.2f}".format(ccsd['ccs2.percent_ccs_bases_q30'] * 100)
-    reports['HiFi Data']['HiFi Number of Passes (mean)'] = "{}".format(ccsd['ccs2.mean_npasses'])
-
-    # Shred two tables from the reports_dict['ccs'] section
-    try:
-        ccst1, = [ t['columns'] for t in reports_dict['ccs']['tables']
-                   if t['id'] == 'ccs2.hifi_length_summary' ]
-        ccsd1 = dict(zip(*[c['values'] for c in ccst1 if c['id'] == 'ccs2.hifi_length_summary.read_length'],
-                         *[c['values'] for c in ccst1 if c['id'] == 'ccs2.hifi_length_summary.reads_pct']))
+    # This is from the ccs report and yes these really are HiFi numbers
+    reports['HiFi Data']['HiFi Reads (M)'] = "{:.2f}".format(attr['ccs2.number_of_ccs_reads'] / 1e6)
+    reports['HiFi Data']['HiFi Yield (Gb)'] = "{:.2f}".format(attr['ccs2.total_number_of_ccs_bases'] / 1e6)
+    reports['HiFi Data']['HiFi Read Length (mean, bp)'] = "{}".format(attr['ccs2.mean_ccs_readlength'])
+    reports['HiFi Data']['HiFi Read Length (median, bp)'] = "{}".format(attr['ccs2.median_ccs_readlength'])
+    reports['HiFi Data']['HiFi Read Quality (median)'] = attr['ccs2.median_accuracy']
+    reports['HiFi Data']['HiFi Bases Quality ≥Q30 (%)'] = "{:.2f}".format(attr['ccs2.percent_ccs_bases_q30'] * 100)
+    reports['HiFi Data']['HiFi Number of Passes (mean)'] = "{}".format(attr['ccs2.mean_npasses'])
+
+    # Shred two tables from the ccs report. Only a missing table is expected - any
+    # other missing value is an error.
+    table_cols = [ 'ccs2.hifi_length_summary.read_length',
+                   'ccs2.hifi_length_summary.reads_pct',
+                   'ccs2.read_quality_summary.read_qv',
+                   'ccs2.read_quality_summary.reads_pct' ]
+    if all(c in cols for c in table_cols):
+        ccsd1 = dict(zip( cols['ccs2.hifi_length_summary.read_length'],
+                          cols['ccs2.hifi_length_summary.reads_pct'] ))
         reports['HiFi Length %']['≥ 5,000 bp'] = "{:.1f}".format(ccsd1['≥ 5,000'])
         reports['HiFi Length %']['≥ 10,000 bp'] = "{:.1f}".format(ccsd1['≥ 10,000'])
         reports['HiFi Length %']['≥ 15,000 bp'] = "{:.1f}".format(ccsd1['≥ 15,000'])
         reports['HiFi Length %']['≥ 20,000 bp'] = "{:.1f}".format(ccsd1['≥ 20,000'])
 
-        ccst2, = [ t['columns'] for t in reports_dict['ccs']['tables']
-                   if t['id'] == 'ccs2.read_quality_summary' ]
-        ccsd2 = dict(zip(*[c['values'] for c in ccst2 if c['id'] == 'ccs2.read_quality_summary.read_qv'],
-                         *[c['values'] for c in ccst2 if c['id'] == 'ccs2.read_quality_summary.reads_pct']))
+        ccsd2 = dict(zip( cols['ccs2.read_quality_summary.read_qv'],
+                          cols['ccs2.read_quality_summary.reads_pct'] ))
         reports['Hifi Quality %']['≥ Q30'] = "{:.1f}".format(ccsd2['≥ Q30'])
         reports['Hifi Quality %']['≥ Q40'] = "{:.1f}".format(ccsd2['≥ Q40'])
-    except ValueError:
+    else:
         reports['HiFi Length %']['all'] = "missing table in JSON"
         reports['Hifi Quality %']['all'] = "missing table in JSON"
 
     # Barcodes
     if lima_counts:
         reports['Barcodes'].update(summarize_lima_counts(lima_counts))
-    elif 'barcodes' in reports_dict:
+    elif 'barcodes' in record['reports']:
         # This is problematic because we don't get a fresh report if the run is re-demultiplexed
-        bcd = { a['id']: a['value'] for a in reports_dict['barcodes']['attributes'] }
+        # The table is just for the CV - Surely this is already logged somewhere?
+        bcvq = cols["barcode.barcode_table.mean_bcqual"]
+        bcvc = cols["barcode.barcode_table.number_of_reads"]
 
-        # This just for the CV - Surely this is already logged somewhere?
-        bct, = [t for t in reports_dict['barcodes']['tables'] if t['id'] == "barcode.barcode_table"]
-        bcvq, = [c for c in bct['columns'] if c['id'] == "barcode.barcode_table.mean_bcqual"]
-        bcvc, = [c for c in bct['columns'] if c['id'] == "barcode.barcode_table.number_of_reads"]
-
-        reports['Barcodes']['Number of samples'] = bcd['barcode.n_barcodes']
-        reports['Barcodes']['Assigned Reads (%)'] = "{:.2f}".format(bcd['barcode.percent_barcoded_reads'] * 100)
-        reports['Barcodes']['CV'] = "{:.2f}".format(calculate_cv(bcvc['values'], bcvq['values']))
+        reports['Barcodes']['Number of samples'] = attr['barcode.n_barcodes']
+        reports['Barcodes']['Assigned Reads (%)'] = "{:.2f}".format(attr['barcode.percent_barcoded_reads'] * 100)
+        reports['Barcodes']['CV'] = "{:.2f}".format(calculate_cv(bcvc, bcvq))
     else:
         reports['Barcodes']['Number of samples'] = 0 # As distinct from a single barcoded sample
         reports['Barcodes']['Assigned Reads (%)'] = 100
         reports['Barcodes']['CV'] = "N/A"
 
     # Control
-    cond = { a['id']: a['value'] for a in reports_dict['control']['attributes'] }
-    reports['Control']['Number of Control Reads'] = "{}".format(cond['control.reads_n'])
-    reports['Control']['Control Read Length Mean'] = "{:.0f}".format(cond['control.readlength_mean'])
-    reports['Control']['Control Read Concordance Mean'] = "{:.3f}".format(cond['control.concordance_mean'])
-    reports['Control']['Control Read Concordance Mode'] = "{:.3f}".format(cond['control.concordance_mode'])
+    reports['Control']['Number of Control Reads'] = "{}".format(attr['control.reads_n'])
+    reports['Control']['Control Read Length Mean'] = "{:.0f}".format(attr['control.readlength_mean'])
+    reports['Control']['Control Read Concordance Mean'] = "{:.3f}".format(attr['control.concordance_mean'])
+    reports['Control']['Control Read Concordance Mode'] = "{:.3f}".format(attr['control.concordance_mode'])
 
     # Adapter
     reports['Adapter']['Local Base Rate'] = "unknown"
@@ -218,11 +289,10 @@ def compile_json_reports(reports_dict, metadata_xml, sts_xml=None, lima_counts=N
         reports['Adapter']['Adapter Dimers (0-10bp) %'] = "{:.4f}".format(sts_xml['adapter_dimers'])
         reports['Adapter']['Short Inserts (11-100bp) %'] = "{:.4f}".format(sts_xml['short_inserts'])
         reports['Adapter']['Local Base Rate'] = "{:.2f}".format(sts_xml['local_base_rate_median'])
-    elif 'adapter' in reports_dict:
-        adad = { a['id']: a['value'] for a in reports_dict['adapter']['attributes'] }
-        reports['Adapter']['Adapter Dimers (0-10bp) %'] = "{:.2f}".format(adad['adapter_xml_report.adapter_dimers'])
-        reports['Adapter']['Short Inserts (11-100bp) %'] = "{:.2f}".format(adad['adapter_xml_report.short_inserts'])
-        reports['Adapter']['Local Base Rate'] = "{:.2f}".format(adad['adapter_xml_report.local_base_rate_median'])
+    elif 'adapter' in record['reports']:
+        reports['Adapter']['Adapter Dimers (0-10bp) %'] = "{:.2f}".format(attr['adapter_xml_report.adapter_dimers'])
+        reports['Adapter']['Short Inserts (11-100bp) %'] = "{:.2f}".format(attr['adapter_xml_report.short_inserts'])
+        reports['Adapter']['Local Base Rate'] = "{:.2f}".format(attr['adapter_xml_report.local_base_rate_median'])
 
     # Instrument
     reports['Instrument']['Run ID'] = metadata_xml['run_id']
@@ -238,7 +308,7 @@ def compile_json_reports(reports_dict, metadata_xml, sts_xml=None, lima_counts=N
 
     # This is funky, as the metadata.xml is full of dates but the JSON reports only have them
     # in the comments. I don't want to look at the timestamps of the files.
-    mo = re.search(r"at ([-0-9]{10})T[0-9:.]+", reports_dict['ccs']['_comment'])
+    mo = re.search(r"at ([-0-9]{10})T[0-9:.]+", record['comments']['ccs'])
     reports['Dataset']['Data created'] = mo.group(1)
 
     # That's it! But I need to add back some info that was previously handled by extract_ids_multi
@@ -379,6 +449,13 @@ def parse_args(*args):
     argparser.add_argument("--lima_counts",
                             help="Location of lima_counts.txt for this cell")
 
+    argparser.add_argument("--record",
+                            help="Load a cell record previously saved with --make_record, in place" +
+                                 " of all the above files.")
+    argparser.add_argument("--make_record", action="store_true",
+                            help="Just extract the cell record from the above files and print it" +
+                                 " as JSON.")
+
     argparser.add_argument("-d", "--debug", action="store_true",
                             help="Print more verbose debugging messages.")
     argparser.add_argument("-c", "--check_yaml", action="store_true",
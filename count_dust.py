@@ -1,42 +1,140 @@
 #!/usr/bin/env python3
 import sys
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import numpy as np
 
 # Read the output of dustmasker_static and report the proportion of
 # non-dust (uppercase) per sequence.
-upper = 0
-lower = 0
-count = 0
+# Or, read the interval output of dustmasker along with the original FASTA
+# file, which saves dustmasker from writing out all the sequences again.
+
 # These aren't contigs but we pretend they are...
-contig = None
-
-# This just prints out the proportion, which is the more sensible
-# type of output.
-"""
-def emit():
-    if count:
-        total = upper + lower
-        print('0.000' if total == 0 else "{:.3f}".format(upper / total))
-"""
-
-# But for blobtools we want something a little different
-print("## count_dust v0.0")
-print("## Total Reads = 10000") # We assume?!
-print("## Mapped Reads = 10000")
-print("## Unmapped Reads = 0")
-print("# contig_id\tread_cov\tbase_cov")
-def emit():
-    if count:
-        total = upper + lower
-        frac = 0.0 if total == 0 else (upper / total)
-        print("{}\t1\t{:.3f}".format(contig, 10**(5*(frac-0.5))))
-
-for l in sys.stdin:
-    if l.startswith('>'):
-        emit()
-        count += 1
-        contig = l.split('|')[1].strip()
-        upper = lower = 0
-    else:
-        upper += sum( 1 for n in l if n in 'ATCG' )
-        lower += sum( 1 for n in l if n in 'atcg' )
-emit()
+# For blobtools we want this header and a line per contig.
+COV_HEADER = [ "## count_dust v0.0",
+               "## Total Reads = 10000", # We assume?!
+               "## Mapped Reads = 10000",
+               "## Unmapped Reads = 0",
+               "# contig_id\tread_cov\tbase_cov" ]
+
+def byte_table(bases):
+    """Make a table which, dotted with a bincount of the bytes in a sequence, gives the
+       number of those bases.
+    """
+    table = np.zeros(256, dtype=np.int64)
+    table[list(bases.encode())] = 1
+
+    return table
+
+UPPER_TABLE = byte_table('ATCG')
+LOWER_TABLE = byte_table('atcg')
+ACGT_TABLE = UPPER_TABLE + LOWER_TABLE
+
+def parse_args(*args):
+    description = """Make a blobtools COV file from the output of dustmasker, where the
+                     coverage reflects the proportion of each sequence that is not dust.
+                  """
+    argparser = ArgumentParser( description=description,
+                                formatter_class = ArgumentDefaultsHelpFormatter )
+    argparser.add_argument("infile", nargs='?',
+                            help="dustmasker output to read, or else will read from stdin.")
+    argparser.add_argument("-f", "--fasta",
+                            help="Input is dustmasker '-outfmt interval' output, and the" +
+                                 " sequences are to be read from this FASTA file.")
+
+    return argparser.parse_args(*args)
+
+def main(args):
+
+    infh = open(args.infile, 'rb') if args.infile else sys.stdin.buffer
+    try:
+        if args.fasta:
+            with open(args.fasta, 'rb') as ffh:
+                counts = count_intervals(infh, read_fasta(ffh))
+        else:
+            counts = count_masked(read_fasta(infh))
+
+        for l in COV_HEADER:
+            print(l)
+        for contig, upper, lower in counts:
+            print(cov_line(contig, upper, lower))
+    finally:
+        if args.infile:
+            infh.close()
+
+def cov_line(contig, upper, lower):
+    """Format the line for one sequence
+    """
+    total = upper + lower
+    frac = 0.0 if total == 0 else (upper / total)
+
+    return "{}\t1\t{:.3f}".format(contig, 10**(5*(frac-0.5)))
+
+def contig_name(header):
+    """dustmasker makes the FASTA headers like '>lcl|name', but in the original
+       FASTA they will just be '>name'.
+    """
+    header = header.decode()
+    return (header.split('|')[1] if '|' in header else header[1:]).strip()
+
+def read_fasta(fh):
+    """Read a FASTA file in binary mode and yield (name, seq) for each record
+    """
+    name = None
+    seq_lines = []
+
+    for l in fh:
+        if l.startswith(b'>'):
+            if name is not None:
+                yield name, b''.join(seq_lines)
+            name = contig_name(l)
+            seq_lines = []
+        else:
+            seq_lines.append(l.rstrip())
+    if name is not None:
+        yield name, b''.join(seq_lines)
+
+def count_masked(records):
+    """Count up the upper and lower case bases in each masked sequence, yielding
+       (name, upper, lower)
+    """
+    for name, seq in records:
+        byte_counts = np.bincount(np.frombuffer(seq, dtype=np.uint8), minlength=256)
+
+        yield name, int(byte_counts @ UPPER_TABLE), int(byte_counts @ LOWER_TABLE)
+
+def count_intervals(fh, records):
+    """Read dustmasker interval output, where the masked ranges for each sequence are
+       listed as "start - end", inclusive and counting from zero. Yields (name, upper,
+       lower) just as count_masked() would have.
+    """
+    for name, intervals in read_intervals(fh):
+        seq_name, seq = next(records)
+        if seq_name != name:
+            raise RuntimeError(f"Mismatched sequence names {seq_name} and {name}")
+
+        acgt_cumsum = np.concatenate(( [0],
+                                       np.cumsum(ACGT_TABLE[np.frombuffer(seq, dtype=np.uint8)]) ))
+        lower = sum( int(acgt_cumsum[e + 1] - acgt_cumsum[s]) for s, e in intervals )
+
+        yield name, int(acgt_cumsum[-1]) - lower, lower
+
+def read_intervals(fh):
+    """Read dustmasker interval output and yield (name, [(start, end), ...])
+    """
+    name = None
+    intervals = []
+
+    for l in fh:
+        if l.startswith(b'>'):
+            if name is not None:
+                yield name, intervals
+            name = contig_name(l)
+            intervals = []
+        elif l.strip():
+            start, end = l.split(b'-')
+            intervals.append((int(start), int(end)))
+    if name is not None:
+        yield name, intervals
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -14,12 +14,14 @@ shopt -sq failglob
 #  on in Illuminatus.
 #
 #  It will go through all runs in FROM_LOCATION and take action on them as needed.
+#  Alternatively, the runs to look at may be given as arguments, relative to FROM_LOCATION,
+#  which is how pb_driver.py calls this script to deal with several runs at once.
 #  As a well behaved CRON job it should only output critical error messages
 #  to stdout - this is controlled by the MAINLOG setting.
 #  The script wants to run every 5 minutes or so, and having multiple instances
-#  in flight at once is fine, though in fact there are race conditions possible if two
-#  instances start at once and claim the same run for processing (Snakemake locking
-#  should catch any fallout before data is scrambled).
+#  in flight at once is fine. Cells and reports are claimed while holding a lock on
+#  the pbpipeline directory, so two instances will not claim the same cell (and Snakemake
+#  locking should catch any other fallout before data is scrambled).
 #
 #  Note within this script I've tried to use ( subshell blocks ) along with "set -e"
 #  to emulate eval{} statements in Perl. It does work but you have to be really careful
@@ -49,7 +51,7 @@ if [ -e "$ENVIRON_SH" ] ; then
            RSYNC_CMD          STALL_TIME         VERBOSE    \
            FILTER_LOCALLY     BLOBS \
            EXTRA_SNAKE_FLAGS  EXTRA_SNAKE_CONFIG EXTRA_SLURM_FLAGS \
-           SMRTLINKRC_SECTION
+           SMRTLINKRC_SECTION STATUS_INDEX
 fi
 
 # LOG_DIR is ignored if MAINLOG is set explicitly.
@@ -108,6 +110,10 @@ if ! [ -e "$TO_LOCATION"/.smrtino ] ; then
     exit 1
 fi
 
+# pb_run_status.py -j keeps the status of finished runs here, so they are not re-examined
+# every time. Set this to '' to disable the index.
+export STATUS_INDEX="${STATUS_INDEX-$TO_LOCATION/.pb_run_status.sqlite}"
+
 # Per-run log for detailed progress messages, goes into the output directory.
 plog() {
     per_run_log="$RUN_OUTPUT/pipeline.log"
@@ -155,17 +161,56 @@ touch_atomic(){
     (set -o noclobber ; >"$1")
 }
 
-touch_or_wait(){
-    # Create a file but if it already exists poll for up to 5 minutes
-    poll_interval=5 # seconds
-    poll_count=60   # 60 loops == 5 minutes
+lock_pbpipeline(){ # pbpipeline_dir
+    # Take an exclusive lock on the pbpipeline directory of a run, waiting up to 5 minutes.
+    # Several drivers may be working on the same run at once (eg. when called by
+    # pb_driver.py), so any touch file that claims a cell or the report must be made while
+    # holding this lock. The lock is on FD 7 and will be released by unlock_pbpipeline.
+    # Returns 1 if the lock could not be had. If the filesystem does not support flock
+    # at all (eg. Lustre mounted without it, where flock exits 71 for ENOLCK) this returns
+    # 2 and the caller must claim files with touch_atomic instead.
+    local rc=0
+    exec 7>>"$1/driver.lock" || return 1
+    flock -w 300 7 || rc=$?
+    if [ $rc -gt 1 ] ; then
+        exec 7>&-
+        log "  flock failed with status $rc on $1/driver.lock. Using touch_atomic instead."
+        return 2
+    fi
+    return $rc
+}
+
+unlock_pbpipeline(){
+    exec 7>&-
+}
+
+touch_locked(){ # pbpipeline_dir file [wait]
+    # Create a file in the pbpipeline directory, while holding the lock. It's an error if
+    # the file already exists, unless 'wait' is given in which case we poll for up to 5
+    # minutes for the file to be removed.
+    local poll_interval=5 # seconds
+    local poll_count=60   # 60 loops == 5 minutes
+    [ "${3:-}" = wait ] || poll_count=1
 
+    local lock_rc
     while [[ $poll_count -gt 0 ]] ; do
         poll_count=$(( $poll_count - 1 ))
-        (set -o noclobber ; >"$1") || continue
-        return 0
+        lock_rc=0 ; lock_pbpipeline "$1" || lock_rc=$?
+        if [ $lock_rc = 0 ] ; then
+            if ! [ -e "$1/$2" ] ; then
+                touch "$1/$2" ; unlock_pbpipeline
+                return 0
+            fi
+            unlock_pbpipeline
+        elif [ $lock_rc = 2 ] ; then
+            # No flock, so fall back to noclobber
+            touch_atomic "$1/$2" 2>/dev/null && return 0
+        else
+            return 1
+        fi
+        [[ $poll_count = 0 ]] || sleep $poll_interval
     done
-    echo "Timeout after 300 seconds." 2>&1
+    [ "${3:-}" != wait ] || echo "Timeout after 300 seconds." 2>&1
     return 1
 }
 
@@ -233,12 +278,38 @@ action_new(){
 action_cell_ready(){
     # It's time for Snakefile.process_cells to process one or more cells.
     local cell always_run
+    local claimed=''
+    local lock_rc=0
+
+    # Claim the cells while holding the lock, as another driver may have got there first.
+    lock_pbpipeline "$RUN_OUTPUT/pbpipeline" || lock_rc=$?
+    if [ $lock_rc = 1 ] ; then
+        log "\_CELL_READY $RUNID. Could not lock $RUN_OUTPUT/pbpipeline. Will try again later."
+        return
+    fi
     # There should not be a report.done but if there is remove it
     rm -f "$RUN_OUTPUT/pbpipeline/report.done"
     for cell in $CELLSREADY ; do
-        touch_atomic "$RUN_OUTPUT/pbpipeline/${cell}.started"
+        if [ -e "$RUN_OUTPUT/pbpipeline/${cell}.started" ] || \
+           [ -e "$RUN_OUTPUT/pbpipeline/${cell}.done" ] ; then
+            continue
+        fi
+        if [ $lock_rc = 0 ] ; then
+            touch "$RUN_OUTPUT/pbpipeline/${cell}.started"
+        elif ! touch_atomic "$RUN_OUTPUT/pbpipeline/${cell}.started" 2>/dev/null ; then
+            # Without the lock, the noclobber touch is the claim
+            continue
+        fi
         rm -f "$RUN_OUTPUT/pbpipeline/${cell}.ready"
+        claimed="$claimed $cell"
     done
+    unlock_pbpipeline
+
+    CELLSREADY="${claimed# }"
+    if [ -z "$CELLSREADY" ] ; then
+        log "\_CELL_READY $RUNID. All the cells were claimed by another driver."
+        return
+    fi
 
     # Make an sc_data.yaml file with a timestamped name.
     # There's a definite race condition if using a single sc_data.yaml. See doc/sc_data_race.txt
@@ -266,8 +337,8 @@ action_cell_ready(){
       cd "$RUN_OUTPUT"
 
       # Compile info for all cells, not just the one being processed. And fix the perms
-      # set by mktemp
-      scan_cells.py -c $CELLSREADY $CELLSPROCESSING $CELLSDONE > "$SC_DATA_FILE"
+      # set by mktemp. Cells that have not changed since the last scan are cached.
+      scan_cells.py -j 8 --cache pbpipeline/sc_cache -c $CELLSREADY $CELLSPROCESSING $CELLSDONE > "$SC_DATA_FILE"
       chmod --reference=pipeline.log "$SC_DATA_FILE"
 
       Snakefile.kinnex_scan --config cells="$CELLSREADY" sc_data="$SC_DATA_FILE" \
@@ -306,7 +377,7 @@ action_cell_ready(){
                        -p report_main
 
       # Snakefile.report jobs can now run in parallel, but the upload still needs to be gated.
-      touch_or_wait pbpipeline/report.started
+      touch_locked pbpipeline report.started wait
 
       # Mark the cells as done while the report is run/uploaded
       for cell in $CELLSREADY ; do
@@ -361,7 +432,10 @@ action_processed() {
     # This touch file puts the run into status reporting.
     # Upload of all reports is regarded as the final QC step, so if this fails we need to
     # log a failure even if everything else was OK.
-    touch_atomic "$RUN_OUTPUT"/pbpipeline/report.started
+    if ! touch_locked "$RUN_OUTPUT"/pbpipeline report.started ; then
+        log "  The report on $RUNID was started by another driver."
+        return
+    fi
     BREAK=1
     set +e
 
@@ -629,20 +703,64 @@ pipeline_fail() {
     fi
 }
 
-get_run_status() { # run_dir
+load_run_statuses() { # run_dir...
+  # Invoke pb_run_status.py just once on all the runs, saving one line of JSON per run
+  # into RUN_STATUS_LINES. This saves starting Python afresh for every run.
+  # If this fails get_run_status will fall back to checking the runs one at a time.
+  RUN_STATUS_LINES=()
+  [ $# -gt 0 ] || return 0
+
+  local rs
+  if ! rs="$(pb_run_status.py -j "$@")" ; then
+    log "Failed to get the status of all runs in one go. Will check them one at a time."
+    return 0
+  fi
+  mapfile -t RUN_STATUS_LINES <<<"$rs"
+
+  if [ "${#RUN_STATUS_LINES[@]}" != $# ] ; then
+    log "Expected $# lines from pb_run_status.py but got ${#RUN_STATUS_LINES[@]}."
+    RUN_STATUS_LINES=()
+  fi
+}
+
+json_field() { # json_line key
+  # Extract a string value from the flat JSON written by pb_run_status.py -j
+  # Values with escaped characters are not supported, but these will never appear
+  # in run or cell names.
+  local re="\"$2\": \"([^\"\\]*)\""
+  if [[ "$1" =~ $re ]] ; then
+    echo "${BASH_REMATCH[1]}"
+  fi
+}
+
+get_run_status() { # run_dir [json_line]
   # invoke pb_run_status.py on $1 and collect some meta-information about the run.
   # We're passing this info to the state functions via global variables.
+  # If the JSON for the run was already loaded by load_run_statuses, use that instead.
   local run="$1"
+  local json="${2:-}"
+  local rs=''
 
-  # This construct allows error output to be seen in the log.
-  local rs="$(pb_run_status.py "$run")" || pb_run_status.py "$run" | log 2>&1
+  if [ -n "$json" ] && [ "$(json_field "$json" RunDir)" != "$run" ] ; then
+    log "Mismatched status for $run in: $json"
+    json=''
+  fi
+
+  if [ -z "$json" ] ; then
+    # This construct allows error output to be seen in the log.
+    rs="$(pb_run_status.py "$run")" || pb_run_status.py "$run" | log 2>&1
+  fi
 
   # Capture the various parts into variables (see test/grs.sh in Hesiod)
   local v line
   for v in RUNID/RunID INSTRUMENT/Instrument STATUS/PipelineStatus \
            CELLS/Cells CELLSREADY/CellsReady CELLSPROCESSING/CellsProcessing CELLSDONE/CellsDone \
            CELLSABORTED/CellsAborted ; do
-    line="$(awk -v FS=":" -v f="${v#*/}" '$1==f {gsub(/^[^:]*:[[:space:]]*/,"");print}' <<<"$rs")"
+    if [ -n "$json" ] ; then
+      line="$(json_field "$json" "${v#*/}")"
+    else
+      line="$(awk -v FS=":" -v f="${v#*/}" '$1==f {gsub(/^[^:]*:[[:space:]]*/,"");print}' <<<"$rs")"
+    fi
     eval "${v%/*}"='"$line"'
   done
 
@@ -671,15 +789,20 @@ for rnregex in "${RUN_NAME_REGEX[@]}" ; do
 done
 # debug "PREFIX_RUN_NAME_REGEX is (${PREFIX_RUN_NAME_REGEX[@]})"
 
-# 6) Scan through each run until we find something that needs dealing with.
+# 6) Find all the runs, unless they were given on the command line.
 pushd "$FROM_LOCATION" >/dev/null
-candidate_run_list=(*/)
+if [ $# -gt 0 ] ; then
+  candidate_run_list=()
+  run_list=("$@")
+else
+  candidate_run_list=(*/)
+  run_list=()
+fi
 
 while [[ "${#candidate_run_list[@]}" > 0 ]] ; do
 
   # Shift the first item off the list
   run_basename="${candidate_run_list[0]%/}"
-  run_dir="$FROM_LOCATION/$run_basename"
   candidate_run_list=("${candidate_run_list[@]:1}")
 
   # Scan for full matches, indicating we have a run
@@ -705,9 +828,21 @@ while [[ "${#candidate_run_list[@]}" > 0 ]] ; do
     continue
   fi
 
+  run_list+=("$run_basename")
+done
+
+# 7) Get the status of every run in one go, then go through each run until we find
+#    something that needs dealing with.
+load_run_statuses "${run_list[@]/#/$FROM_LOCATION/}"
+
+for run_idx in "${!run_list[@]}" ; do
+
+  run_basename="${run_list[$run_idx]}"
+  run_dir="$FROM_LOCATION/$run_basename"
+
   # invoke runinfo and collect some meta-information about the run. We're passing this info
   # to the state functions via global variables. RUNID INSTRUMENT CELLS etc.
-  get_run_status "$run_dir"
+  get_run_status "$run_dir" "${RUN_STATUS_LINES[$run_idx]:-}"
 
   _log=log
   for s in complete aborted testrun ; do
@@ -4,65 +4,168 @@
 """
 import os, sys
 from collections import namedtuple, OrderedDict
-from itertools import islice, takewhile
+from itertools import islice
+from functools import reduce
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
+import numpy as np
+
 from smrtino import dump_yaml
+from smrtino import bam
 
 fastaline = namedtuple('fastaline', 'length at_bases gc_bases'.split())
+histogram = namedtuple('histogram', 'tally at_bases gc_bases'.split())
+
+# How many fastaline tuples to add to the histogram at a time
+BATCHSIZE = 100000
+
+# Read buffer size for FASTA files
+BUFSIZE = 1024 * 1024
+
+def byte_table(bases):
+    """Make a table which, dotted with a bincount of the bytes in a sequence, gives the
+       number of those bases.
+    """
+    table = np.zeros(256, dtype=np.int64)
+    table[list(bases.encode())] = 1
+
+    return table
+
+AT_TABLE = byte_table('ATat')
+GC_TABLE = byte_table('GCgc')
+
+# And the same for packed bases in BAM files
+BAM_AT_TABLE = bam.nibble_table('AT')
+BAM_GC_TABLE = bam.nibble_table('GC')
 
 def read_fasta(fh, trim_n=False):
     """Reads lines from a FASTA file, and for each returns the total length and the
        GC content. You can opt to trim N's from the end.
+       The file must be opened in binary mode.
     """
-    # Length and GC for the current read. We also need both at and gc count so N's
-    # don't skew the GC calculation.
-    length = at = gc = 0
-    # Count of reads read
+    # Lines of the current read, and count of reads read
+    lines = []
     count = 0
 
     for l in fh:
-        if l.startswith('>'):
+        if l.startswith(b'>'):
             if count:
-                yield(fastaline(length, at, gc))
+                yield seq_fastaline(b''.join(lines))
             count += 1
-            length = at = gc = 0
+            lines = []
         else:
             l = l.strip()
             if trim_n:
-                l = l.strip('Nn')
+                l = l.strip(b'Nn')
+            lines.append(l)
+    if count:
+        yield seq_fastaline(b''.join(lines))
 
-            # This was my original atgc counter. It works but is slow.
-            #atgc += sum( 1 for n in l if n in 'ATGCatgc' )
-            # These variations are faster
-            #atgc += sum( l.count(n) for n in 'ATGCatgc' )
-            #atgc += len(re.findall('[ATGCatgc]', l))
+def seq_fastaline(seq):
+    """Get the fastaline tuple for a whole sequence.
+    """
+    # My original atgc counter was:
+    #atgc += sum( 1 for n in l if n in 'ATGCatgc' )
+    # and then I had a version calling l.count() for each of 'ATat' and 'GCgc'
+    # but that makes eight passes over the line. Tallying all the bytes at once
+    # with NumPy is much faster on long reads. We do this once per read, not per line,
+    # as the set-up cost of bincount would dominate on wrapped FASTA.
+    byte_counts = np.bincount(np.frombuffer(seq, dtype=np.uint8), minlength=256)
 
-            # But this is the best I found.
-            at += sum( l.count(n) for n in 'ATat' )
-            gc += sum( l.count(n) for n in 'GCgc' )
+    return fastaline( len(seq),
+                      int(byte_counts @ AT_TABLE),
+                      int(byte_counts @ GC_TABLE) )
 
-            length += len(l)
-    if count:
-        yield(fastaline(length, at, gc))
+def read_bam(filename, trim_n=False, threads=1):
+    """Reads a BAM file directly and yields the same fastaline tuples as read_fasta(),
+       without going through "samtools fasta". threads is the number of threads used
+       to decompress the BAM.
+    """
+    for buf, records in bam.iter_record_chunks(filename, threads):
+        yield from bam_fastalines(np.frombuffer(buf, dtype=np.uint8), records, trim_n)
+
+def bam_fastalines(packed, records, trim_n=False):
+    """Get the fastaline tuples for a chunk of BAM records, as found by
+       bam.iter_record_chunks(). The 4-bit packed bases are tallied a byte at a time
+       with bincount, then lookup tables turn the byte counts into AT and GC counts.
+    """
+    seq_starts, seq_lens = records.seq_starts, records.seq_lens
+
+    # Any odd padding nibble is zero, which is '=', so is not counted
+    byte_counts = np.array([ np.bincount(packed[s:e], minlength=256)
+                             for s, e in zip(seq_starts.tolist(), records.qual_starts.tolist()) ],
+                           dtype=np.int64).reshape(-1, 256)
+    at_bases = byte_counts @ BAM_AT_TABLE
+    gc_bases = byte_counts @ BAM_GC_TABLE
+
+    if trim_n:
+        seq_lens = trim_packed_n(packed, seq_starts, seq_lens)
+
+    return list(map(fastaline, seq_lens.tolist(), at_bases.tolist(), gc_bases.tolist()))
+
+def trim_packed_n(packed, seq_starts, seq_lens):
+    """Work out the sequence lengths after trimming N's from either end. Only sequences
+       which start or end with N need to be looked at in detail.
+    """
+    seq_lens = seq_lens.copy()
+
+    # An empty sequence at the very end of the buffer has no bytes to look at
+    has_seq = seq_lens > 0
+    first_bytes = packed[np.where(has_seq, seq_starts, 0)]
+    last_bytes = packed[np.where(has_seq, seq_starts + (seq_lens - 1) // 2, 0)]
+    last_nibbles = np.where(seq_lens % 2, last_bytes >> 4, last_bytes & 0xf)
+    to_trim, = np.nonzero( has_seq & ( ((first_bytes >> 4) == bam.N_CODE) |
+                                       (last_nibbles == bam.N_CODE) ) )
+
+    for i in to_trim.tolist():
+        seq = bam.unpack_seq(packed, seq_starts[i], seq_lens[i])
+        seq_lens[i] = len(seq.strip('N'))
+
+    return seq_lens
 
 def fasta_to_histo(fastalines):
-    """Reads fastaline tuples as produced by read_fasta(...) and retuns a histogram (a list) of
-       dict(tally=..., at_bases=..., gc_bases=...)
+    """Reads fastaline tuples as produced by read_fasta(...) and returns a histogram, being
+       three NumPy arrays (tally, at_bases, gc_bases) indexed by read length.
     """
-    res = list()
+    res = histogram(*[ np.zeros(0, dtype=np.int64) for _ in histogram._fields ])
+
+    fastalines = iter(fastalines)
+    while True:
+        batch = np.array(list(islice(fastalines, BATCHSIZE)), dtype=np.int64).reshape(-1, 3)
+        if not len(batch):
+            break
+        lengths, at_bases, gc_bases = batch.T
 
-    for fline in fastalines:
-        if fline.length > len(res) - 1:
-            res.extend( dict(tally=0, at_bases=0, gc_bases=0) for _ in range(len(res) - 1, fline.length) )
-        res[fline.length]['tally'] += 1
-        res[fline.length]['at_bases'] += fline.at_bases
-        res[fline.length]['gc_bases'] += fline.gc_bases
+        res = add_histo( res, histogram( np.bincount(lengths),
+                                         bincount_sum(lengths, at_bases),
+                                         bincount_sum(lengths, gc_bases) ) )
+
+    return res
+
+def bincount_sum(idx, values):
+    """Like np.bincount(idx, weights=values) but keeps the result as exact integers.
+    """
+    res = np.zeros(idx.max() + 1, dtype=np.int64)
+    np.add.at(res, idx, values)
+
+    return res
+
+def add_histo(h1, h2):
+    """Add two histograms, which may be of different lengths.
+    """
+    if len(h2.tally) > len(h1.tally):
+        h1, h2 = h2, h1
+
+    res = histogram(*[ a.copy() for a in h1 ])
+    for a, b in zip(res, h2):
+        a[:len(b)] += b
 
     return res
 
 def histo_to_result(histo, cutoffs=(0,), headings=True):
     """ Do some calculations on the histogram.
+        All the totals for reads above any cutoff come from reverse cumulative sums,
+        so this is quick even for a long histogram and many cutoffs.
     """
     res = OrderedDict()
 
@@ -80,15 +183,31 @@ def histo_to_result(histo, cutoffs=(0,), headings=True):
             res.setdefault('_headings', []).append(newl)
         return newl
 
-    res[labelize('Min read length', None)] = sum(1 for _ in
-                                                 takewhile( lambda i: i['tally']==0,
-                                                            histo ))
-    res[labelize('Max read length', None)] = len(histo) - 1
+    def rev_cumsum(a):
+        """Sums of a[i:] for every i, with a final 0 for cutoffs beyond the end.
+        """
+        return np.append(np.cumsum(a[::-1])[::-1], 0)
+
+    max_len = len(histo.tally) - 1
+    lens_seen, = np.nonzero(histo.tally)
+
+    res[labelize('Min read length', None)] = int(lens_seen[0]) if len(lens_seen) else 0
+    res[labelize('Max read length', None)] = max_len
+
+    reads_from = rev_cumsum(histo.tally)
+    bases_from = rev_cumsum(np.arange(max_len + 1) * histo.tally)
+    gc_from = rev_cumsum(histo.gc_bases)
+    at_from = rev_cumsum(histo.at_bases)
+
+    # For the N50 search, bases_from in ascending order
+    bases_from_asc = bases_from[:max_len+1][::-1]
 
     for cutoff in cutoffs:
+        c = min(cutoff, max_len + 1)
+
         # Total reads and bases
-        total_reads = sum( h['tally'] for h in histo[cutoff:] )
-        total_length = sum( n * h['tally'] for n, h in islice(enumerate(histo), cutoff, None) )
+        total_reads = int(reads_from[c])
+        total_length = int(bases_from[c])
 
         res[labelize('Reads', cutoff)] = total_reads
         res[labelize('Total bases', cutoff)] = total_length
@@ -97,18 +216,15 @@ def histo_to_result(histo, cutoffs=(0,), headings=True):
         # If the cutoff is larger than the longest sequence the N50 will be the length
         # or the longest sequence(!?)
         half_length = (total_length // 2) + (total_length % 2)
-        sum_length = 0
-        for i in reversed(range(len(histo))):
-            sum_length += (i * histo[i]['tally'])
-            if sum_length >= half_length:
-                res[labelize('N50', cutoff)] = i
-                break
+        below_half = int(np.searchsorted(bases_from_asc, half_length))
+        if below_half < len(bases_from_asc):
+            res[labelize('N50', cutoff)] = max_len - below_half
         else:
             res[labelize('N50', cutoff)] = -1
 
         # GC
-        total_gc = sum( h['gc_bases'] for h in histo[cutoff:] )
-        total_at = sum( h['at_bases'] for h in histo[cutoff:] )
+        total_gc = int(gc_from[c])
+        total_at = int(at_from[c])
 
         try:
             res[labelize('GC %', cutoff)] = total_gc / (total_at + total_gc) * 100
@@ -126,12 +242,38 @@ def histo_to_result(histo, cutoffs=(0,), headings=True):
 
     return res
 
+def save_histo(histo, filename):
+    """Save the histogram in NPZ format, which can be loaded and merged later.
+    """
+    # Using a file handle stops NumPy adding .npz to the name
+    with open(filename, 'wb') as fh:
+        np.savez_compressed(fh, **histo._asdict())
+
+def load_histo(filename):
+    """Load a histogram saved by save_histo()
+    """
+    with np.load(filename) as npz:
+        return histogram(*[ npz[k].astype(np.int64) for k in histogram._fields ])
+
+def merge_histos(filenames):
+    """Load and sum any number of saved histograms, eg. from shards of a BAM file.
+    """
+    return reduce(add_histo, map(load_histo, filenames), fasta_to_histo([]))
+
 def main(args):
 
-    if not args.fastafile or args.fastafile == '-':
-        histo = fasta_to_histo(read_fasta(sys.stdin, trim_n = args.trim_n))
+    if args.merge:
+        if args.fastafile:
+            exit("Cannot read a FASTA file and also --merge histograms.")
+        histo = merge_histos(args.merge)
+    elif not args.fastafile or args.fastafile == '-':
+        histo = fasta_to_histo(read_fasta(sys.stdin.buffer, trim_n = args.trim_n))
+    elif args.fastafile.endswith('.bam'):
+        histo = fasta_to_histo(read_bam( args.fastafile,
+                                         trim_n = args.trim_n,
+                                         threads = args.jobs or 1 ))
     else:
-        with open(args.fastafile) as fh:
+        with open(args.fastafile, 'rb', buffering=BUFSIZE) as fh:
             histo = fasta_to_histo(read_fasta(fh, trim_n = args.trim_n))
 
     # Print the result to STDOUT
@@ -140,10 +282,13 @@ def main(args):
                                      headings=not(args.no_headings) )))
 
     # Save the histogram
+    if args.npz:
+        save_histo(histo, args.npz)
+
     if args.histogram:
         with open(args.histogram, 'w') as hfh:
-            for n, v in enumerate(histo):
-                print('{}\t{}'.format(n, v['tally']), file=hfh)
+            for n, v in enumerate(histo.tally.tolist()):
+                print('{}\t{}'.format(n, v), file=hfh)
 
 def parse_args(*args):
     description = """Reads a FASTA file and outputs some stats. Yes, it's yet another
@@ -152,7 +297,8 @@ def parse_args(*args):
     argparser = ArgumentParser( description=description,
                                 formatter_class = ArgumentDefaultsHelpFormatter )
     argparser.add_argument("fastafile", nargs='?',
-                            help="File to read, or else will read from stdin.")
+                            help="File to read, or else will read from stdin. A file" +
+                                 " ending in .bam will be read directly as BAM.")
     argparser.add_argument("-c", "--cutoff", type=int, nargs='+', default=(0,),
                             help="Min length cutoff (or multiple cutoffs) for the stats.")
     argparser.add_argument("-H", "--histogram",
@@ -161,6 +307,15 @@ def parse_args(*args):
                             help="Suppress listing out the _headings.")
     argparser.add_argument("-t", "--trim_n", action="store_true",
                             help="Trim off N's from the start and end of reads.")
+    argparser.add_argument("-j", "--jobs", type=int, default=1,
+                            help="Number of threads to use for decompression when reading BAM.")
+    argparser.add_argument("-N", "--npz",
+                            help="Save the full histogram to the specified file in NPZ format," +
+                                 " to be combined later with --merge.")
+    argparser.add_argument("-m", "--merge", nargs='+',
+                            help="Sum up the histograms in these NPZ files, rather than" +
+                                 " reading any FASTA. Eg. for a BAM file that has been split" +
+                                 " into shards by ZMW.")
 
     return argparser.parse_args(*args)
 
@@ -2,8 +2,13 @@
 
 import os, sys, re
 import gzip
-import collections
+import logging as L
+from itertools import chain, repeat
+from concurrent.futures import ProcessPoolExecutor
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import numpy as np
+
+from smrtino import bgzf
 
 """ This tool counts up the reads and bases in a FASTQ file.
     The idea is that for each .fastq.gz, as well as the .md5 file we also
@@ -19,6 +24,14 @@ from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
     This version of the scrip does not attempt to look for an index sequence.
 """
 
+# Read the FASTQ in chunks of this size. Bigger is not better here - the buffers
+# want to stay in the CPU cache.
+BLOCKSIZE = 256 * 1024
+
+# If the lines average longer than this, finding the line ends with bytes.find()
+# (which uses memchr) beats NumPy.
+LONG_LINE = 1000
+
 def parse_args():
 
     description = "Output base counts on a FASTQ file."
@@ -30,6 +43,12 @@ def parse_args():
                         help="actually read from stdin, but using the given filename")
     parser.add_argument("-c", "--cstats",
                         help="actually get the numbers from cstats.yaml, but using the given filename")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes to use if the input is BGZF")
+    parser.add_argument("-q", "--quality", action="store_true",
+                        help="also scan the quality lines and count Q20/Q30/Q40 bases")
+    parser.add_argument("-Q", "--qv_histogram",
+                        help="save a histogram of the mean QV per read to this file. Implies -q")
 
     parser.add_argument("infile", nargs=1,
                         help=".fastq.gz file to be read")
@@ -39,14 +58,22 @@ def parse_args():
 def main(args):
 
     fn, = args.infile
+    quals = bool(args.quality or args.qv_histogram)
 
     if args.cstats:
         # Short-circuit the file reading. Needs newer cstats with the extra infos
-        print_info(load_cstats(args.cstats), fn=os.path.basename(fn))
+        fq_info = load_cstats(args.cstats)
     elif args.stdin:
-        print_info(scan_fh(sys.stdin.buffer), fn=os.path.basename(fn))
+        fq_info = scan_fh(sys.stdin.buffer, quals=quals)
     else:
-        print_info(scan_fq(fn), fn=os.path.basename(fn))
+        fq_info = scan_fq(fn, jobs=args.jobs or 1, quals=quals)
+
+    print_info(fq_info, fn=os.path.basename(fn))
+
+    if args.qv_histogram:
+        with open(args.qv_histogram, 'w') as hfh:
+            for qv, count in enumerate(fq_info.get('read_qv_histo', [])):
+                print('{}\t{}'.format(qv, count), file=hfh)
 
 def load_cstats(filename):
     import yaml
@@ -54,34 +81,208 @@ def load_cstats(filename):
     with open(filename) as yfh:
         ydata = yaml.safe_load(yfh)
 
+    return cstats_to_info(ydata)
+
+def cstats_to_info(ydata):
+    """ Convert the stats from fasta_stats.py into the dict that print_info() wants
+    """
     return dict( total_reads = ydata['Reads'],
                  min_read_len = ydata['Min read length'] if ydata['Reads'] else 0,
                  max_read_len = ydata['Max read length'] if ydata['Reads'] else 0,
                  total_bases = ydata['Total bases'],
                  non_n_bases = ydata['non-N bases'] if ydata['Reads'] else 0, )
 
-def scan_fh(filehandle):
+def scan_fh(filehandle, blocksize=BLOCKSIZE, quals=False):
     """ Read an open file handle. The data must be uncompressed.
+
+        The file is read in large blocks and each block is scanned in bulk. Any
+        partial line at the end of a block is carried over to the next one.
     """
-    lens_found = collections.Counter()
-    ns_found = 0
-    n = 0
+    def _blocks():
+        while True:
+            block = filehandle.read(blocksize)
+            if not block:
+                break
+            yield block
+
+    tally = new_tally(quals)
+    leftover = scan_blocks(_blocks(), tally)
 
-    for n, l in enumerate(filehandle):
-        if n % 4 == 1:
-            # Sequence line
-            lens_found[len(l) - 1] += 1
-            ns_found += l.count(b'N')
+    return tally_to_info(tally, leftover)
+
+def new_tally(quals=False):
+    """ Running totals for scan_blocks(). All the histograms are arrays that
+        grow as needed.
+    """
+    tally = dict( lens = np.zeros(0, dtype=np.int64),
+                  n_bases = 0,
+                  lines = 0,
+                  long_lines = True,
+                  quals = quals )
+    if quals:
+        # Count of bases for each quality byte, and of reads by mean QV
+        tally['qual_bytes'] = np.zeros(0, dtype=np.int64)
+        tally['read_qvs'] = np.zeros(0, dtype=np.int64)
+
+    return tally
+
+def add_tally(tally, part_tally):
+    """ Add the counts in part_tally to tally
+    """
+    for k in ['lens', 'qual_bytes', 'read_qvs']:
+        if k in tally:
+            tally[k] = add_histo(tally[k], part_tally[k])
+    tally['n_bases'] += part_tally['n_bases']
+    tally['lines'] += part_tally['lines']
+
+def scan_blocks(blocks, tally):
+    """ Scan a series of blocks of FASTQ data, adding to tally.
+        Returns the partial line at the end, if any.
+    """
+    leftover = b''
+    for block in blocks:
+        chunk = leftover + block
+
+        # Only scan up to the last newline
+        last_eol = chunk.rfind(b'\n')
+        if last_eol == -1:
+            leftover = chunk
+            continue
+        leftover = chunk[last_eol+1:]
+
+        lines_before = tally['lines']
+        scan_lines(chunk[:last_eol+1], tally)
+
+        # Pick the best way to find the line ends for the next block
+        tally['long_lines'] = (last_eol > LONG_LINE * (tally['lines'] - lines_before))
+
+    return leftover
+
+def scan_lines(chunk, tally):
+    """ Scan a chunk of complete lines and add the results to tally.
+    """
+    add_tally(tally, scan_block( chunk,
+                                 tally['lines'],
+                                 tally['long_lines'],
+                                 tally['quals'] ))
+
+def tally_to_info(tally, leftover=b''):
+    """ Turn the tally into the dict that print_info() wants
+    """
+    if leftover:
+        # Final line with no newline at the end of the file
+        scan_lines(leftover + b'\n', tally)
+
+    lens_found = tally['lens']
+    lens_seen, = np.nonzero(lens_found)
+
+    res = dict( total_reads = tally['lines'] // 4,
+                min_read_len = int(lens_seen[0]) if len(lens_seen) else 0,
+                max_read_len = int(lens_seen[-1]) if len(lens_seen) else 0,
+                total_bases = int(np.dot(np.arange(len(lens_found)), lens_found)),
+                n_bases = tally['n_bases'] )
+
+    if tally['quals']:
+        # Quality bytes are Phred+33
+        qual_bytes = tally['qual_bytes']
+        for q in [20, 30, 40]:
+            res[f'q{q}_bases'] = int(qual_bytes[33+q:].sum())
+        res['read_qv_histo'] = tally['read_qvs'].tolist()
+
+    return res
+
+def find_eols(chunk, long_lines=True):
+    """ Get the positions of all the newlines in chunk, as an array.
+    """
+    if long_lines:
+        eols = []
+        find = chunk.find
+        pos = find(b'\n')
+        while pos != -1:
+            eols.append(pos)
+            pos = find(b'\n', pos + 1)
+        return np.array(eols, dtype=np.int64)
+    else:
+        buf = np.frombuffer(chunk, dtype=np.uint8)
+        eols, = np.nonzero(buf == ord('\n'))
+        return eols
 
-    return dict( total_reads = (n + 1) // 4,
-                 min_read_len = min(lens_found.keys() or [0]),
-                 max_read_len = max(lens_found.keys() or [0]),
-                 total_bases = sum([ l * c for l, c in lens_found.items()]),
-                 n_bases = ns_found )
+def scan_block(chunk, first_line, long_lines=True, quals=False):
+    """ Scan a chunk of complete lines. first_line is the number of lines already
+        seen, so we know which lines in the chunk are sequence lines.
 
-def scan_fq(filename):
+        Returns a tally of sequence lengths, count of N's in the sequences,
+        number of lines in the chunk, and optionally the quality counts.
+    """
+    eols = find_eols(chunk, long_lines)
+
+    # Sequence lines are those where the overall line number % 4 == 1
+    seq_starts, seq_ends = line_bounds(eols, (1 - first_line) % 4)
+
+    res = dict( lens = np.bincount(seq_ends - seq_starts),
+                n_bases = 0,
+                lines = len(eols) )
+
+    # Most reads have no N's at all, and find() is much faster than count()
+    find, count = chunk.find, chunk.count
+    for s, e in zip(seq_starts.tolist(), seq_ends.tolist()):
+        if find(b'N', s, e) != -1:
+            res['n_bases'] += count(b'N', s, e)
+
+    if quals:
+        res.update(scan_quals(chunk, *line_bounds(eols, (3 - first_line) % 4)))
+
+    return res
+
+def line_bounds(eols, first):
+    """ Get the start and end positions of every fourth line, starting from
+        line number first.
+    """
+    lines = np.arange(first, len(eols), 4)
+    ends = eols[lines]
+    starts = np.where(lines > 0, eols[lines - 1] + 1, 0)
+
+    return starts, ends
+
+def scan_quals(chunk, qual_starts, qual_ends):
+    """ Count the quality values in the quality lines, and the mean QV per read.
+        All done in NumPy.
+    """
+    buf = np.frombuffer(chunk, dtype=np.uint8)
+
+    # Mark the start and end of each quality line, then a cumulative sum gives a
+    # mask of all the quality bytes.
+    in_qual = np.zeros(len(buf) + 1, dtype=np.int8)
+    in_qual[qual_starts] += 1
+    in_qual[qual_ends] -= 1
+    in_qual = np.cumsum(in_qual[:-1], dtype=np.int8).view(np.bool_)
+
+    # The sum for each line is the difference in the cumulative sum of the buffer.
+    # Zero-length reads have no mean QV, so leave them out.
+    qual_lens = qual_ends - qual_starts
+    buf_cumsum = np.concatenate(([0], np.cumsum(buf, dtype=np.int64)))
+    qual_sums = buf_cumsum[qual_ends] - buf_cumsum[qual_starts] - (33 * qual_lens)
+    has_qual = qual_lens > 0
+
+    return dict( qual_bytes = np.bincount(buf[in_qual]),
+                 read_qvs = np.bincount(qual_sums[has_qual] // qual_lens[has_qual]) )
+
+def add_histo(h1, h2):
+    """ Sum two histogram arrays which may be different lengths.
+    """
+    if len(h2) > len(h1):
+        h1, h2 = h2, h1
+    h1 = h1.copy()
+    h1[:len(h2)] += h2
+
+    return h1
+
+def scan_fq(filename, jobs=1, quals=False):
     """ Read a file. The file must actually be a gzipped file, unless it's completely empty,
         which is useful for testing.
+
+        If the file is BGZF (as made by bgzip) and jobs > 1 then the file will be split
+        between several processes.
     """
     if os.stat(filename).st_size == 0:
         return dict( total_reads = 0,
@@ -89,15 +290,103 @@ def scan_fq(filename):
                      max_read_len = 0,
                      n_bases = 0       )
 
+    if jobs > 1:
+        if bgzf.is_bgzf(filename):
+            return scan_bgzf(filename, jobs, quals)
+        L.warning(f"{filename} is not BGZF so it will be read in a single process")
+
     try:
         with gzip.open(filename, mode='rb') as fh:
-            return scan_fh(fh)
+            return scan_fh(fh, quals=quals)
     except OSError as e:
         #The GZip module doesn't tell you what file it was trying to read
         e.filename = filename
         e.strerror = e.args[0]
         raise
 
+def scan_bgzf(filename, jobs, quals=False):
+    """ Scan a BGZF file on a process pool. Each worker scans a range of blocks and
+        reports back the bits at either end that it could not account for, which
+        are stitched together here.
+    """
+    # Several parts per worker evens out the load
+    ranges = bgzf.split_file(filename, jobs * 4)
+
+    tally = new_tally(quals)
+    carry = b''
+    with ProcessPoolExecutor(jobs) as executor:
+        for head, part_tally, tail in executor.map( scan_bgzf_range,
+                                                    repeat(filename),
+                                                    *zip(*ranges),
+                                                    repeat(quals) ):
+            carry += head
+            if part_tally is None:
+                # No complete record in this part
+                continue
+
+            # The carry is now complete lines, up to the start of a record
+            scan_lines(carry, tally)
+            if tally['lines'] % 4:
+                raise RuntimeError(f"FASTQ records in {filename} are out of step")
+
+            add_tally(tally, part_tally)
+            carry = tail
+
+    # Anything left must be a final line with no newline
+    last_eol = carry.rfind(b'\n')
+    scan_lines(carry[:last_eol+1], tally)
+
+    return tally_to_info(tally, carry[last_eol+1:])
+
+def scan_bgzf_range(filename, start, end, quals=False):
+    """ Worker for scan_bgzf(). Scan the blocks that start between start and end.
+        The range will likely start and end part way through a record, so resync
+        at the first complete record.
+
+        Returns (data before the first record, tally, partial line at the end)
+        or (all the data, None, b'') if no record start was found.
+    """
+    with open(filename, 'rb') as fh:
+        blocks = bgzf.iter_blocks(fh, start, end)
+
+        head = b''
+        for block in blocks:
+            head += block
+            rec_start = find_record_start(head)
+            if rec_start is not None:
+                break
+        else:
+            return head, None, b''
+
+        tally = new_tally(quals)
+        tail = scan_blocks(chain([head[rec_start:]], blocks), tally)
+
+    return head[:rec_start], tally, tail
+
+def find_record_start(chunk):
+    """ Find the first FASTQ record that starts after a newline in chunk. A line
+        starting with '@' could be a quality line, but it can only be a header if
+        the line two after starts with '+' and the sequence and quality lines are
+        the same length. Returns None if no complete record is seen.
+    """
+    pos = chunk.find(b'\n@')
+    while pos != -1:
+        # Find the ends of the next four lines
+        eols = [pos]
+        for _ in range(4):
+            eols.append(chunk.find(b'\n', eols[-1] + 1))
+            if eols[-1] == -1:
+                # Need more data
+                return None
+
+        seq_len = eols[2] - eols[1]
+        qual_len = eols[4] - eols[3]
+        if chunk.startswith(b'+', eols[2] + 1) and seq_len == qual_len:
+            return pos + 1
+        pos = chunk.find(b'\n@', pos + 1)
+
+    return None
+
 def print_info(fq_info, fn='input.fastq.gz'):
     """ Show what we got.
     """
@@ -123,8 +412,14 @@ def print_info(fq_info, fn='input.fastq.gz'):
     elif 'n_bases' in fq_info:
         print( "non_n_bases: {}".format(total_bases - fq_info['n_bases']) )
 
+    if 'q20_bases' in fq_info:
+        print( "q20_bases:   {}".format(fq_info['q20_bases']) )
+
     if 'q30_bases' in fq_info:
         print( "q30_bases:   {}".format(fq_info['q30_bases']) )
 
+    if 'q40_bases' in fq_info:
+        print( "q40_bases:   {}".format(fq_info['q40_bases']) )
+
 if __name__ == '__main__':
     main(parse_args())
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""The scanning loop of driver.sh, in Python, with a pool of workers so that several
+   runs can be dealt with at once.
+
+   When driver.sh starts any real work on a run it stops looking at other runs, so two
+   runs that need attention at the same time are dealt with one after the other, on
+   successive CRON cycles. This script finds all the runs and gets their status just as
+   driver.sh does, then calls "driver.sh <run>" for every run that needs work, up to
+   --jobs at a time. Runs that need no work, aside from logging, are passed to a single
+   call to driver.sh. So all the actions, touch files and log messages are just as before.
+   Finished runs (complete, aborted or testrun) are skipped.
+
+   Several cells of a run may also be processed at once, as driver.sh claims cells while
+   holding a lock on the pbpipeline directory, so a cell that becomes ready while others
+   are still processing will be picked up on the next cycle.
+
+   This can be called from the CRON in place of driver.sh, or by pb_watcher.py --driver.
+"""
+import os, sys, re
+import json
+from subprocess import run, DEVNULL
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import logging as L
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from pb_run_status import StatusIndex, get_json_lines, open_index
+from pb_watcher import load_environ, find_runs, BIN_DIR
+
+# These are the states where driver.sh sets BREAK=1, as it starts some actual work.
+BUSY_STATES = ['new', 'cell_ready', 'processed', 'stalled']
+
+def main(args):
+
+    L.basicConfig( level = L.DEBUG if args.verbose else L.WARNING,
+                   format = "{levelname}:{message}",
+                   style = '{' )
+
+    env = load_environ(args.environ_sh)
+    for v in ['FROM_LOCATION', 'TO_LOCATION']:
+        if not os.path.isdir(env[v] or ''):
+            exit(f"{v} is not set to a directory.")
+
+    # RunStatus needs this
+    os.environ['TO_LOCATION'] = env['TO_LOCATION']
+
+    runs = find_runs(env['FROM_LOCATION'], env['RUN_NAME_REGEX'])
+
+    index = open_index(env['STATUS_INDEX'])
+    try:
+        statuses = get_statuses(env['FROM_LOCATION'], runs, index=index)
+    finally:
+        if index: index.close()
+
+    jobs = plan_jobs(statuses)
+    failures = run_jobs(args.driver, jobs, max_workers=args.jobs)
+    if failures:
+        exit(f"{failures} of {len(jobs)} calls to {args.driver} failed.")
+
+def get_statuses(from_location, runs, index=None):
+    """ Get a list of (run, status) for all the runs.
+    """
+    run_dirs = [ os.path.join(from_location, r) for r in runs ]
+    return [ (r, json.loads(jline)['PipelineStatus'])
+             for r, jline in zip(runs, get_json_lines(run_dirs, index=index)) ]
+
+def plan_jobs(statuses):
+    """ Decide how to call the driver. Each job is a list of runs for one call.
+        Every busy run gets a call of its own, and all the rest that are not finished
+        share one call, which comes last.
+    """
+    busy = [ [r] for r, s in statuses if s in BUSY_STATES ]
+    quiet = [ r for r, s in statuses if s not in BUSY_STATES
+                                    and s not in StatusIndex.TERMINAL_STATES ]
+
+    return busy + ([quiet] if quiet else [])
+
+def run_driver(driver, runs):
+    """ Call the driver on the runs and wait for it. Returns the exit status.
+    """
+    L.info(f"Calling {driver} on {' '.join(runs)}")
+    cp = run([driver, *runs], stdin=DEVNULL)
+
+    if cp.returncode:
+        L.error(f"{driver} failed on {' '.join(runs)} with status {cp.returncode}")
+    return cp.returncode
+
+def run_jobs(driver, jobs, max_workers=1):
+    """ Run all the jobs, with up to max_workers at a time. Returns the number that
+        failed.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(partial(run_driver, driver), jobs))
+
+    return len([ r for r in results if r ])
+
+def parse_args(*args):
+    description = """Find all the runs and call driver.sh on every run that needs attention,
+                     several at a time.
+                  """
+
+    parser = ArgumentParser( description = description,
+                             formatter_class = ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--environ_sh", default=os.environ.get('ENVIRON_SH', f"{BIN_DIR}/environ.sh"),
+                        help="Settings file to read FROM_LOCATION, TO_LOCATION and RUN_NAME_REGEX,"
+                             " which must be the same one that driver.sh reads.")
+
+    parser.add_argument("--driver", default=f"{BIN_DIR}/driver.sh",
+                        help="The driver to call on each run.")
+
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="Number of runs to work on at once.")
+
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Print more logging to stderr")
+
+    return parser.parse_args(*args)
+
+if __name__=="__main__":
+    main(parse_args())
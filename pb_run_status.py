@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
-import os.path
+import os, re
 from glob import glob
+from fnmatch import fnmatchcase
 import sys
 import logging as L
 import datetime
+import json
+import sqlite3
 
 class RunStatus:
     """This Class provides information about a PacBio sequel run, given a run folder.
@@ -74,6 +77,7 @@ class RunStatus:
 
     def _clear_cache( self ):
         self._exists_cache = dict()
+        self._listdir_cache = dict()
         self._cells_cache = None
 
     def _exists_from( self, glob_pattern ):
@@ -88,16 +92,41 @@ class RunStatus:
 
     def _exists( self, glob_pattern, root_path ):
         """ Returns if a file exists in root_path and caches the result.
-            The check will be done with glob() so wildcards can be used, and
-            the result will be the number of matches.
+            The check will be done as for glob() so wildcards can be used, and
+            the result will be the number of matches. Rather than calling glob()
+            for each pattern, each directory is listed just once and the
+            wildcards matched against the listing.
         """
         full_pattern = os.path.join(root_path, glob_pattern)
         if full_pattern not in self._exists_cache:
-            self._exists_cache[full_pattern] = glob(full_pattern)
+            dir_name, file_pattern = os.path.split(full_pattern)
+
+            if re.search(r'[*?[]', dir_name):
+                # Wildcards in the directory part are not needed, but fall back to glob()
+                self._exists_cache[full_pattern] = glob(full_pattern)
+            else:
+                # As with glob(), wildcards do not match hidden files
+                self._exists_cache[full_pattern] = [
+                        os.path.join(dir_name, f) for f in self._listdir(dir_name)
+                        if fnmatchcase(f, file_pattern)
+                        and ( file_pattern.startswith('.') or not f.startswith('.') ) ]
             L.debug(f"_exists {full_pattern} => {self._exists_cache[full_pattern]}")
 
         return len( self._exists_cache[full_pattern] )
 
+    def _listdir( self, dir_name ):
+        """ Returns a dict of { name: is_dir } for the directory and caches the result.
+            A missing directory is treated as empty.
+        """
+        if dir_name not in self._listdir_cache:
+            try:
+                with os.scandir(dir_name) as entries:
+                    self._listdir_cache[dir_name] = { e.name: e.is_dir() for e in entries }
+            except (FileNotFoundError, NotADirectoryError):
+                self._listdir_cache[dir_name] = dict()
+
+        return self._listdir_cache[dir_name]
+
     def get_cells( self ):
         """ Returns a dict of { cellname: status } where status is one of the constants
             defined above
@@ -109,11 +138,10 @@ class RunStatus:
 
         # OK, we need to work it out...
         res = dict()
-        cells = glob( os.path.join(self.from_path, '[0-9]_???/') )
-
-        for cell in cells:
-            cellname = cell.rstrip('/').split('/')[-1]
+        cells = [ f for f, is_dir in self._listdir(self.from_path).items()
+                  if is_dir and fnmatchcase(f, '[0-9]_???') ]
 
+        for cellname in cells:
             if self._exists_to( f"pbpipeline/{cellname}.aborted" ):
                 res[cellname] = self.CELL_ABORTED
             elif self._exists_to( f"pbpipeline/{cellname}.failed" ):
@@ -319,17 +347,20 @@ class RunStatus:
         except Exception:
             return 'unknown'
 
-    def get_yaml(self, debug=True):
+    def get_record(self, debug=True):
+        """ Get all the info as a dict. The values are all strings, formatted just as
+            they appear in the YAML.
+        """
         try:
-            return '\n'.join([ 'RunID: '           + self.get_run_id(),
-                               'Instrument: '      + self.get_instrument(),
-                               'Cells: '           + ' '.join(sorted(self.get_cells())),
-                               'CellsReady: '      + ' '.join(sorted(self.get_cells_ready())),
-                               'CellsProcessing: ' + ' '.join(sorted(self.get_cells_processing())),
-                               'CellsDone: '       + ' '.join(sorted(self.get_cells_done())),
-                               'CellsAborted: '    + ' '.join(sorted(self.get_cells_aborted())),
-                               'StartTime: '       + self.get_start_time(),
-                               'PipelineStatus: '  + self.get_status() ])
+            return dict( RunID           = self.get_run_id(),
+                         Instrument      = self.get_instrument(),
+                         Cells           = ' '.join(sorted(self.get_cells())),
+                         CellsReady      = ' '.join(sorted(self.get_cells_ready())),
+                         CellsProcessing = ' '.join(sorted(self.get_cells_processing())),
+                         CellsDone       = ' '.join(sorted(self.get_cells_done())),
+                         CellsAborted    = ' '.join(sorted(self.get_cells_aborted())),
+                         StartTime       = self.get_start_time(),
+                         PipelineStatus  = self.get_status() )
 
         except Exception:
             # if we can't read something just produce a blank reply, unless -d flag
@@ -337,20 +368,145 @@ class RunStatus:
             if debug: raise
             pstatus = 'aborted' if self._was_aborted() else 'unknown'
 
-            return '\n'.join([ 'RunID: unknown',
-                               'Instrument: unknown',
-                               'Cells: ',
-                               'CellsReady: ',
-                               'CellsProcessing: ',
-                               'CellsDone: ',
-                               'CellsAborted: ',
-                               'StartTime: unknown',
-                               'PipelineStatus: ' + pstatus ])
+            return unknown_record(pstatus)
+
+    def get_yaml(self, debug=True):
+        return '\n'.join( f"{k}: {v}" for k, v in self.get_record(debug=debug).items() )
+
+def unknown_record(pstatus='unknown'):
+    """ The record we report when the run cannot be examined.
+    """
+    return dict( RunID           = 'unknown',
+                 Instrument      = 'unknown',
+                 Cells           = '',
+                 CellsReady      = '',
+                 CellsProcessing = '',
+                 CellsDone       = '',
+                 CellsAborted    = '',
+                 StartTime       = 'unknown',
+                 PipelineStatus  = pstatus )
+
+class StatusIndex:
+    """ A persistent record of the status of runs which have reached a terminal state,
+        so they need not be examined afresh on every cycle of the driver.
+        An entry is only trusted while the mtimes of all the directories that
+        get_status() looks into are unchanged. That's the run directory, the pbpipeline
+        directory, and every cell directory and its metadata directory. Adding or
+        removing a touch file, a cell or a .transferdone file changes one of these.
+    """
+    TERMINAL_STATES = ['complete', 'aborted', 'testrun']
+
+    # Directories modified within the last MIN_AGE seconds may yet change again with
+    # no change in mtime, so we don't index these yet.
+    MIN_AGE = 2
+
+    # Bump this if the layout of the table changes. Any older table is discarded.
+    SCHEMA_VERSION = 2
+
+    def __init__( self, db_file ):
+        self.db = sqlite3.connect(db_file, timeout=60)
+        with self.db:
+            if self.db.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+                self.db.execute( "DROP TABLE IF EXISTS runs" )
+                self.db.execute( f"PRAGMA user_version = {self.SCHEMA_VERSION}" )
+            self.db.execute( "CREATE TABLE IF NOT EXISTS runs ("
+                             " to_path TEXT PRIMARY KEY,"
+                             " mtimes TEXT,"
+                             " record TEXT )" )
+
+    def close( self ):
+        self.db.close()
+
+    def get_mtimes( self, run_info ):
+        """ Get the mtimes that validate an entry, as a list of [dir, mtime] where dir
+            is relative to the run and mtime is None for a missing directory. Returns
+            None if the run has no pbpipeline directory yet.
+        """
+        try:
+            res = [ [ 'pbpipeline',
+                      os.stat(os.path.join(run_info.to_path, 'pbpipeline')).st_mtime_ns ],
+                    [ '.', os.stat(run_info.from_path).st_mtime_ns ] ]
+        except FileNotFoundError:
+            return None
+
+        # This listing is cached, and get_cells() will see the same cells.
+        cells = sorted( f for f, is_dir in run_info._listdir(run_info.from_path).items()
+                        if is_dir and fnmatchcase(f, '[0-9]_???') )
+        for d in [ d for c in cells for d in [c, os.path.join(c, 'metadata')] ]:
+            try:
+                res.append([ d, os.stat(os.path.join(run_info.from_path, d)).st_mtime_ns ])
+            except FileNotFoundError:
+                res.append([ d, None ])
+
+        return res
+
+    def lookup( self, run_info, mtimes ):
+        """ Get the saved record for this run, if it is still valid.
+        """
+        if not mtimes:
+            return None
+        row = self.db.execute( "SELECT mtimes, record FROM runs WHERE to_path = ?",
+                               (run_info.to_path,) ).fetchone()
+        if row and json.loads(row[0]) == mtimes:
+            L.debug(f"Using indexed status for {run_info.to_path}")
+            return json.loads(row[1])
+        return None
+
+    def store( self, run_info, mtimes, record ):
+        """ Save the record for this run, if it is in a terminal state. The mtimes
+            must have been obtained before the record.
+        """
+        min_mtime = ( datetime.datetime.now().timestamp() - self.MIN_AGE ) * 1e9
+        with self.db:
+            if ( mtimes and all(m < min_mtime for d, m in mtimes if m is not None)
+                        and record['PipelineStatus'] in self.TERMINAL_STATES ):
+                self.db.execute( "INSERT OR REPLACE INTO runs VALUES (?, ?, ?)",
+                                 (run_info.to_path, json.dumps(mtimes), json.dumps(record)) )
+            else:
+                self.db.execute( "DELETE FROM runs WHERE to_path = ?", (run_info.to_path,) )
+
+def open_index(db_file):
+    """ Open the StatusIndex, or return None if there is no db_file or it cannot be
+        opened. Running without the index is slower but otherwise no different.
+    """
+    if not db_file:
+        return None
+    try:
+        return StatusIndex(db_file)
+    except sqlite3.Error as e:
+        L.warning(f"Cannot use status index {db_file}: {e}")
+        return None
+
+def get_json_lines(runs, opts='', index=None):
+    """ Yield a line of JSON for each run. A problem with one run will not stop the
+        others being reported, unless -d flag is in effect.
+        If a StatusIndex is supplied, runs in a terminal state are looked up there.
+    """
+    for run in runs:
+        try:
+            run_info = RunStatus(run, opts,
+                                 to_location = os.environ.get('TO_LOCATION'),
+                                 stall_time  = os.environ.get('STALL_TIME') or None)
+            record = None
+            if index:
+                mtimes = index.get_mtimes(run_info)
+                record = index.lookup(run_info, mtimes)
+            if not record:
+                record = run_info.get_record( debug=('d' in opts) )
+                if index:
+                    index.store(run_info, mtimes, record)
+        except Exception:
+            if 'd' in opts: raise
+            L.exception(f"Failed to get the status of {run}")
+            record = unknown_record()
+
+        yield json.dumps(dict(RunDir=run, **record))
 
 try:
     if __name__ == '__main__':
         # Very cursory option parsing
         # -v = verbose; -d = debug ; -q = quick mode ; -i = ignore report.started
+        # -j = print one line of JSON per run
         optind = 1 ; opts = ''
         if sys.argv[optind:] and sys.argv[optind].startswith('-'):
             opts += sys.argv[optind][1:]
@@ -361,11 +517,21 @@ try:
 
         #If no run specified, examine the CWD.
         runs = sys.argv[optind:] or ['.']
-        for run in runs:
-            run_info = RunStatus(run, opts,
-                                 to_location = os.environ.get('TO_LOCATION'),
-                                 stall_time  = os.environ.get('STALL_TIME') or None)
-            print ( run_info.get_yaml( debug=('d' in opts) ) )
+        if 'j' in opts:
+            # Batch mode, with one line of JSON per run, and using the STATUS_INDEX
+            # file if set.
+            index = open_index(os.environ.get('STATUS_INDEX'))
+            try:
+                for jline in get_json_lines(runs, opts, index):
+                    print(jline, flush=True)
+            finally:
+                if index: index.close()
+        else:
+            for run in runs:
+                run_info = RunStatus(run, opts,
+                                     to_location = os.environ.get('TO_LOCATION'),
+                                     stall_time  = os.environ.get('STALL_TIME') or None)
+                print ( run_info.get_yaml( debug=('d' in opts) ) )
 except BrokenPipeError:
     # We're not fussed
     pass
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+"""A long-running alternative to calling driver.sh from the CRON every 5 minutes.
+
+   This watches FROM_LOCATION and, for every run that is not yet finished, the run
+   directory, the cell directories and their metadata directories, and the pbpipeline
+   directory in TO_LOCATION. As soon as a file appears or disappears in any of these
+   (such as a .transferdone file) it calls driver.sh, which takes exactly the same
+   actions as it would when called by the CRON. And if nothing happens, driver.sh is
+   still called every --max_interval seconds.
+
+   Changes are seen immediately by inotify where the filesystem supports it, but inotify
+   does not see changes made by other hosts on NFS or Lustre, so the directories are
+   also polled. Polling is frequent after a recent change and backs off when all is quiet.
+
+   It can be kept running by the CRON, with a line like:
+
+   */5 * * * * /path/to/pb_watcher.py --timeout 3600
+
+   Only one watcher will run at a time, so any extra copies simply exit. Since driver.sh
+   is unchanged, calling it from the CRON directly is also still fine.
+"""
+import os, sys, re
+import time
+import json
+import fcntl
+import select
+import ctypes, ctypes.util
+from subprocess import run, Popen, PIPE, DEVNULL
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import logging as L
+
+from pb_run_status import get_json_lines, open_index
+
+BIN_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# Flags for inotify_add_watch(), from <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO   = 0x00000080
+IN_CREATE     = 0x00000100
+IN_DELETE     = 0x00000200
+IN_ONLYDIR    = 0x01000000
+WATCH_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+def main(args):
+
+    L.basicConfig( level = L.DEBUG if args.verbose else L.WARNING,
+                   format = "{asctime} {levelname}:{message}",
+                   style = '{' )
+
+    env = load_environ(args.environ_sh)
+    for v in ['FROM_LOCATION', 'TO_LOCATION']:
+        if not os.path.isdir(env[v] or ''):
+            exit(f"{v} is not set to a directory.")
+
+    # RunStatus needs this
+    os.environ['TO_LOCATION'] = env['TO_LOCATION']
+
+    lock_fh = get_lock(args.lock or os.path.join(env['TO_LOCATION'], '.pb_watcher.lock'))
+    if not lock_fh:
+        L.debug("Another watcher is already running.")
+        return
+
+    inotify = None
+    if not args.no_inotify:
+        try:
+            inotify = Inotify()
+        except (OSError, AttributeError) as e:
+            # AttributeError means libc has no inotify functions at all
+            L.warning(f"Cannot use inotify, so will just poll: {e}")
+
+    index = open_index(env['STATUS_INDEX'])
+    try:
+        watch(env, args, inotify=inotify, index=index)
+    finally:
+        if index: index.close()
+        if inotify: inotify.close()
+        lock_fh.close()
+
+def load_environ(environ_sh):
+    """ Get the settings we need from environ.sh, just as driver.sh would see them.
+        RUN_NAME_REGEX may be a list and is returned as such.
+    """
+    script = r'''if [ -e "$1" ] ; then
+                   cd "$(dirname "$1")" && source "./$(basename "$1")" >/dev/null || exit 1
+                 fi
+                 RUN_NAME_REGEX="${RUN_NAME_REGEX:-r.*_[0-9]{8\}_.*}"
+                 STATUS_INDEX="${STATUS_INDEX-${TO_LOCATION:-}/.pb_run_status.sqlite}"
+                 printf '%s\0' "${FROM_LOCATION:-}" "${TO_LOCATION:-}" "$STATUS_INDEX" \
+                               "${RUN_NAME_REGEX[@]}"
+              '''
+    cp = run( ['bash', '-c', script, 'bash', environ_sh],
+              stdout = PIPE, universal_newlines = True, check = True )
+    vals = cp.stdout.split('\0')[:-1]
+
+    return dict( FROM_LOCATION  = vals[0],
+                 TO_LOCATION    = vals[1],
+                 STATUS_INDEX   = vals[2],
+                 RUN_NAME_REGEX = vals[3:] )
+
+def get_lock(lock_file):
+    """ Take an exclusive lock on lock_file and return the open handle, which must be
+        kept open to keep the lock. If someone else has the lock, return None.
+        If locking is not possible at all, the handle is returned anyway.
+    """
+    fh = open(lock_file, 'a')
+    try:
+        fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        fh.close()
+        return None
+    except OSError as e:
+        # eg. ENOLCK where the filesystem has no flock support. A second watcher
+        # would only mean extra calls to driver.sh, so carry on.
+        L.warning(f"Unable to lock {lock_file}, so carrying on without the lock: {e}")
+    return fh
+
+def find_runs(from_location, run_name_regex):
+    """ List the runs in from_location, just as driver.sh does. Any regex with a '/'
+        in it means we need to look into subdirectories, and the parts before each
+        '/' are used to decide which subdirectories.
+    """
+    prefix_regex = []
+    for rnregex in run_name_regex:
+        mo = re.fullmatch(r'(.+)/(.+)', rnregex)
+        while mo:
+            prefix_regex.append(mo.group(1))
+            mo = re.fullmatch(r'(.+)/(.+)', mo.group(1))
+
+    candidates = subdirs(from_location)
+    res = []
+    while candidates:
+        run_basename = candidates.pop(0)
+
+        if any( re.fullmatch(r, run_basename) for r in run_name_regex ):
+            res.append(run_basename)
+        elif any( re.fullmatch(r, run_basename) for r in prefix_regex ):
+            candidates[0:0] = subdirs(from_location, run_basename)
+        else:
+            L.debug(f"Ignoring {run_basename}")
+
+    return res
+
+def subdirs(base_dir, rel_dir=''):
+    """ Get the non-hidden subdirectories of base_dir/rel_dir, like the shell
+        glob rel_dir/*/ would.
+    """
+    try:
+        with os.scandir(os.path.join(base_dir, rel_dir)) as entries:
+            return sorted( os.path.join(rel_dir, e.name) for e in entries
+                           if e.is_dir() and not e.name.startswith('.') )
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+def get_watch_dirs(from_location, to_location, runs, index=None):
+    """ Work out the directories that need watching. That's from_location and to_location
+        and any subdirectories that hold runs, then for any run that is not a testrun
+        the run directory, the cell directories and their metadata directories, and the
+        pbpipeline directory. Complete and aborted runs are watched too, as a late cell
+        may still turn up.
+    """
+    res = {from_location, to_location}
+
+    for run_basename in runs:
+        parent = os.path.dirname(run_basename)
+        while parent:
+            res.add(os.path.join(from_location, parent))
+            parent = os.path.dirname(parent)
+
+    run_dirs = [ os.path.join(from_location, r) for r in runs ]
+    for run_dir, jline in zip(run_dirs, get_json_lines(run_dirs, index=index)):
+        record = json.loads(jline)
+        if record['PipelineStatus'] == 'testrun':
+            continue
+
+        res.add(run_dir)
+        for cell in record['Cells'].split():
+            res.add(os.path.join(run_dir, cell))
+            res.add(os.path.join(run_dir, cell, 'metadata'))
+        # This is the to_path of the RunStatus. Note the RunID may not match the
+        # directory name.
+        res.add(os.path.join(to_location, os.path.basename(run_dir), 'pbpipeline'))
+
+    return sorted(res)
+
+def get_mtimes(dirs):
+    """ Get the mtimes of all the directories. Missing directories are None.
+    """
+    res = dict()
+    for d in dirs:
+        try:
+            res[d] = os.stat(d).st_mtime_ns
+        except OSError:
+            res[d] = None
+    return res
+
+class Inotify:
+    """ Just enough of the Linux inotify API, via ctypes, to tell us when anything
+        changes in a set of directories. We don't need to know what the change was, as
+        driver.sh will work that out.
+    """
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self.watches = dict()
+
+    def set_watches(self, dirs):
+        """ Watch all the dirs, and stop watching anything else. Directories that do not
+            exist are skipped, but polling will see them appear.
+        """
+        for d in set(self.watches).difference(dirs):
+            self._rm_watch(self.fd, self.watches.pop(d))
+
+        # Adding a watch a second time is fine, and re-adds it if the directory was
+        # replaced.
+        for d in dirs:
+            wd = self._add_watch(self.fd, os.fsencode(d), WATCH_MASK)
+            if wd >= 0:
+                self.watches[d] = wd
+            else:
+                self.watches.pop(d, None)
+
+        # Removing watches makes events, which we don't want.
+        self.drain()
+
+    def wait(self, timeout):
+        """ Wait for up to timeout seconds. Returns True if anything happened.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            self.drain()
+        return bool(ready)
+
+    def drain(self):
+        try:
+            while os.read(self.fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+def watch(env, args, inotify=None, index=None):
+    """ The main loop. Calls the driver straight away, then whenever a change is seen,
+        but not more than once every args.min_interval seconds and not with more than
+        args.max_drivers in flight. Returns the number of times the driver was called.
+    """
+    start_time = time.monotonic()
+    interval = args.min_interval
+    last_start = None
+    drivers = []
+    pending = True
+    calls = 0
+
+    while True:
+        # Forget about drivers that finished
+        drivers = [ p for p in drivers if p.poll() is None ]
+
+        now = time.monotonic()
+        if args.timeout and now - start_time >= args.timeout:
+            break
+
+        if last_start is None or now - last_start >= args.max_interval:
+            pending = True
+
+        if ( pending and len(drivers) < args.max_drivers and
+             (last_start is None or now - last_start >= args.min_interval) ):
+
+            # Look at the directories before calling the driver, so we'll see anything
+            # that happens after. This will include changes made by the driver itself,
+            # which means one extra call to the driver, but that's safer than missing a change.
+            runs = find_runs(env['FROM_LOCATION'], env['RUN_NAME_REGEX'])
+            dirs = get_watch_dirs(env['FROM_LOCATION'], env['TO_LOCATION'], runs, index=index)
+            mtimes = get_mtimes(dirs)
+            if inotify:
+                inotify.set_watches(dirs)
+            L.debug(f"Watching {len(dirs)} directories for {len(runs)} runs.")
+
+            L.info(f"Calling {args.driver}")
+            drivers.append(Popen( [args.driver], stdin = DEVNULL, start_new_session = True ))
+            last_start = now
+            pending = False
+            calls += 1
+
+        # Wait until the next poll, but no longer than we need to.
+        deadlines = [ now + interval,
+                      last_start + args.max_interval ]
+        if pending:
+            deadlines.append(last_start + args.min_interval)
+        if args.timeout:
+            deadlines.append(start_time + args.timeout)
+        wait_time = max(0, min(deadlines) - now)
+
+        if inotify:
+            changed = inotify.wait(wait_time)
+        else:
+            time.sleep(wait_time)
+            changed = False
+
+        if not pending:
+            changed = changed or get_mtimes(mtimes) != mtimes
+            if changed:
+                L.info("Change detected.")
+                pending = True
+
+        if changed:
+            interval = args.min_interval
+        else:
+            interval = min(interval * 2, args.max_interval)
+
+    return calls
+
+def parse_args(*args):
+    description = """Watch for changes in the runs and call driver.sh as soon as anything
+                     happens, rather than waiting for the CRON.
+                  """
+
+    parser = ArgumentParser( description = description,
+                             formatter_class = ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--environ_sh", default=os.environ.get('ENVIRON_SH', f"{BIN_DIR}/environ.sh"),
+                        help="Settings file to read FROM_LOCATION, TO_LOCATION and RUN_NAME_REGEX,"
+                             " which must be the same one that driver.sh reads.")
+
+    parser.add_argument("--driver", default=f"{BIN_DIR}/driver.sh",
+                        help="The driver to call.")
+
+    parser.add_argument("--min_interval", type=float, default=30,
+                        help="Seconds between polls after a change, and the minimum time"
+                             " between calls to the driver.")
+
+    parser.add_argument("--max_interval", type=float, default=300,
+                        help="Seconds between polls when nothing is happening, and the longest"
+                             " we will go without calling the driver.")
+
+    parser.add_argument("--max_drivers", type=int, default=4,
+                        help="Maximum number of driver processes to have running at once.")
+
+    parser.add_argument("--timeout", type=float, default=0,
+                        help="Exit after this many seconds. 0 means run forever.")
+
+    parser.add_argument("--lock",
+                        help="Lock file, to ensure only one watcher runs. Defaults to"
+                             " .pb_watcher.lock in TO_LOCATION.")
+
+    parser.add_argument("--no_inotify", action="store_true",
+                        help="Just poll, even if inotify is available.")
+
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Print more logging to stderr")
+
+    return parser.parse_args(*args)
+
+if __name__=="__main__":
+    main(parse_args())
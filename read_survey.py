@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import os, sys
+import logging as L
+import hashlib
+import random
+from collections import deque
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import numpy as np
+
+from smrtino import dump_yaml, bam, bgzf
+from fasta_stats import fasta_to_histo, add_histo, histo_to_result, bam_fastalines
+from fq_base_counter import print_info, cstats_to_info
+
+""" For each barcode we used to read the same BAM file over and over:
+
+     fasta_stats.py for the .cstats.yaml
+     samtools fastq | bgzip for the .fastq.gz
+     samtools fasta | seqtk sample for each subsample size
+     md5sum for the .bam and the .fastq.gz
+
+    plus fq_base_counter.py for the .fastq.count, which at least could use the
+    cstats. This script reads the BAM once and makes all of these at the same time.
+    The outputs should be the same as from the individual tools, apart from the
+    random selection of the subsamples.
+"""
+
+# Same default as "seqtk sample"
+DEFAULT_SEED = 11
+
+def parse_args(*args):
+    description = """Read a BAM file once, and output the stats, FASTQ, counts, md5sums
+                     and random subsamples as requested.
+                  """
+    argparser = ArgumentParser( description=description,
+                                formatter_class = ArgumentDefaultsHelpFormatter )
+    argparser.add_argument("bamfile",
+                            help="BAM file to read.")
+    argparser.add_argument("--cstats",
+                            help="Save the stats, as from fasta_stats.py, to this file.")
+    argparser.add_argument("--fastq",
+                            help="Save the reads to this file as BGZF-compressed FASTQ.")
+    argparser.add_argument("--count",
+                            help="Save the counts, as from fq_base_counter.py, to this file.")
+    argparser.add_argument("--fastq_md5",
+                            help="Save the md5sum of the FASTQ file to this file. Needs --fastq.")
+    argparser.add_argument("--bam_md5",
+                            help="Save the md5sum of the BAM file to this file.")
+    argparser.add_argument("-S", "--subsample", nargs=2, action="append", default=[],
+                            metavar=("N", "FILE"),
+                            help="Save N randomly chosen reads to FILE, as FASTA." +
+                                 " May be given several times.")
+    argparser.add_argument("--seed", type=int, default=DEFAULT_SEED,
+                            help="Random seed for the subsampling.")
+    argparser.add_argument("-j", "--jobs", type=int, default=1,
+                            help="Number of threads to use for BGZF (de)compression.")
+    argparser.add_argument("-d", "--debug", action="store_true",
+                            help="Print more verbose debugging messages.")
+
+    return argparser.parse_args(*args)
+
+def main(args):
+
+    L.basicConfig(level=(L.DEBUG if args.debug else L.WARNING), stream=sys.stderr)
+
+    if args.fastq_md5 and not args.fastq:
+        exit("Saving --fastq_md5 requires --fastq")
+
+    subsample_files = { int(n): f for n, f in args.subsample }
+
+    fastq_fh = open(args.fastq, 'wb') if args.fastq else None
+    try:
+        survey = survey_bam( args.bamfile,
+                             fastq_fh = fastq_fh,
+                             subsample_sizes = subsample_files,
+                             threads = args.jobs or 1,
+                             seed = args.seed )
+    finally:
+        if fastq_fh:
+            fastq_fh.close()
+
+    cstats = histo_to_result(survey['histo'])
+    if args.cstats:
+        # fasta_stats.py prints the YAML and so has an extra newline
+        with open(args.cstats, 'w') as yfh:
+            print(dump_yaml(cstats), file=yfh)
+
+    if args.count:
+        fastq_name = os.path.basename(args.fastq or (args.bamfile[:-len('.bam')] + '.fastq.gz'))
+        with open(args.count, 'w') as cfh:
+            with redirect_stdout(cfh):
+                print_info(cstats_to_info(cstats), fn=fastq_name)
+
+    if args.fastq_md5:
+        save_md5(args.fastq_md5, survey['fastq_md5'], args.fastq)
+
+    if args.bam_md5:
+        save_md5(args.bam_md5, survey['bam_md5'], args.bamfile)
+
+    for n, sub in survey['subsamples'].items():
+        with open(subsample_files[n], 'wb') as sfh:
+            write_subsample(sub, sfh)
+
+def write_subsample(sub, fh):
+    """Write a list of (index, name, seq) as FASTA to a binary file handle
+    """
+    for _, name, seq in sub:
+        fh.write(b'>' + name + b'\n' + seq + b'\n')
+
+def save_md5(md5_file, md5_hex, filename):
+    """Save the md5sum in the same format as the md5sum command, with just the base
+       name of the file.
+    """
+    with open(md5_file, 'w') as mfh:
+        print("{}  {}".format(md5_hex, os.path.basename(filename)), file=mfh)
+
+class _HashingReader:
+    """Wraps a file handle so that everything read from it goes into a hash.
+    """
+    def __init__(self, fh, hasher):
+        self._fh = fh
+        self._hasher = hasher
+
+    def read(self, size=-1):
+        data = self._fh.read(size)
+        self._hasher.update(data)
+        return data
+
+def survey_bam(filename, fastq_fh=None, subsample_sizes=(), threads=1, seed=DEFAULT_SEED):
+    """Read the BAM file and do everything at once. The FASTQ is written to fastq_fh
+       if supplied. Returns a dict with the histogram as from fasta_stats.fasta_to_histo(),
+       the md5sums, and a dict of subsamples, each being a list of (index, name, seq)
+       in the order the reads were in the file.
+    """
+    bam_md5 = hashlib.md5()
+    fastq_md5 = hashlib.md5()
+
+    histo = fasta_to_histo([])
+    reservoirs = { n: [] for n in subsample_sizes }
+    rngs = { n: random.Random(seed) for n in subsample_sizes }
+    reads_seen = 0
+
+    def _write_fastq(zdata):
+        fastq_md5.update(zdata)
+        fastq_fh.write(zdata)
+
+    with open(filename, 'rb') as raw_fh, ThreadPoolExecutor(threads) as executor:
+        # Compressed FASTQ chunks in the order they need to be written
+        pending = deque()
+
+        for buf, records in bam.iter_record_chunks_fh( _HashingReader(raw_fh, bam_md5),
+                                                       threads,
+                                                       filename = filename ):
+            packed = np.frombuffer(buf, dtype=np.uint8)
+            histo = add_histo(histo, fasta_to_histo(bam_fastalines(packed, records)))
+
+            # All the sequences are needed for the FASTQ, but otherwise only decode the
+            # ones that go into the subsamples.
+            fastq_parts = []
+            for name_start, name_end, seq_start, seq_len, qual_start in zip(
+                                        *[ a.tolist() for a in ( records.name_starts,
+                                                                 records.name_ends,
+                                                                 records.seq_starts,
+                                                                 records.seq_lens,
+                                                                 records.qual_starts ) ] ):
+                name = buf[name_start:name_end]
+                seq = None
+                if fastq_fh:
+                    seq = bam.decode_seq(packed, seq_start, seq_len)
+                    fastq_parts.extend([ b'@', name, b'\n',
+                                         seq, b'\n+\n',
+                                         bam.decode_qual(buf, qual_start, seq_len), b'\n' ])
+
+                for n, reservoir in reservoirs.items():
+                    slot = reservoir_slot(reads_seen, n, rngs[n])
+                    if slot is None:
+                        continue
+                    if seq is None:
+                        seq = bam.decode_seq(packed, seq_start, seq_len)
+
+                    # Same munging of the names as we used to do with sed
+                    sub_read = (reads_seen, name.replace(b'/', b'_'), seq)
+                    if slot == len(reservoir):
+                        reservoir.append(sub_read)
+                    else:
+                        reservoir[slot] = sub_read
+
+                reads_seen += 1
+
+            # Compress in the background but keep the output in order
+            if fastq_fh:
+                pending.append(executor.submit(bgzf.deflate_data, b''.join(fastq_parts)))
+                while len(pending) > threads or (pending and pending[0].done()):
+                    _write_fastq(pending.popleft().result())
+
+        if fastq_fh:
+            while pending:
+                _write_fastq(pending.popleft().result())
+            _write_fastq(bgzf.EOF_BLOCK)
+
+    L.debug(f"Read {reads_seen} reads from {filename}")
+
+    return dict( histo = histo,
+                 bam_md5 = bam_md5.hexdigest(),
+                 fastq_md5 = fastq_md5.hexdigest() if fastq_fh else None,
+                 subsamples = { n: sorted(r) for n, r in reservoirs.items() } )
+
+def reservoir_slot(i, n, rng):
+    """Reservoir sampling (Algorithm R). Given that read i (counting from 0) is being
+       considered for a sample of size n, say which slot in the reservoir it should go
+       into, or None if it is not to be kept.
+    """
+    if i < n:
+        return i
+
+    slot = rng.randrange(i + 1)
+    return slot if slot < n else None
+
+if __name__ == "__main__":
+    main(parse_args())
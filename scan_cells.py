@@ -12,13 +12,18 @@
    formats.
 """
 import os, sys, re
+import time
+import yaml
+from tempfile import mkstemp
+from fnmatch import fnmatch
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import logging as L
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 from pprint import pprint, pformat
 
-from smrtino import ( glob, parse_run_name, dump_yaml )
+from smrtino import ( glob, parse_run_name, load_yaml, dump_yaml )
 
 def main(args):
 
@@ -49,9 +54,87 @@ def my_normpath(p):
 
     return p + '/'
 
+# Directory listings, keyed by absolute path. Each listing is a dict of
+# { name: is_dir } and is loaded with a single os.scandir() call, since on Lustre
+# every glob() or os.path.exists() is a round trip to the metadata server.
+_listings = dict()
+
+def reset_listings():
+    """Forget all the directory listings, so the next scan sees any new files.
+    """
+    _listings.clear()
+
+def dir_listing(d):
+    """Get the listing for directory d ('' means the CWD). A missing directory just
+       has no files.
+    """
+    key = os.path.abspath(d or '.')
+    if key not in _listings:
+        try:
+            with os.scandir(key) as it:
+                _listings[key] = { e.name: e.is_dir() for e in it }
+        except (FileNotFoundError, NotADirectoryError):
+            _listings[key] = {}
+
+    return _listings[key]
+
+def map_jobs(func, items, jobs=1):
+    """Like list(map(func, items)) but with up to 'jobs' threads. The results are
+       always in the order of the items. Network filesystems release the GIL while we
+       wait, so even on one core this helps.
+    """
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return [ func(i) for i in items ]
+
+    with ThreadPoolExecutor(min(jobs, len(items))) as executor:
+        return list(executor.map(func, items))
+
+def prefetch_listings(dirs, jobs=1):
+    """Load the listings for all these directories, using up to 'jobs' threads.
+    """
+    map_jobs(dir_listing, dirs, jobs)
+
+def path_exists(f):
+    """Equivalent to os.path.exists(f), but uses the directory listing.
+    """
+    d, name = os.path.split(f)
+    if name in ['', '.']:
+        return os.path.isdir(f or '.')
+
+    return name in dir_listing(d)
+
+glob_magic = re.compile(r'[*?[]')
+
+def path_glob(pattern):
+    """Equivalent to smrtino.glob(pattern), but uses the directory listings. Wildcards
+       may be in any part of the path.
+    """
+    d, pat = os.path.split(pattern)
+
+    if glob_magic.search(d):
+        dirs = [ m for m in path_glob(d) if dir_listing(os.path.dirname(m)).get(os.path.basename(m)) ]
+    else:
+        dirs = [d]
+
+    res = []
+    for adir in dirs:
+        listing = dir_listing(adir)
+        if glob_magic.search(pat):
+            # Like glob, '*' does not match hidden files
+            res.extend( os.path.join(adir, n) for n in listing
+                        if fnmatch(n, pat) and (pat.startswith('.') or not n.startswith('.')) )
+        elif pat in listing:
+            res.append(os.path.join(adir, pat))
+
+    return sorted(res)
+
 def scan_main(args):
     """Get scanning
     """
+    # Any previous listings may be out of date
+    reset_listings()
+
     run_name = os.path.basename(os.path.realpath(args.rundir))
     parsed_run_name = parse_run_name(run_name)
 
@@ -66,19 +149,23 @@ def scan_main(args):
     if parsed_run_name['platform'].startswith("Sequel"):
         sc = scan_cells_sequel( my_normpath(args.rundir),
                                 args.cells,
-                                extn_to_scan )
+                                extn_to_scan,
+                                jobs = args.jobs )
     else:
         sc = scan_cells_revio( my_normpath(args.rundir),
                                args.cells,
                                extn_to_scan,
-                               args.redemux and my_normpath(args.redemux) )
+                               args.redemux and my_normpath(args.redemux),
+                               cache_dir = args.cache,
+                               jobs = args.jobs )
 
     res['cells'].update(sc)
 
     return res
 
 
-def scan_cells_revio(rundir, cell_list, extn_to_scan=".transferdone", redemux=None):
+def scan_cells_revio( rundir, cell_list, extn_to_scan=".transferdone", redemux=None,
+                      cache_dir=None, jobs=1 ):
     """ Here's what we want to find, per cell.
         .transferdone - is under metadata
         {cell}.reads.bam - under hifi_reads and fail_reads
@@ -94,50 +181,41 @@ def scan_cells_revio(rundir, cell_list, extn_to_scan=".transferdone", redemux=No
             {cell}.consensusreadset.xml
             {cell}.lima_counts.txt (if it exists, and note the rename)
 
+        If cache_dir is set, the result for each slot is saved there and re-used
+        if none of the directories for the slot have changed.
+
+        If jobs > 1, the directories are listed and the slots scanned in parallel.
     """
     # Get a dict of slot: cell for all cells
+    prefetch_listings( [ f"{rundir}{d}/metadata" for d, is_dir in dir_listing(rundir).items()
+                                                 if is_dir ], jobs )
     all_cells = { b.split('/')[-3]: b.split('/')[-1][:-len(extn_to_scan)]
-                  for b in glob(f"{rundir}*/metadata/*{extn_to_scan}") }
+                  for b in path_glob(f"{rundir}*/metadata/*{extn_to_scan}") }
 
     if cell_list:
         all_cells = { k:all_cells[k] for k in cell_list }
 
-    # Now we can make a result, keyed off cell ID (not the slot)
-    res = dict()
-    for slot, cellid in all_cells.items():
-        res[cellid] = { 'slot': slot,
-                        'parts': ['hifi_reads', 'fail_reads'] }
-        if redemux is None:
-            redemux_dir = None
-            res[cellid]['re-demultiplex'] = False
-        else:
-            redemux_dir = redemux.format(slot=slot, cell=cellid, cellid=cellid)
-            # This is needed as os.path.isdir('') always returns False
-            res[cellid]['re-demultiplex'] = os.path.isdir(redemux_dir or '.')
-        if res[cellid]['re-demultiplex']:
-            res[cellid].update({
-                    'barcodes': find_barcodes_redemux(redemux_dir, cellid),
-                    'metadata': find_meta(rundir, slot, cellid),
-                    'sts': find_meta(rundir, slot, cellid, fmt="sts"),
-                    'reports_zip': find_reports_zip(rundir, slot, cellid),
-                    'lima_counts': find_lima_counts_redemux(redemux_dir, cellid) })
+    # List all the directories we will need up front, and then the subdirectories of
+    # any re-demultiplex directories, which hold the files for each barcode.
+    redemux_dirs = [ get_redemux_dir(redemux, slot, cellid) for slot, cellid in all_cells.items() ]
+    redemux_dirs = [ d or '.' for d in redemux_dirs if d is not None ]
+    prefetch_listings( [ *( os.path.join(f"{rundir}{slot}", d) for slot in all_cells
+                                                                for d in SLOT_SUBDIRS ),
+                         *redemux_dirs ], jobs )
+    prefetch_listings( [ os.path.join(rd, d) for rd in redemux_dirs
+                                             for d, is_dir in dir_listing(rd).items() if is_dir ],
+                       jobs )
+
+    def _scan_slot(slot_and_cellid):
+        slot, cellid = slot_and_cellid
+        if cache_dir:
+            return scan_slot_cached(cache_dir, rundir, slot, cellid, redemux)
         else:
-            res[cellid].update({
-                    'barcodes': find_barcodes(rundir, slot, cellid),
-                    'metadata': find_meta(rundir, slot, cellid),
-                    'sts': find_meta(rundir, slot, cellid, fmt="sts"),
-                    'reports_zip': find_reports_zip(rundir, slot, cellid),
-                    'lima_counts': find_lima_counts(rundir, slot, cellid) })
+            return scan_slot_revio(rundir, slot, cellid, redemux)
 
-    # Add unassigned, and unbarcoded ('all'), possibly
-    for cellid, v in res.items():
-        if 'unassigned' in v['barcodes']:
-            # Move it out
-            v['unassigned'] = v['barcodes']['unassigned']
-            del v['barcodes']['unassigned']
-
-        if not res[cellid]['re-demultiplex']:
-            v['barcodes'].update(find_unbarcoded(rundir, v['slot'], cellid))
+    # Now we can make a result, keyed off cell ID (not the slot)
+    res = dict(zip( all_cells.values(),
+                    map_jobs(_scan_slot, all_cells.items(), jobs) ))
 
     # Sanity check on lima_counts
     for cellid, v in res.items():
@@ -149,6 +227,126 @@ def scan_cells_revio(rundir, cell_list, extn_to_scan=".transferdone", redemux=No
 
     return res
 
+def get_redemux_dir(redemux, slot, cellid):
+    """Work out the re-demultiplex directory for this cell, if any
+    """
+    if redemux is None:
+        return None
+
+    return redemux.format(slot=slot, cell=cellid, cellid=cellid)
+
+def scan_slot_revio(rundir, slot, cellid, redemux=None):
+    """Find all the files for a single cell, as described in scan_cells_revio()
+    """
+    res = { 'slot': slot,
+            'parts': ['hifi_reads', 'fail_reads'] }
+
+    redemux_dir = get_redemux_dir(redemux, slot, cellid)
+    if redemux_dir is None:
+        res['re-demultiplex'] = False
+    else:
+        # This is needed as os.path.isdir('') always returns False
+        res['re-demultiplex'] = os.path.isdir(redemux_dir or '.')
+
+    if res['re-demultiplex']:
+        res.update({
+                'barcodes': find_barcodes_redemux(redemux_dir, cellid),
+                'metadata': find_meta(rundir, slot, cellid),
+                'sts': find_meta(rundir, slot, cellid, fmt="sts"),
+                'reports_zip': find_reports_zip(rundir, slot, cellid),
+                'lima_counts': find_lima_counts_redemux(redemux_dir, cellid) })
+    else:
+        res.update({
+                'barcodes': find_barcodes(rundir, slot, cellid),
+                'metadata': find_meta(rundir, slot, cellid),
+                'sts': find_meta(rundir, slot, cellid, fmt="sts"),
+                'reports_zip': find_reports_zip(rundir, slot, cellid),
+                'lima_counts': find_lima_counts(rundir, slot, cellid) })
+
+    # Add unassigned, and unbarcoded ('all'), possibly
+    if 'unassigned' in res['barcodes']:
+        # Move it out
+        res['unassigned'] = res['barcodes']['unassigned']
+        del res['barcodes']['unassigned']
+
+    if not res['re-demultiplex']:
+        res['barcodes'].update(find_unbarcoded(rundir, slot, cellid))
+
+    return res
+
+# The directories which scan_slot_revio() looks in, relative to the run
+SLOT_SUBDIRS = ["", "hifi_reads", "fail_reads", "pb_formats", "metadata", "statistics"]
+
+# Changes within this many seconds of a directory mtime might not show up in the mtime
+CACHE_MIN_AGE = 2
+
+def slot_dir_stamp(rundir, slot, cellid, redemux=None):
+    """Get the mtimes of all the directories that scan_slot_revio() looks in, as
+       { dir: mtime_ns }, with None for missing directories.
+    """
+    dirs = [ os.path.join(f"{rundir}{slot}", d) for d in SLOT_SUBDIRS ]
+
+    redemux_dir = get_redemux_dir(redemux, slot, cellid)
+    if redemux_dir is not None:
+        # The files for each barcode are in subdirectories
+        redemux_dir = redemux_dir or '.'
+        dirs.append(redemux_dir)
+        dirs.extend( os.path.join(redemux_dir, d)
+                     for d, is_dir in sorted(dir_listing(redemux_dir).items()) if is_dir )
+
+    res = dict()
+    for d in dirs:
+        try:
+            res[d] = os.stat(d).st_mtime_ns
+        except FileNotFoundError:
+            res[d] = None
+
+    return res
+
+def scan_slot_cached(cache_dir, rundir, slot, cellid, redemux=None):
+    """Wrapper around scan_slot_revio() which saves the result in {cache_dir}/{slot}.yaml
+       and re-uses the saved result if the directories have not changed since.
+    """
+    cache_file = os.path.join(cache_dir, f"{slot}.yaml")
+    cache_key = dict( rundir = rundir,
+                      cellid = cellid,
+                      redemux = redemux,
+                      dirs = slot_dir_stamp(rundir, slot, cellid, redemux) )
+
+    try:
+        cached = load_yaml(cache_file)
+        if cached['key'] == cache_key:
+            L.debug(f"Using cached scan result for {slot} from {cache_file}")
+            return cached['result']
+    except (OSError, KeyError, TypeError, yaml.YAMLError):
+        # Missing or corrupt, so just rescan
+        pass
+    L.debug(f"Scanning {slot}")
+
+    res = scan_slot_revio(rundir, slot, cellid, redemux)
+
+    # If a directory changed very recently, a change just after we looked would not
+    # alter the mtime, so the result can't be cached.
+    newest = max( (m for m in cache_key['dirs'].values() if m is not None), default=0 )
+    if newest > time.time_ns() - CACHE_MIN_AGE * 1e9:
+        L.debug(f"Not caching result for {slot} as the files are changing")
+        return res
+
+    # Write a temp file of our own and rename it, in case two scans run at once.
+    tmp_file = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_file = mkstemp(dir=cache_dir, prefix=f"{slot}.yaml.")
+        with open(fd, 'w') as yfh:
+            dump_yaml(dict(key=cache_key, result=res), fh=yfh)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        L.warning(f"Unable to save {cache_file}: {e}")
+        if tmp_file and os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+
+    return res
+
 def find_barcodes_redemux(redemux_dir, cellid, check_exist=True):
     """Finds the data files and .consensusreadset.xml files for re-demultiplexing jobs
        in SMRTLink.
@@ -158,7 +356,7 @@ def find_barcodes_redemux(redemux_dir, cellid, check_exist=True):
     """
     # At this point I'm not checking that the directory name matches the file name,
     # but files_per_barcode_redemux() will spot any anomalies.
-    xmlfiles = glob(f"{redemux_dir}*/{cellid}.hifi_reads.*.consensusreadset.xml")
+    xmlfiles = path_glob(f"{redemux_dir}*/{cellid}.hifi_reads.*.consensusreadset.xml")
     barcodes = [ os.path.basename(f)[len(f"{cellid}.hifi_reads."):-len(".consensusreadset.xml")]
                  for f in xmlfiles ]
 
@@ -186,7 +384,7 @@ def find_barcodes(rundir, slot, cellid, check_exist=True):
     # instead. Probably makes no difference.
     # eg: 1_C01/pb_formats/m84140_231018_155043_s3.hifi_reads.bc1002.consensusreadset.xml
 
-    xmlfiles = glob(f"{rundir}{slot}/pb_formats/{cellid}.hifi_reads.*.consensusreadset.xml")
+    xmlfiles = path_glob(f"{rundir}{slot}/pb_formats/{cellid}.hifi_reads.*.consensusreadset.xml")
     barcodes = [ os.path.basename(f)[len(f"{cellid}.hifi_reads."):-len(".consensusreadset.xml")]
                  for f in xmlfiles ]
 
@@ -207,7 +405,7 @@ def find_unbarcoded(rundir, slot, cellid, check_exist=True):
     # combined hifi_reads.consensusreadset.xml file.
 
     hifipath = f"{rundir}{slot}/hifi_reads"
-    bamfiles = glob(f"{hifipath}/{cellid}.hifi_reads.bam")
+    bamfiles = path_glob(f"{hifipath}/{cellid}.hifi_reads.bam")
 
     res = {}
     if bamfiles:
@@ -229,7 +427,7 @@ def unassigned_for_redemux(redemux_dir, cellid, check_exist=True):
 
     if check_exist:
         for f in chain(hifi.values(), fail.values()):
-            if not os.path.exists(f):
+            if not path_exists(f):
                 raise FileNotFoundError(f"missing {f}")
 
     return dict( hifi_reads = hifi,
@@ -248,7 +446,7 @@ def files_per_barcode_redemux(redemux_dir, cellid, barcode, check_exist=True):
 
     if check_exist:
         for f in chain(hifi.values(), fail.values()):
-            if not os.path.exists(f):
+            if not path_exists(f):
                 raise FileNotFoundError(f"missing {f}")
 
     return dict( hifi_reads = hifi,
@@ -268,7 +466,7 @@ def files_per_barcode(rundir, slot, cellid, barcode, check_exist=True):
 
     if check_exist:
         for f in chain(hifi.values(), fail.values()):
-            if not os.path.exists(f):
+            if not path_exists(f):
                 raise FileNotFoundError(f"missing {f}")
 
     return dict( hifi_reads = hifi,
@@ -280,7 +478,7 @@ def find_meta(rundir, slot, cellid, fmt="metadata"):
     """
     res = f"{rundir}{slot}/metadata/{cellid}.{fmt}.xml"
 
-    if not os.path.exists(res):
+    if not path_exists(res):
         raise FileNotFoundError(f"missing {res}")
 
     return res
@@ -291,7 +489,7 @@ def find_reports_zip(rundir, slot, cellid, check_exist=True):
     res = f"{rundir}{slot}/statistics/{cellid}.reports.zip"
 
     if check_exist:
-        if not os.path.exists(res):
+        if not path_exists(res):
             raise FileNotFoundError(f"missing {res}")
 
     return res
@@ -303,7 +501,7 @@ def find_lima_counts_redemux(redemux_dir, cellid, check_exist=True):
     res = f"{redemux_dir}{cellid}.hifi_reads.lima.counts" # ignoring the fail_reads counts here
 
     if check_exist:
-        if not os.path.exists(res):
+        if not path_exists(res):
             raise FileNotFoundError(f"missing {res}")
 
     return res
@@ -314,12 +512,12 @@ def find_lima_counts(rundir, slot, cellid):
     """
     res = f"{rundir}{slot}/statistics/{cellid}.hifi_reads.lima_counts.txt"
 
-    if not os.path.exists(res):
+    if not path_exists(res):
         return None
 
     return res
 
-def scan_cells_sequel(rundir, cell_list, extn_to_scan=".transferdone"):
+def scan_cells_sequel(rundir, cell_list, extn_to_scan=".transferdone", jobs=1):
     """ Work out all the cells to process based on config['cells'] and config['rundir']
         and thus infer the base names of the info.yaml files that need to be made.
         Return a dict of:
@@ -328,7 +526,7 @@ def scan_cells_sequel(rundir, cell_list, extn_to_scan=".transferdone"):
         no filter is currently supported but I left this feature in just in case.
     """
     all_cells = { b.split('/')[-2]: b.split('/')[-1][:-len(extn_to_scan)]
-                  for b in glob(f"{rundir}*/*{extn_to_scan}") }
+                  for b in path_glob(f"{rundir}*/*{extn_to_scan}") }
 
     # Now see if I need to filter by cell_list.
     if cell_list:
@@ -343,10 +541,12 @@ def scan_cells_sequel(rundir, cell_list, extn_to_scan=".transferdone"):
     # Assume no barcodes, and all reads are "default".
     # We don't really need this to work anyways - it's just for comparison.
     for cellid, cellinfo in res.items():
-        if not os.path.exists(cellinfo['meta']):
+        if not path_exists(cellinfo['meta']):
             raise FileNotFoundError(f"missing {cellinfo['meta']}")
 
-        parts = determine_parts_sequel(rundir, cellinfo['slot'], cellid)
+    all_parts = map_jobs( lambda c: determine_parts_sequel(rundir, res[c]['slot'], c),
+                          res, jobs )
+    for cellinfo, parts in zip(res.values(), all_parts):
         cellinfo['parts'] = sorted(parts, reverse=True)
         cellinfo['barcodes'] = dict(default=parts)
 
@@ -356,7 +556,7 @@ def determine_parts_sequel(rundir, slot, cellid):
     """Work out if this is a ['subreads', 'scraps'] cell or a ['reads'] cell.
     """
     cellpath = f"{rundir}{slot}/{cellid}"
-    bamfiles = glob(f"{cellpath}.*.bam")
+    bamfiles = path_glob(f"{cellpath}.*.bam")
 
     def get_xml(slot, cellid, part):
         if part == "subreads":
@@ -378,7 +578,8 @@ def determine_parts_sequel(rundir, slot, cellid):
         for d in parts.values():
             for f in d.values():
                 # Ensure file exists
-                os.stat(f)
+                if not path_exists(f):
+                    raise FileNotFoundError(f"missing {f}")
 
     return parts
 
@@ -400,6 +601,14 @@ def parse_args(*args):
                         help = "Cells to look at. If not specified, all will be scanned."
                                " Give the slot not the cell ID - eg. 1_A01" )
 
+    parser.add_argument("--cache",
+                        help="Directory in which to save the result for each slot, so that slots"
+                             " whose directories are unchanged need not be scanned again.")
+
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of threads to use for looking at the files. Useful on"
+                             " network filesystems, where each lookup has to wait.")
+
     parser.add_argument("-x", "--xmltrigger", action="store_true",
                         help="Identify ready cells by .sts.xml presence, not .transferdone.")
 
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
-import re
+import os, re
+import json
 import logging as L
+from hashlib import md5
+from tempfile import mkstemp
 import xml.etree.ElementTree as ET
+from collections import namedtuple
 
 from . import squash_barcode
 
@@ -11,6 +15,12 @@ from . import squash_barcode
     but also some info on the whole cell.
 
     If you run a function on the wrong type of file you'll get an error.
+
+    The same files tend to get read several times over, so parsed documents are
+    cached, keyed by the path, mtime and size of the file. If SMRTINO_XML_SIDECAR
+    is set to a directory then the raw fields extracted by _get_fields() are also
+    saved in a small JSON file in that directory (see _sidecar_name()) so that other
+    processes can skip parsing the XML altogether.
 """
 
 _ns = dict( pbmeta   = 'http://pacificbiosciences.com/PacBioCollectionMetadata.xsd',
@@ -33,36 +43,285 @@ rs_constants = dict( Revio = \
                               shortname = 'subreads',
                               parts = ['subreads', 'scraps'] ) )
 
-def _load_xml(filename):
-    """XML file loader that deals with the SMRTLink 12 bug -
-       the files claim to be utf-16. But they are not. FFS.
+# Parsed documents and extracted fields, keyed by absolute path and by what was extracted
+# (None for the whole document, or else the id() of the field spec). Each entry is
+# (stamp, result), where the stamp is [mtime_ns, size]
+_xml_cache = dict()
+
+CHUNKSIZE = 64 * 1024
+
+def _file_stamp(filename):
+    """Say if a file has changed, without reading it.
+    """
+    st = os.stat(filename)
+    return [st.st_mtime_ns, st.st_size]
+
+def _cached(filename, key, loader):
+    """Return loader(filename), unless we already have the result for this file and
+       key and the file is unchanged.
+    """
+    path = os.path.abspath(filename)
+    stamp = _file_stamp(path)
+
+    cached = _xml_cache.get((path, key))
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    res = loader(filename)
+    _xml_cache[(path, key)] = (stamp, res)
+
+    return res
+
+def _read_munged(fh):
+    """Deals with the SMRTLink 12 bug - the files claim to be utf-16. But they are not.
+       FFS. Yields the file in chunks, with the first line fixed.
 
        The files saved to the output directory are fixed (and SMRTLink 13 fixes the
        bug anyway) but I leave this here for backwards compatibility.
     """
-    with open(filename) as fh:
-        munged_lines = ( re.sub(r"utf-16", r"utf-8", aline) if n == 0
-                         else aline
-                         for n, aline in enumerate(fh) )
+    yield re.sub(rb"utf-16", rb"utf-8", fh.readline())
+    yield from iter(lambda: fh.read(CHUNKSIZE), b'')
+
+def _load_xml(filename):
+    """Load the whole XML file as an ElementTree, and return the root element.
+
+       Repeat calls on an unchanged file return the same (cached) root element, so
+       don't modify it!
+    """
+    def _parse(f):
+        with open(f, 'rb') as fh:
+            return ET.fromstringlist(_read_munged(fh))
+
+    return _cached(filename, None, _parse)
+
+# The result of _get_fields(), which has the tag and attrib of the root element so it
+# can stand in for the root in get_smrtlink_link()
+xmlfields = namedtuple('xmlfields', 'tag attrib fields')
+
+# A field to be extracted from the XML. The path is like "pbmeta:Foo/pbmeta:Bar", which
+# will match any Bar element which is a child of a Foo element (just like ".//" in
+# ElementPath). When the element has been read, get(elem) gives the value and then, if
+# the value is not None, convert(value). If every is True we collect the values from all
+# matching elements in a list, else we just take the first.
+xmlfield = namedtuple('xmlfield', 'path get convert every', defaults=[None, False])
+
+def _text(elem):
+    return elem.text
+
+def _attrib(elem):
+    return dict(elem.attrib)
+
+def _attr(name):
+    return lambda elem: elem.attrib.get(name)
+
+_BIOSAMPLE = 'pbmeta:WellSample/pbsample:BioSamples/pbsample:BioSample'
+
+# Fields needed by _get_common_stuff()
+_COMMON_FIELDS = dict(
+    results_folder  = xmlfield('pbmeta:ResultsFolder', _text),
+    collection_md   = xmlfield('pbmeta:CollectionMetadata', _attrib),
+    readset_ref     = xmlfield('pbmeta:ConsensusReadSetRef', _attrib),
+    well_samples    = xmlfield('pbmeta:WellSample', _attrib, every=True),
+    sample_barcodes = xmlfield( f'{_BIOSAMPLE}/pbsample:DNABarcodes/pbsample:DNABarcode',
+                                _attr('Name'), every=True ),
+    )
+
+# Everything we want from a metadata.xml file
+_METADATA_FIELDS = dict(
+    **_COMMON_FIELDS,
+    experiment      = xmlfield('pbmodel:ExperimentContainer', _attrib),
+    model_run       = xmlfield('pbmodel:Run', _attrib),
+    meta_run        = xmlfield('pbmeta:Run', _attrib),
+    runs_run        = xmlfield('pbmodel:Runs/pbmodel:Run', _attrib),
+    cellpac         = xmlfield('pbmeta:CellPac', _attrib),
+    application     = xmlfield('pbmeta:WellSample/pbmeta:Application', _text),
+    insert_size     = xmlfield('pbmeta:InsertSize', _text, int),
+    oplc            = xmlfield('pbmeta:OnPlateLoadingConcentration', _text, int),
+    versions        = xmlfield('pbmeta:ComponentVersions/pbmeta:VersionInfo', _attrib, every=True),
+    base_aps        = xmlfield('pbbase:AutomationParameter', _attrib, every=True),
+    meta_aps        = xmlfield('pbmeta:AutomationParameter', _attrib, every=True),
+    )
+
+# Everything we want from a sts.xml file
+_STS_FIELDS = dict(
+    local_base_rate_median = xmlfield('pbps:LocalBaseRateDist/pbbase:SampleMed', _text, float),
+    adapter_dimers         = xmlfield('pbps:AdapterDimerFraction', _text, float),
+    short_inserts          = xmlfield('pbps:ShortInsertFraction', _text, float),
+    )
+
+# Everything we want from a readset.xml file
+_READSET_FIELDS = dict(
+    **_COMMON_FIELDS,
+    bio_samples   = xmlfield(_BIOSAMPLE, _attrib, every=True),
+    meta_barcodes = xmlfield( f'{_BIOSAMPLE}/pbmeta:DNABarcodes/pbmeta:DNABarcode',
+                              _attr('Name'), every=True ),
+    )
+
+def _get_fields(filename, spec):
+    """Get all the fields in the spec from the XML file, in a single pass through the
+       file. Returns an xmlfields tuple.
+
+       We never hold the whole tree in memory. Elements are cleared as soon as they have
+       been read, and if the spec has no 'every' fields we stop reading as soon as all
+       the fields are found.
+    """
+    return _cached(filename, id(spec), lambda f: _with_sidecar(f, spec))
+
+def _clark(step):
+    """Convert "pbmeta:Foo" to "{http://pacificbiosciences.com/...}Foo"
+    """
+    prefix, tag = step.split(':')
+    return f"{{{_ns[prefix]}}}{tag}"
+
+def _iter_events(fh, parser):
+    """Feed the file into an XMLPullParser and yield the events
+    """
+    for chunk in _read_munged(fh):
+        parser.feed(chunk)
+        yield from parser.read_events()
+
+    parser.close()
+    yield from parser.read_events()
+
+def _walk_fields(filename, spec):
+    """Does the work for _get_fields()
+    """
+    res = { n: ([] if f.every else None) for n, f in spec.items() }
+    still_wanted = set( n for n, f in spec.items() if not f.every )
+    can_stop = not any( f.every for f in spec.values() )
+
+    # Index the fields by the last tag in the path, so we only check the ones that
+    # could match.
+    targets = dict()
+    for n, f in spec.items():
+        steps = [ _clark(s) for s in f.path.split('/') ]
+        targets.setdefault(steps[-1], []).append((n, steps))
+
+    root = None
+    tag_stack = []      # Tags of the elements we are in, not including the root
+    matched_stack = []  # Names of the fields matched by each of these elements
+
+    with open(filename, 'rb') as fh:
+        for event, elem in _iter_events(fh, ET.XMLPullParser(events=('start', 'end'))):
+            if root is None:
+                root = elem
+                continue
+            if elem is root:
+                break
+
+            if event == 'start':
+                tag_stack.append(elem.tag)
+                # For a single field, we want the first element to start, not to end
+                matched = [ n for n, steps in targets.get(elem.tag, ())
+                            if (spec[n].every or n in still_wanted)
+                            and tag_stack[-len(steps):] == steps ]
+                still_wanted.difference_update(matched)
+                matched_stack.append(matched)
+                continue
+
+            # So this is an 'end' event, and elem is complete.
+            tag_stack.pop()
+            for n in matched_stack.pop():
+                val = spec[n].get(elem)
+                if val is not None and spec[n].convert:
+                    val = spec[n].convert(val)
+
+                if spec[n].every:
+                    res[n].append(val)
+                else:
+                    res[n] = val
+
+            # We never need to look at the children of an element after it ends
+            elem.clear()
+
+            if can_stop and not still_wanted and not any(matched_stack):
+                L.debug(f"Found everything we need in {filename}, stopping early")
+                break
+
+    if root is None:
+        raise ET.ParseError(f"No XML elements found in {filename}")
+
+    return xmlfields(root.tag, dict(root.attrib), res)
+
+# Bump this if _walk_fields() or any of the get or convert functions in the field specs
+# change what they return, so that old sidecar files are ignored. Changes to the names
+# and paths of the fields are picked up by _spec_key() in any case.
+SIDECAR_VERSION = 1
+
+def _sidecar_name(xmlfile, sidecar_dir):
+    """The sidecar for foo/bar.metadata.xml is {sidecar_dir}/bar.metadata.xml.{hash}.fields.json
+       where the hash is of the full path, as different directories may have files of the
+       same name.
+    """
+    path = os.path.abspath(xmlfile)
+    path_hash = md5(path.encode()).hexdigest()[:12]
+    return os.path.join(sidecar_dir, f"{os.path.basename(path)}.{path_hash}.fields.json")
+
+def _spec_key(spec):
+    """A key for the results of a field spec, which changes if the spec changes.
+    """
+    spec_desc = json.dumps([ [n, f.path, f.every] for n, f in sorted(spec.items()) ])
+    return md5(spec_desc.encode()).hexdigest()
+
+def _with_sidecar(xmlfile, spec):
+    """Return _walk_fields(xmlfile, spec), or else the result saved in the sidecar file,
+       if the sidecar matches the XML file and the spec.
+       Sidecars are only used if SMRTINO_XML_SIDECAR is set to a directory. If the sidecar
+       can't be written (eg. the directory is read-only) we just carry on.
+    """
+    sidecar_dir = os.environ.get('SMRTINO_XML_SIDECAR', '')
+    if sidecar_dir in ['', '0']:
+        return _walk_fields(xmlfile, spec)
 
-        root = ET.fromstringlist(munged_lines)
+    sidecar = _sidecar_name(xmlfile, sidecar_dir)
+    stamp = _file_stamp(xmlfile)
+    key = _spec_key(spec)
 
-    return root
+    try:
+        with open(sidecar) as sfh:
+            sc_data = json.load(sfh)
+        if sc_data.get('version') != SIDECAR_VERSION or sc_data.get('stamp') != stamp:
+            L.debug(f"Ignoring stale {sidecar}")
+            sc_data = dict(version=SIDECAR_VERSION, stamp=stamp, fields={})
+    except (OSError, ValueError):
+        sc_data = dict(version=SIDECAR_VERSION, stamp=stamp, fields={})
+
+    if key in sc_data['fields']:
+        return xmlfields(*sc_data['fields'][key])
+
+    res = _walk_fields(xmlfile, spec)
+
+    sc_data['fields'][key] = res
+    # Several processes may be doing this at once, so each writes a temp file of its own.
+    # The sidecar gets the same permissions as the XML file.
+    tmp_file = None
+    try:
+        os.makedirs(sidecar_dir, exist_ok=True)
+        fd, tmp_file = mkstemp(dir=sidecar_dir, prefix=os.path.basename(sidecar))
+        os.fchmod(fd, os.stat(xmlfile).st_mode & 0o666)
+        with open(fd, 'w') as sfh:
+            json.dump(sc_data, sfh)
+        os.replace(tmp_file, sidecar)
+    except OSError as e:
+        L.debug(f"Unable to save {sidecar}: {e}")
+        if tmp_file and os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+
+    return res
 
-def _get_automation_parameters(root):
+def _get_automation_parameters(xf):
     """Return the AutomationParameter list as a regular dict
 
        We'll squish all the AutomationParameters into one dict, until
        I see a reason not to.
     """
     res = {}
-    ap_list = [ *root.findall('.//pbbase:AutomationParameter', _ns),
-                *root.findall('.//pbmeta:AutomationParameter', _ns) ]
+    ap_list = [ *xf.fields['base_aps'], *xf.fields['meta_aps'] ]
 
     for ap in ap_list:
-        k = ap.attrib['Name']
-        dtype = ap.attrib['ValueDataType']
-        val = ap.attrib['SimpleValue']
+        k = ap['Name']
+        dtype = ap['ValueDataType']
+        val = ap['SimpleValue']
 
         if k in res:
             raise KeyError(f"AutomationParameter {k} is repeated in XML.")
@@ -79,21 +338,21 @@ def _get_automation_parameters(root):
 
     return res
 
-def _get_common_stuff(root):
+def _get_common_stuff(xf):
     """There is a lot of overlap between what make_summary.py wants from the metadata
        file and compile_bc_info.py wants from the readset file.
 
        This function captures that.
     """
-    try:
-        rf = root.find('.//pbmeta:ResultsFolder', _ns).text.rstrip('/')
-        cmd = root.find('.//pbmeta:CollectionMetadata', _ns).attrib
-        crs = root.find('.//pbmeta:ConsensusReadSetRef', _ns).attrib
-    except AttributeError:
+    rf = xf.fields['results_folder']
+    cmd = xf.fields['collection_md']
+    crs = xf.fields['readset_ref']
+    if None in [rf, cmd, crs]:
         rf = "/unknown/unknown"
         cmd = {}
         crs = {}
 
+    rf = rf.rstrip('/')
     info = { 'run_id':     rf.split('/')[-2],
              'run_slot':   rf.split('/')[-1], # Also could get this from TimeStampedName
              'cell_id':    cmd.get('Context', "unknown"),
@@ -112,7 +371,7 @@ def _get_common_stuff(root):
 
     # All these files should have a single WellSample, until I see otherwise.
     # For the metadata for a pooled run there may be several biosamples.
-    well_samples = root.findall('.//pbmeta:WellSample', _ns)
+    well_samples = xf.fields['well_samples']
 
     # There should be 1!
     L.debug(f"Found {len(well_samples)} WellSample records")
@@ -120,8 +379,8 @@ def _get_common_stuff(root):
     if len(well_samples) == 1:
         ws, = well_samples
 
-        info['ws_name'] = ws.attrib.get('Name', '')
-        info['ws_desc'] = ws.attrib.get('Description', '')
+        info['ws_name'] = ws.get('Name', '')
+        info['ws_desc'] = ws.get('Description', '')
 
         mo = re.search(r'\b(\d{5,})', info['ws_name'])
         if mo:
@@ -129,22 +388,20 @@ def _get_common_stuff(root):
             info['ws_project'] = mo.group(1)
 
     # And see if we have barcodes
-    dna_barcodes = ws.findall(".//pbsample:DNABarcodes", _ns)
+    dna_barcodes = xf.fields['sample_barcodes']
     if dna_barcodes:
-        info['barcodes'] = [ squash_barcode(bc.attrib.get('Name', 'unknown'))
-                             for dna in dna_barcodes
-                             for bc in dna ]
+        info['barcodes'] = [ squash_barcode(bc or 'unknown')
+                             for bc in dna_barcodes ]
 
     return info
 
-
 def get_metadata_summary(xmlfile, smrtlink_base=None):
     """ Glean info from the metadata.xml file for a contents of the Revio SMRT cell.
 
         This is used to get the info before the pipeline actually runs - the report
         maker gets this same info from the readset.xml file.
     """
-    root = _load_xml(xmlfile)
+    root = _get_fields(xmlfile, _METADATA_FIELDS)
 
     if root.tag != f"{{{_ns['pbmodel']}}}PacBioDataModel":
         raise RuntimeError("This function must be run on a metadata.xml file."
@@ -163,30 +420,30 @@ def get_metadata_info(xmlfile):
     """
     run_info = dict(ExperimentId = 'unknown')
 
-    root = _load_xml(xmlfile)
+    root = _get_fields(xmlfile, _METADATA_FIELDS)
 
     if root.tag != f"{{{_ns['pbmodel']}}}PacBioDataModel":
         raise RuntimeError("This function must be run on a metadata.xml file."
                            f" Root tag is: {root.tag}.")
 
     # attribute if one was set.
-    ec = root.find('pbmodel:ExperimentContainer', _ns)
+    ec = root.fields['experiment']
     if ec is not None:
-        run_info['ExperimentId'] = ec.attrib.get('ExperimentId', '')
+        run_info['ExperimentId'] = ec.get('ExperimentId', '')
 
     # And there should be a Run element which provides us, eg.
     # ChipType="8mChip" InstrumentType="Sequel2e" CreatedBy="rfoster2"
-    run = root.find('.//pbmodel:Run', _ns)
+    run = root.fields['model_run']
     if run is not None:
         for i in "ChipType InstrumentType CreatedBy TimeStampedName".split():
-            run_info[i] = run.attrib.get(i, 'unknown')
+            run_info[i] = run.get(i, 'unknown')
 
     # And there should be a CollectionMetadata element which gives us the InstrumentId
     # Except this is now under "Run", even though the name is under "CollectionMetadata"?
-    rmd = root.find('.//pbmeta:Run', _ns)
-    if rmd:
+    rmd = root.fields['meta_run']
+    if rmd is not None:
         for i in ["InstrumentId"]:
-            run_info[i] = rmd.attrib.get(i, 'unknown')
+            run_info[i] = rmd.get(i, 'unknown')
 
         if "InstrumentType" in run_info:
             run_info["Instrument"] = f"{run_info['InstrumentType']}_{run_info['InstrumentId']}"
@@ -216,7 +473,7 @@ def get_metadata_info2(xmlfile):
     """
     run_info = dict()
 
-    root = _load_xml(xmlfile)
+    root = _get_fields(xmlfile, _METADATA_FIELDS)
     if root.tag != f"{{{_ns['pbmodel']}}}PacBioDataModel":
         raise RuntimeError("This function must be run on a metadata.xml file."
                            f" Root tag is: {root.tag}.")
@@ -231,17 +488,16 @@ def get_metadata_info2(xmlfile):
     cellpac = _get_cellpac(root)
     runattribs = _get_runelem(root)
 
-    cmd = root.find('.//pbmeta:CollectionMetadata', _ns)
-    run_info['instrument_id'] = cmd.attrib['InstrumentId']
-    run_info['instrument_name'] = cmd.attrib['InstrumentName']
+    cmd = root.fields['collection_md']
+    run_info['instrument_id'] = cmd['InstrumentId']
+    run_info['instrument_name'] = cmd['InstrumentName']
 
     # I could parse this properly, but instead just take the first chars
     mo = re.match(r"(\d{4}-\d{2}-\d{2})T", runattribs['WhenStarted'])
     run_info['run_start'] = mo.group(1)
     run_info['smrtlink_user'] = runattribs['CreatedBy']
 
-    ws_application = root.find('.//pbmeta:WellSample/pbmeta:Application', _ns)
-    run_info['application'] = ws_application.text
+    run_info['application'] = root.fields['application']
 
     # adaptive_loading
     run_info['adaptive_loading'] = aps.get('DynamicLoadingCognate')
@@ -257,17 +513,15 @@ def get_metadata_info2(xmlfile):
                   f" are expected to be the same nowadays.")
 
     # insert_size - this could be in two places
-    run_info['insert_size'] = int(root.find('.//pbmeta:InsertSize', _ns).text)
+    run_info['insert_size'] = root.fields['insert_size']
     if ('InsertSize' in aps) and (run_info['insert_size'] != aps['InsertSize']):
         raise ValueError("Insert size mismatch in XML")
 
     # on_plate_loading_conc
-    run_info['on_plate_loading_conc'] = int(
-                    root.find('.//pbmeta:OnPlateLoadingConcentration', _ns).text )
+    run_info['on_plate_loading_conc'] = root.fields['oplc']
 
     # software versions
-    vi = { e.attrib['Name']: e.attrib.get('Version', 'unknown') for e in
-           root.findall('.//pbmeta:ComponentVersions/pbmeta:VersionInfo', _ns) }
+    vi = { e['Name']: e.get('Version', 'unknown') for e in root.fields['versions'] }
     run_info['version_ics'] = vi['ics']
     run_info['version_chemistry'] = vi['chemistry']
     run_info['version_smrtlink'] = vi['smrtlink']
@@ -283,36 +537,31 @@ def get_sts_info(xmlfile):
     """
     sts_info = dict()
 
-    root = _load_xml(xmlfile)
+    root = _get_fields(xmlfile, _STS_FIELDS)
     if root.tag != f"{{{_ns['pbps']}}}PipeStats":
         raise RuntimeError("This function must be run on a sts.xml file."
                            f" Root tag is: {root.tag}.")
 
-    lbrm_elem = root.find('.//pbps:LocalBaseRateDist/pbbase:SampleMed', _ns)
-    sts_info['local_base_rate_median'] = float(lbrm_elem.text)
-
-    adf_elem = root.find('.//pbps:AdapterDimerFraction', _ns)
-    sts_info['adapter_dimers'] = float(adf_elem.text) * 100
-
-    sif_elem = root.find('.//pbps:ShortInsertFraction', _ns)
-    sts_info['short_inserts'] = float(sif_elem.text) * 100
+    sts_info['local_base_rate_median'] = root.fields['local_base_rate_median']
+    sts_info['adapter_dimers'] = root.fields['adapter_dimers'] * 100
+    sts_info['short_inserts'] = root.fields['short_inserts'] * 100
 
     return sts_info
 
-def _get_cellpac(root):
+def _get_cellpac(xf):
     """Get the CellPac element attribs
     """
-    return root.find('.//pbmeta:CellPac', _ns).attrib
+    return xf.fields['cellpac']
 
-def _get_runelem(root):
-    """Get the Run element
+def _get_runelem(xf):
+    """Get the Run element attribs
     """
-    return root.find('.//pbmodel:Runs/pbmodel:Run', _ns).attrib
+    return xf.fields['runs_run']
 
 def get_readset_info(xmlfile, smrtlink_base=None):
     """ Glean info from a readset file for a SMRT cell
     """
-    root = _load_xml(xmlfile)
+    root = _get_fields(xmlfile, _READSET_FIELDS)
 
     if root.tag != f"{{{_ns['pb']}}}ConsensusReadSet":
         raise RuntimeError("This function must be run on a readset.xml file."
@@ -324,11 +573,9 @@ def get_readset_info(xmlfile, smrtlink_base=None):
     # It might or might not have the same name as the wellsample (depending on if the wellsample was a pool).
     # Unassigned readsets will, confusingly, have one or more BioSamples but the barcodes will be
     # 'pbmeta:DNABarcode' tags not 'pbsample:DNABarcode' tags.
-    bio_samples = root.findall('.//pbmeta:WellSample/pbsample:BioSamples/pbsample:BioSample', _ns)
-    samp_barcodes = [ mbc for bs in bio_samples
-                      for mbc in bs.findall('pbsample:DNABarcodes/pbsample:DNABarcode', _ns) ]
-    meta_barcodes = [ mbc for bs in bio_samples
-                      for mbc in bs.findall('pbmeta:DNABarcodes/pbmeta:DNABarcode', _ns) ]
+    bio_samples = root.fields['bio_samples']
+    samp_barcodes = root.fields['sample_barcodes']
+    meta_barcodes = root.fields['meta_barcodes']
 
     # Get the barcode according to the filename
     # This regex may capture "bc0001.mas16" so we need to chop off any
@@ -353,7 +600,7 @@ def get_readset_info(xmlfile, smrtlink_base=None):
         else:
             # This assertion is an internal consistency check and should pass regardless
             # of the data content.
-            assert info['barcodes'] == [squash_barcode(e.attrib['Name']) for e in samp_barcodes]
+            assert info['barcodes'] == [squash_barcode(bc) for bc in samp_barcodes]
             # Verify that info['barcode'] really is the same as barcode_from_filename but this
             # could be squashed or unsquashed.
             barcode_from_xml, = info['barcodes']
@@ -367,8 +614,8 @@ def get_readset_info(xmlfile, smrtlink_base=None):
 
         bs, = bio_samples
 
-        info['bs_name'] = bs.attrib.get('Name', '')
-        info['bs_desc'] = bs.attrib.get('Description', '')
+        info['bs_name'] = bs.get('Name', '')
+        info['bs_desc'] = bs.get('Description', '')
 
         mo = re.search(r'\b(\d{5,})', info['bs_name'])
         if mo:
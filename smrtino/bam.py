@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+import struct
+from collections import namedtuple
+import numpy as np
+
+from smrtino import bgzf
+
+""" Just enough of a BAM parser to get at the read names, sequences and qualities
+    without going via "samtools fasta" or "samtools fastq". The tags are skipped
+    over, and we assume the reads are unaligned, as they are from the PacBio.
+
+    See section 4.2 of https://samtools.github.io/hts-specs/SAMv1.pdf
+"""
+
+# The fixed part of each record, after the block_size:
+# refID pos l_read_name mapq bin n_cigar_op flag l_seq next_refID next_pos tlen
+RECORD_HEAD = struct.Struct('<iiBBHHHiiii')
+
+# Bases are packed two to a byte using these 4-bit codes
+SEQ_CODES = '=ACMGRSVTWYHKDBN'
+N_CODE = SEQ_CODES.index('N')
+
+# Secondary and supplementary alignments
+SKIP_FLAGS = 0x900
+
+CHUNKSIZE = 1024 * 1024
+
+bamrecords = namedtuple('bamrecords', 'name_starts name_ends flags seq_starts seq_lens qual_starts'.split())
+
+class BAMError(ValueError):
+    pass
+
+def nibble_table(bases):
+    """Make a lookup table giving, for every possible byte of packed sequence, how
+       many of the two bases are in the given set.
+    """
+    in_set = np.array([ c in bases for c in SEQ_CODES ], dtype=np.int64)
+    codes = np.arange(256)
+
+    return in_set[codes >> 4] + in_set[codes & 0xf]
+
+def skip_header(buf):
+    """If buf contains the whole BAM header, return the offset of the first record,
+       else None.
+    """
+    if len(buf) < 12:
+        return None
+    if not buf.startswith(b'BAM\x01'):
+        raise BAMError("Not a BAM file")
+
+    l_text, = struct.unpack_from('<i', buf, 4)
+    pos = 8 + l_text
+    if len(buf) < pos + 4:
+        return None
+
+    n_ref, = struct.unpack_from('<i', buf, pos)
+    pos += 4
+    for _ in range(n_ref):
+        if len(buf) < pos + 4:
+            return None
+        l_name, = struct.unpack_from('<i', buf, pos)
+        pos += 4 + l_name + 4
+
+    return pos if len(buf) >= pos else None
+
+def find_records(buf):
+    """Find all the complete records in buf. Returns a bamrecords tuple of arrays
+       locating the parts of each record, and the offset at the end of the last
+       complete record.
+    """
+    name_starts = []
+    flags = []
+    seq_starts = []
+    seq_lens = []
+
+    pos = 0
+    buflen = len(buf)
+    unpack_from = RECORD_HEAD.unpack_from
+    while pos + 4 <= buflen:
+        block_size = int.from_bytes(buf[pos:pos+4], 'little')
+        if pos + 4 + block_size > buflen:
+            break
+
+        ( _, _, l_read_name, _, _, n_cigar_op,
+          flag, l_seq, _, _, _ ) = unpack_from(buf, pos + 4)
+
+        name_start = pos + 4 + RECORD_HEAD.size
+        name_starts.append(name_start)
+        flags.append(flag)
+        seq_starts.append(name_start + l_read_name + 4 * n_cigar_op)
+        seq_lens.append(l_seq)
+        pos += 4 + block_size
+
+    name_starts = np.array(name_starts, dtype=np.int64)
+    seq_starts = np.array(seq_starts, dtype=np.int64)
+    seq_lens = np.array(seq_lens, dtype=np.int64)
+
+    # The name is NUL-terminated and the qualities follow the packed sequence
+    return bamrecords( name_starts = name_starts,
+                       name_ends = np.array([ buf.find(b'\0', n) for n in name_starts.tolist() ],
+                                            dtype=np.int64),
+                       flags = np.array(flags, dtype=np.int64),
+                       seq_starts = seq_starts,
+                       seq_lens = seq_lens,
+                       qual_starts = seq_starts + (seq_lens + 1) // 2 ), pos
+
+def iter_record_chunks(filename, threads=1, chunksize=CHUNKSIZE, skip_flags=SKIP_FLAGS):
+    """Read a BAM file and yield (buf, records) for each chunk of complete records,
+       where records is a bamrecords tuple of NumPy arrays locating the parts of every
+       record in buf. The packed sequences occupy (seq_lens + 1) // 2 bytes each.
+       threads is the number of threads used to inflate BGZF blocks.
+       Records with any of skip_flags set are left out, as "samtools fasta" would.
+    """
+    with open(filename, 'rb') as fh:
+        yield from iter_record_chunks_fh(fh, threads, chunksize, skip_flags, filename=filename)
+
+def iter_record_chunks_fh(fh, threads=1, chunksize=CHUNKSIZE, skip_flags=SKIP_FLAGS,
+                          filename="BAM file"):
+    """Does the work for iter_record_chunks() on an open file. fh may be anything
+       with a read() method.
+    """
+    def _records(buf):
+        records, buf_used = find_records(buf)
+        if skip_flags:
+            keep = (records.flags & skip_flags) == 0
+            if not keep.all():
+                records = bamrecords(*[ a[keep] for a in records ])
+        return records, buf_used
+
+    data = bgzf.iter_inflated(fh, threads)
+
+    # Get past the header
+    buf = b''
+    for block in data:
+        buf += block
+        rec_start = skip_header(buf)
+        if rec_start is not None:
+            buf = buf[rec_start:]
+            break
+    else:
+        if buf:
+            raise BAMError(f"Truncated BAM header in {filename}")
+        return
+
+    pending = [buf]
+    pending_len = len(buf)
+    for block in data:
+        pending.append(block)
+        pending_len += len(block)
+        if pending_len < chunksize:
+            continue
+
+        buf = b''.join(pending)
+        records, buf_used = _records(buf)
+        if len(records.seq_starts):
+            yield buf, records
+        pending = [buf[buf_used:]]
+        pending_len = len(pending[0])
+
+    buf = b''.join(pending)
+    records, buf_used = _records(buf)
+    if buf_used != len(buf):
+        raise BAMError(f"Truncated BAM record in {filename}")
+    if len(records.seq_starts):
+        yield buf, records
+
+def unpack_seq(buf, start, length):
+    """Unpack a single sequence into a string. Mostly for debugging, and for the odd
+       sequence that needs to be looked at in detail.
+    """
+    packed = buf[start:start + (length + 1) // 2]
+
+    return ''.join( SEQ_CODES[b >> 4] + SEQ_CODES[b & 0xf] for b in packed )[:length]
+
+# For decode_seq(), the pair of letters for every possible byte, as a 16-bit value
+# so that a single lookup gets both.
+_SEQ_PAIRS = np.array([ [ord(a), ord(b)] for a in SEQ_CODES for b in SEQ_CODES ],
+                      dtype=np.uint8).view(np.uint16).ravel()
+
+# Qualities are stored without the +33 offset, or as all 0xff if missing, in which case
+# we follow samtools and report them as Q1
+_QUAL_TABLE = bytes( min(q + 33, 126) for q in range(256) )
+
+def decode_seq(packed, start, length):
+    """Unpack a single sequence from a NumPy uint8 array into bytes. This is the one
+       to use for bulk output.
+    """
+    return _SEQ_PAIRS[packed[start:start + (length + 1) // 2]].tobytes()[:length]
+
+def decode_qual(buf, start, length):
+    """Get the quality string for a record as Phred+33 bytes.
+    """
+    qual = buf[start:start + length]
+    if qual[:1] == b'\xff':
+        return b'"' * length
+
+    return qual.translate(_QUAL_TABLE)
+
+def record_at(fh, voffset):
+    """Get a single raw record, starting with the block_size, at the given BGZF virtual
+       file offset, as found in a .pbi index. The record may run over several blocks.
+    """
+    fh.seek(voffset >> 16)
+    uoffset = voffset & 0xffff
+
+    data = b''
+    record_end = None
+    while record_end is None or len(data) < record_end:
+        block = bgzf.read_block(fh)
+        if not block:
+            raise BAMError(f"No complete BAM record at virtual offset {voffset}")
+        data += bgzf.inflate_block(block)
+
+        if record_end is None and len(data) >= uoffset + 4:
+            record_end = uoffset + 4 + int.from_bytes(data[uoffset:uoffset+4], 'little')
+
+    return data[uoffset:record_end]
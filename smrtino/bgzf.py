@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+import os
+import struct
+import zlib
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+""" Minimal support for BGZF, the blocked gzip format used for BAM files and
+    written by bgzip.
+
+    A BGZF file is just a series of gzip members, each no more than 64KiB, where
+    the header of each member records the size of the member. This means we can
+    find the block boundaries without decompressing anything, and so split the
+    work on a file between several processes.
+
+    See section 4.1 of https://samtools.github.io/hts-specs/SAMv1.pdf
+"""
+
+# The header is fixed - XLEN is always 6 and the only extra subfield is BC
+MAGIC = b'\x1f\x8b\x08\x04'
+HEADER_LEN = 18
+MAX_BLOCK = 65536
+
+# This is the 28-byte block that bgzip and samtools put at the end of the file
+EOF_BLOCK = bytes.fromhex( "1f8b08040000000000ff0600424302001b0003000000000000000000" )
+
+def block_size(header):
+    """If header is the start of a BGZF block, return the total size of the
+       block, else None.
+    """
+    if len(header) < HEADER_LEN or not header.startswith(MAGIC):
+        return None
+
+    xlen, si1, si2, slen, bsize = struct.unpack_from('<HBBHH', header, 10)
+    if (xlen, si1, si2, slen) != (6, 66, 67, 2):
+        return None
+
+    return bsize + 1
+
+def is_bgzf(filename):
+    """Sniff the start of a file to see if it is BGZF.
+    """
+    with open(filename, 'rb') as fh:
+        return block_size(fh.read(HEADER_LEN)) is not None
+
+def read_block(fh):
+    """Read the next raw block from fh. Returns b'' at the end of the file.
+    """
+    header = fh.read(HEADER_LEN)
+    if not header:
+        return b''
+
+    bsize = block_size(header)
+    if bsize is None:
+        raise ValueError(f"Invalid BGZF block header at offset {fh.tell() - len(header)}")
+
+    block = header + fh.read(bsize - HEADER_LEN)
+    if len(block) != bsize:
+        raise EOFError("Truncated BGZF block")
+
+    return block
+
+def inflate_block(block):
+    """Decompress a raw block as returned by read_block() and check the CRC.
+       zlib releases the GIL so this can usefully be run in a thread pool.
+    """
+    data = zlib.decompress(block[HEADER_LEN:-8], -15)
+
+    crc, isize = struct.unpack_from('<II', block, len(block) - 8)
+    if isize != len(data) or crc != zlib.crc32(data):
+        raise ValueError("BGZF block failed CRC check")
+
+    return data
+
+def deflate_block(data, level=6):
+    """Make a raw BGZF block from up to 64KiB of data.
+    """
+    cobj = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = cobj.compress(data) + cobj.flush()
+
+    bsize = HEADER_LEN + len(cdata) + 8
+    if bsize > MAX_BLOCK:
+        raise ValueError("Data does not fit in a BGZF block")
+
+    return ( MAGIC + struct.pack('<IBBHBBHH', 0, 0, 0xff, 6, 66, 67, 2, bsize - 1) +
+             cdata +
+             struct.pack('<II', zlib.crc32(data), len(data)) )
+
+def find_block(fh, offset):
+    """Find the first block that starts at or after offset. The magic bytes could
+       appear by chance in the compressed data, so a candidate is only accepted if
+       it is followed by another block or by the end of the file.
+       If there is no such block, returns the size of the file.
+    """
+    fsize = os.fstat(fh.fileno()).st_size
+
+    while offset < fsize:
+        fh.seek(offset)
+        window = fh.read(MAX_BLOCK + HEADER_LEN)
+
+        pos = window.find(MAGIC)
+        while pos != -1:
+            bsize = block_size(window[pos:pos+HEADER_LEN])
+            if bsize is not None:
+                next_block = offset + pos + bsize
+                if next_block == fsize:
+                    return offset + pos
+                fh.seek(next_block)
+                if block_size(fh.read(HEADER_LEN)) is not None:
+                    return offset + pos
+            pos = window.find(MAGIC, pos + 1)
+
+        # Keep looking, allowing for the magic being split over the window boundary
+        offset += max(len(window) - len(MAGIC), 1)
+
+    return fsize
+
+def split_file(filename, nparts):
+    """Divide a BGZF file into up to nparts ranges of roughly equal size, each
+       starting on a block boundary. Returns a list of (start, end) offsets.
+    """
+    fsize = os.path.getsize(filename)
+
+    with open(filename, 'rb') as fh:
+        starts = sorted({ find_block(fh, fsize * n // nparts) for n in range(nparts) })
+
+    return [ (s, e) for s, e in zip(starts, starts[1:] + [fsize]) if s < e ]
+
+def iter_blocks(fh, start=0, end=None):
+    """Yield the decompressed contents of every block which starts between start
+       and end (which should be offsets as given by split_file()).
+    """
+    fh.seek(start)
+    pos = start
+
+    while end is None or pos < end:
+        block = read_block(fh)
+        if not block:
+            break
+        pos += len(block)
+
+        yield inflate_block(block)
+
+def iter_inflated(fh, threads=1):
+    """Yield the decompressed contents of every block in fh, from the current
+       position to the end. With threads > 1 the blocks are inflated in a thread
+       pool, keeping a few blocks ahead of the consumer.
+    """
+    blocks = iter(partial(read_block, fh), b'')
+
+    if threads <= 1:
+        yield from map(inflate_block, blocks)
+        return
+
+    with ThreadPoolExecutor(threads) as executor:
+        pending = deque()
+        for block in blocks:
+            pending.append(executor.submit(inflate_block, block))
+            if len(pending) >= threads * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def deflate_data(data, level=6):
+    """Compress any amount of data into a series of BGZF blocks, returned as a single
+       bytes object. Like bgzip, this puts at most 0xff00 bytes into each block.
+    """
+    blocks = []
+    for n in range(0, len(data), 0xff00):
+        piece = data[n:n+0xff00]
+        try:
+            blocks.append(deflate_block(piece, level))
+        except ValueError:
+            # Data that will not compress can end up too big for a block, so halve it
+            half = len(piece) // 2
+            blocks.extend([ deflate_block(piece[:half], level),
+                            deflate_block(piece[half:], level) ])
+
+    return b''.join(blocks)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+import gzip
+import struct
+from collections import namedtuple
+import numpy as np
+
+""" Reader for the PacBio BAM index (.pbi) files which sit alongside every BAM file
+    from the instrument. We only need the BasicData section, which has the ZMW
+    (hole number) and the virtual file offset of every record, so that we can go
+    straight to any read without scanning the BAM.
+
+    See https://pacbiofileformats.readthedocs.io/en/latest/PacBioBamIndex.html
+"""
+
+PBI_MAGIC = b'PBI\x01'
+
+# magic, version, pbi_flags, n_reads, then 18 reserved bytes
+PBI_HEADER = struct.Struct('<4sIHI18x')
+
+# The BasicData columns, in order, each having n_reads entries
+BASIC_DATA = [ ('rg_id',        '<i4'),
+               ('q_start',      '<i4'),
+               ('q_end',        '<i4'),
+               ('hole_number',  '<i4'),
+               ('read_qual',    '<f4'),
+               ('ctxt_flag',    'u1'),
+               ('file_offset',  '<i8') ]
+
+pbiindex = namedtuple('pbiindex', 'version n_reads hole_number file_offset'.split())
+
+class PBIError(ValueError):
+    pass
+
+def load_pbi(filename):
+    """Load the parts of the index we care about. The file is BGZF compressed, but
+       we only need to read as far as the end of the BasicData section.
+    """
+    with gzip.open(filename, 'rb') as fh:
+        header = fh.read(PBI_HEADER.size)
+        if len(header) != PBI_HEADER.size:
+            raise PBIError(f"Truncated PBI header in {filename}")
+
+        magic, version, pbi_flags, n_reads = PBI_HEADER.unpack(header)
+        if magic != PBI_MAGIC:
+            raise PBIError(f"{filename} is not a PBI file")
+
+        columns = {}
+        for col, dtype in BASIC_DATA:
+            col_size = np.dtype(dtype).itemsize * n_reads
+            col_bytes = fh.read(col_size)
+            if len(col_bytes) != col_size:
+                raise PBIError(f"Truncated PBI data in {filename}")
+            columns[col] = np.frombuffer(col_bytes, dtype=dtype)
+
+    return pbiindex( version = "{}.{}.{}".format(version >> 16, (version >> 8) & 0xff, version & 0xff),
+                     n_reads = n_reads,
+                     hole_number = columns['hole_number'],
+                     file_offset = columns['file_offset'] )
@@ -1,14 +1,20 @@
 #!/usr/bin/env python3
 
-# Strip some links to files from the consensusreadset.xml what we are processing.
+import sys, re
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
-# 1) load the XML
-# 2) Prune out the pbds:ConsensusReadSet/pbbase:ExternalResources/pbbase:ExternalResource/pbbase:ExternalResources node
-# 3) Rename unbarcoded files to add .all to the filenames
-# 4) Print the result
+from lxml import etree
 
-import sys, re
-import xml.etree.ElementTree as ET
+""" Strip some links to files from the consensusreadset.xml what we are processing.
+
+    1) load the XML
+    2) Prune out the pbds:ConsensusReadSet/pbbase:ExternalResources/pbbase:ExternalResource/pbbase:ExternalResources node
+    3) Rename unbarcoded files to add .all to the filenames
+    4) Print the result
+
+    All the changes are made in a single walk over the tree. Several files may be
+    processed in one go, to save starting Python for every barcode.
+"""
 
 # What to get rid of...
 nsmap = dict( pbbase   = "http://pacificbiosciences.com/PacBioBaseDataModel.xsd",
@@ -23,98 +29,119 @@ prune = [ "pbds:SubreadSet/pbbase:ExternalResources/pbbase:ExternalResource/pbba
           "pbds:ConsensusReadSet/pbbase:ExternalResources/pbbase:ExternalResource/pbbase:ExternalResources",
           "pbds:ConsensusReadSet/pbbase:SupplementalResources"]
 
-def main(fh):
-    tree = ET.parse(fh)
+def parse_args(*args):
+    description = """Remove the links to extra files from consensusreadset.xml files, and
+                     fix the names of the unbarcoded files.
+                  """
+    argparser = ArgumentParser( description=description,
+                                formatter_class = ArgumentDefaultsHelpFormatter )
+    argparser.add_argument("xmlfile", nargs='+',
+                            help="XML files to process.")
+    argparser.add_argument("-o", "--output", action="append",
+                            help="File to write. Give this once for each input file. If not" +
+                                 " given, the result is printed to stdout.")
+
+    return argparser.parse_args(*args)
 
-    for p in prune:
-        remove_path(tree, None, p.split('/'))
+def main(args):
 
-    chop_resourceids(tree.getroot())
+    if not args.output:
+        for xmlfile in args.xmlfile:
+            strip_readset(xmlfile, sys.stdout.buffer)
+        return
 
-    if unbarcoded_file_rename(tree.getroot()):
-        # Now we replace all the pbsample:DNABarcode[s] with pbmeta:DNABarcode[s]
-        meta_ise_barcodes(tree.getroot())
+    if len(args.output) != len(args.xmlfile):
+        exit("The number of --output files must match the number of input files.")
 
-    print('<?xml version="1.0" encoding="utf-8"?>')
-    tree.write(sys.stdout, "unicode")
-    print()
+    for xmlfile, outfile in zip(args.xmlfile, args.output):
+        with open(outfile, 'wb') as ofh:
+            strip_readset(xmlfile, ofh)
 
-def meta_ise_barcodes(elem):
-    """Is this the unassigned file? Then it should look like the unassigned file!!
+def clark(path_step):
+    """Convert "pbbase:Foo" to "{http://pacificbiosciences.com/...}Foo"
     """
-    for bcs_elem in elem.iterfind('.//pbsample:DNABarcodes', nsmap):
-        bcs_elem.tag = f"{{{nsmap['pbmeta']}}}DNABarcodes"
-        for bc_elem in bcs_elem.iterfind('pbsample:DNABarcode', nsmap):
-            bc_elem.tag = f"{{{nsmap['pbmeta']}}}DNABarcode"
+    ns, tn = path_step.split(':')
+    return f"{{{nsmap[ns]}}}{tn}"
 
-def unbarcoded_file_rename(elem):
-    """This is getting even hackier. Walk the whole XML tree and insert .all into the
-       filenames of reads without a barcode name because the pipeline is renaming these files so
-       we need to munge the XML too.
+def strip_readset(xmlfile, ofh):
+    """Load one file, fix it, and write the result to a binary file handle
+    """
+    tree = etree.parse(xmlfile)
 
-       Also, when processing re-demultiplexed reads, the 'unbarcoded' reads are being
-       renamed to 'unassigned', so we need to correct this too.
+    fix_tree(tree.getroot())
+
+    ofh.write(b'<?xml version="1.0" encoding="utf-8"?>\n')
+    ofh.write(etree.tostring(tree.getroot(), encoding='utf-8'))
+    ofh.write(b'\n')
 
-       And don't get me started on the re-demultiplex XML using the wrong tags for the
-       barcodes.
+def fix_tree(root):
+    """Make all the changes to the tree in one go. This is equivalent to what used to
+       be four separate passes:
+
+        remove_path() - remove all nodes matching any of the 'prune' paths
+        chop_resourceids() - if we see a ResourceId attribute that starts with
+                             "../\\w+_reads/" then chop that off
+        unbarcoded_file_rename() - fix up the ResourceId for unbarcoded reads
+        meta_ise_barcodes() - if that found unassigned reads, swap the pbsample:DNABarcode[s]
+                              tags for pbmeta:DNABarcode[s]
     """
+    prune_paths = set( tuple(clark(s) for s in p.split('/')) for p in prune )
+
+    to_prune = []
+    dna_barcodes = []
     unbarcoded_flag = False
 
-    # I could do this on the same pass as chop_resourceids() but I want to keep
-    # my hacks separate.
-    if 'ResourceId' in elem.attrib:
-        elem.attrib['ResourceId'] = re.sub( r"_reads\.bam(?=\.pbi$|$)",
-                                            "_reads.all.bam",
-                                            elem.attrib['ResourceId'] )
-        elem.attrib['ResourceId'] = re.sub( r"_reads\.unbarcoded\.bam(?=\.pbi$|$)",
-                                            "_reads.unassigned.bam",
-                                            elem.attrib['ResourceId'] )
+    # Walk the tree without recursion, tracking the path to each node.
+    stack = [(root, (root.tag,))]
+    while stack:
+        elem, path = stack.pop()
+
+        if 'ResourceId' in elem.attrib:
+            elem.attrib['ResourceId'] = fix_resourceid(elem.attrib['ResourceId'])
+            if re.search(r"_reads\.unassigned\.bam$", elem.attrib['ResourceId']):
+                unbarcoded_flag = True
+
+        if elem.tag == clark("pbsample:DNABarcodes"):
+            dna_barcodes.append(elem)
+
+        for child in elem:
+            if not isinstance(child.tag, str):
+                # Comments and processing instructions
+                continue
+            child_path = path + (child.tag,)
+            if child_path in prune_paths:
+                to_prune.append(child)
+            else:
+                stack.append((child, child_path))
+
+    for elem in to_prune:
+        elem.getparent().remove(elem)
+
+    if unbarcoded_flag:
+        # Is this the unassigned file? Then it should look like the unassigned file!!
+        for bcs_elem in dna_barcodes:
+            bcs_elem.tag = clark("pbmeta:DNABarcodes")
+            for bc_elem in bcs_elem.iterfind('pbsample:DNABarcode', nsmap):
+                bc_elem.tag = clark("pbmeta:DNABarcode")
 
-        if re.search( r"_reads\.unassigned\.bam$",
-                      elem.attrib['ResourceId'] ):
-            unbarcoded_flag = True
+    return unbarcoded_flag
 
-    # Drill down
-    for child in elem:
-        unbarcoded_flag = unbarcoded_file_rename(child) or unbarcoded_flag
+def fix_resourceid(rid):
+    """Fix up a single ResourceId.
 
-    return unbarcoded_flag
+       Chop off any leading "../\\w+_reads/".
 
-def chop_resourceids(elem):
-    r"""Walk the whole XML tree and if we see a ResourceId attribute that
-        starts with "../\w+_reads/" then chop that off.
-     """
-    if 'ResourceId' in elem.attrib:
-        elem.attrib['ResourceId'] = re.sub( r"^\.\./\w+_reads/",
-                                            "",
-                                            elem.attrib['ResourceId'] )
-
-    # Drill down
-    for child in elem:
-        chop_resourceids(child)
-
-def remove_path(pnode, ppnode, path):
-    """Remove all nodes matching the path. For consistency, apply at all levels.
-       We need to track the parent node as ElementTree does not.
+       Then insert .all into the filenames of reads without a barcode name because the
+       pipeline is renaming these files so we need to munge the XML too.
+
+       Also, when processing re-demultiplexed reads, the 'unbarcoded' reads are being
+       renamed to 'unassigned', so we need to correct this too.
     """
+    rid = re.sub(r"^\.\./\w+_reads/", "", rid)
+    rid = re.sub(r"_reads\.bam(?=\.pbi$|$)", "_reads.all.bam", rid)
+    rid = re.sub(r"_reads\.unbarcoded\.bam(?=\.pbi$|$)", "_reads.unassigned.bam", rid)
+
+    return rid
 
-    # Special handling if pnode is actually a document.
-    try:
-        root = pnode.getroot()
-        ns, tn = path[0].split(':')
-        if root.tag != "{{{}}}{}".format(nsmap[ns],tn):
-            # Shtop. Root node name mismatch.
-            return
-        remove_path(root, pnode, path[1:])
-    except AttributeError:
-        # Keep going we're not dealing with a root node.
-        pass
-
-    if not path:
-        # We reached a leaf. Remove it.
-        ppnode.remove(pnode)
-    else:
-        for cnode in pnode.findall(path[0], nsmap):
-            remove_path(cnode, pnode, path[1:])
-
-main(sys.argv[1])
+if __name__ == "__main__":
+    main(parse_args())
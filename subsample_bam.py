@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import os, sys
+import logging as L
+import random
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import numpy as np
+
+from smrtino import bam
+from smrtino.pbi import load_pbi
+from read_survey import write_subsample, DEFAULT_SEED
+
+""" Pick N random reads from a BAM file and output them as FASTA, with any '/' in the
+    read names changed to '_'. This replaces:
+
+      samtools fasta in.bam | seqtk sample - N | sed 's,/,_,g'
+
+    Rather than streaming the whole file, we get the number of reads and the offset
+    of every record from the .pbi index, then seek straight to the chosen records.
+    So the time taken depends on N rather than on the size of the BAM file. The index
+    must be present, as it always is for the BAM files that SMRTLink writes.
+"""
+
+def parse_args(*args):
+    description = """Randomly subsample reads from a BAM file, as FASTA."""
+    argparser = ArgumentParser( description=description,
+                                formatter_class = ArgumentDefaultsHelpFormatter )
+    argparser.add_argument("bamfile",
+                            help="BAM file to read.")
+    argparser.add_argument("-n", "--num_reads", type=int, required=True,
+                            help="Number of reads to pick.")
+    argparser.add_argument("-p", "--pbi",
+                            help="Index file to use. Defaults to the BAM file name + .pbi")
+    argparser.add_argument("-o", "--output",
+                            help="File to write. Defaults to stdout.")
+    argparser.add_argument("--seed", type=int, default=DEFAULT_SEED,
+                            help="Random seed for the subsampling.")
+    argparser.add_argument("-d", "--debug", action="store_true",
+                            help="Print more verbose debugging messages.")
+
+    return argparser.parse_args(*args)
+
+def main(args):
+
+    L.basicConfig(level=(L.DEBUG if args.debug else L.WARNING), stream=sys.stderr)
+
+    pbi_file = args.pbi or (args.bamfile + '.pbi')
+    sub = subsample_with_pbi(args.bamfile, pbi_file, args.num_reads, seed=args.seed)
+
+    if args.output:
+        with open(args.output, 'wb') as ofh:
+            write_subsample(sub, ofh)
+    else:
+        write_subsample(sub, sys.stdout.buffer)
+
+def subsample_with_pbi(bam_file, pbi_file, num_reads, seed=DEFAULT_SEED):
+    """Pick num_reads records at random, using the index to find them. Returns a list
+       of (index, name, seq) in file order, as survey_bam() does.
+    """
+    pbi = load_pbi(pbi_file)
+    L.debug(f"Index {pbi_file} is version {pbi.version} with {pbi.n_reads} reads")
+
+    rng = random.Random(seed)
+    chosen = sorted(rng.sample(range(pbi.n_reads), min(num_reads, pbi.n_reads)))
+
+    res = []
+    with open(bam_file, 'rb') as fh:
+        for i in chosen:
+            record = bam.record_at(fh, int(pbi.file_offset[i]))
+            records, record_len = bam.find_records(record)
+            if record_len != len(record) or len(records.seq_starts) != 1:
+                raise bam.BAMError(f"Index entry {i} does not point to a BAM record")
+
+            name = record[records.name_starts[0]:records.name_ends[0]]
+            seq = bam.decode_seq( np.frombuffer(record, dtype=np.uint8),
+                                  records.seq_starts[0],
+                                  records.seq_lens[0] )
+
+            # Same munging of the names as we used to do with sed
+            res.append((i, name.replace(b'/', b'_'), seq))
+
+    return res
+
+if __name__ == "__main__":
+    main(parse_args())
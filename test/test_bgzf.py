@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""Test the minimal BGZF reader/writer in smrtino/bgzf.py"""
+
+import sys, os, re
+import unittest
+import logging
+import gzip
+from tempfile import mkstemp
+
+DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/hifi_examples')
+VERBOSE = os.environ.get('VERBOSE', '0') != '0'
+
+from smrtino import bgzf
+
+class T(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        #Prevent the logger from printing messages - I like my tests to look pretty.
+        if VERBOSE:
+            logging.getLogger().setLevel(logging.DEBUG)
+        else:
+            logging.getLogger().setLevel(logging.CRITICAL)
+
+        # Make a BGZF version of the example FASTQ
+        with gzip.open(DATA_DIR + '/example_hifi_reads.fastq.gz', 'rb') as fq_fh:
+            cls.fq_bytes = fq_fh.read()
+
+        fd, cls.bgzf_file = mkstemp(suffix='.fastq.gz')
+        with os.fdopen(fd, 'wb') as fh:
+            for n in range(0, len(cls.fq_bytes), 50000):
+                fh.write(bgzf.deflate_block(cls.fq_bytes[n:n+50000]))
+            fh.write(bgzf.EOF_BLOCK)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.bgzf_file)
+
+    def setUp(self):
+        # See the errors in all their glory
+        self.maxDiff = None
+
+    ### THE TESTS ###
+    def test_round_trip(self):
+        """Regular gzip should be able to read what we wrote, and vice versa.
+        """
+        with open(self.bgzf_file, 'rb') as fh:
+            bgzf_data = fh.read()
+
+        self.assertEqual(gzip.decompress(bgzf_data), self.fq_bytes)
+        self.assertEqual(bgzf.deflate_block(b''), bgzf.EOF_BLOCK)
+
+        self.assertTrue(bgzf.is_bgzf(self.bgzf_file))
+        self.assertFalse(bgzf.is_bgzf(DATA_DIR + '/example_hifi_reads.fastq.gz'))
+
+        with open(self.bgzf_file, 'rb') as fh:
+            self.assertEqual(b''.join(bgzf.iter_blocks(fh)), self.fq_bytes)
+
+        for threads in [1, 4]:
+            with open(self.bgzf_file, 'rb') as fh:
+                self.assertEqual(b''.join(bgzf.iter_inflated(fh, threads)), self.fq_bytes)
+
+    def test_split_file(self):
+        """Splitting the file and reading all the parts should get everything back
+           exactly once.
+        """
+        for nparts in [1, 3, 10, 200]:
+            ranges = bgzf.split_file(self.bgzf_file, nparts)
+            self.assertLessEqual(len(ranges), nparts)
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], os.path.getsize(self.bgzf_file))
+
+            with open(self.bgzf_file, 'rb') as fh:
+                parts = [ b''.join(bgzf.iter_blocks(fh, s, e)) for s, e in ranges ]
+            self.assertEqual(b''.join(parts), self.fq_bytes)
+
+    def test_bad_crc(self):
+        block = bytearray(bgzf.deflate_block(b'hello'))
+        block[-5] ^= 1
+
+        with self.assertRaisesRegex(ValueError, "CRC"):
+            bgzf.inflate_block(bytes(block))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,11 +6,64 @@
 import sys, os, re
 import unittest
 import logging
+import json
+from io import StringIO
+from unittest.mock import patch
+from tempfile import TemporaryDirectory
+from zipfile import ZipFile
 
 LIMA_REPORTS = os.path.abspath(os.path.dirname(__file__) + '/lima_reports')
+REVIO_DIR = os.path.abspath(os.path.dirname(__file__) + '/revio_examples/r84140_20250121_143858')
 VERBOSE = os.environ.get('VERBOSE', '0') != '0'
 
-from compile_cell_info import load_lima_counts, summarize_lima_counts
+from compile_cell_info import ( main as compile_cell_info_main, parse_args,
+                                load_lima_counts, summarize_lima_counts,
+                                extract_cell_record, compile_cell_record,
+                                compile_json_reports, load_cell_record,
+                                load_reports_zip )
+
+def attrs(**kwargs):
+    """Make a list of attributes as seen in the JSON reports
+    """
+    return [ dict(id=k.replace('__', '.'), name=k, value=v) for k, v in kwargs.items() ]
+
+# Minimal versions of the reports found in reports.zip
+JSON_REPORTS = dict(
+    raw_data = dict( attributes = attrs( raw_data_report__nbases = 123456789012,
+                                         raw_data_report__nreads = 9876543,
+                                         raw_data_report__read_n50 = 45000,
+                                         raw_data_report__insert_n50 = 20000,
+                                         raw_data_report__unique_molecular_yield = 98765432101 ) ),
+    loading = dict( attributes = attrs( loading_xml_report__productive_zmws = 1000,
+                                        loading_xml_report__productivity_0_n = 300,
+                                        loading_xml_report__productivity_1_n = 650,
+                                        loading_xml_report__productivity_2_n = 50 ) ),
+    ccs = { '_comment': "Generated with pbcommand version 2.4 at 2025-01-22T12:00:00.000000",
+            'attributes': attrs( ccs2__number_of_ccs_reads = 4567890,
+                                 ccs2__total_number_of_ccs_bases = 76543210987,
+                                 ccs2__mean_ccs_readlength = 16757,
+                                 ccs2__median_ccs_readlength = 16001,
+                                 ccs2__median_accuracy = "Q33",
+                                 ccs2__percent_ccs_bases_q30 = 0.9512,
+                                 ccs2__mean_npasses = 11 ),
+            'tables': [ dict( id = 'ccs2.hifi_length_summary',
+                              columns = [ dict( id = 'ccs2.hifi_length_summary.read_length',
+                                                values = ['≥ 0', '≥ 5,000', '≥ 10,000',
+                                                          '≥ 15,000', '≥ 20,000'] ),
+                                          dict( id = 'ccs2.hifi_length_summary.reads_pct',
+                                                values = [100.0, 98.1, 80.25, 51.3, 10.0] ) ] ),
+                        dict( id = 'ccs2.read_quality_summary',
+                              columns = [ dict( id = 'ccs2.read_quality_summary.read_qv',
+                                                values = ['≥ Q20', '≥ Q30', '≥ Q40'] ),
+                                          dict( id = 'ccs2.read_quality_summary.reads_pct',
+                                                values = [100.0, 88.88, 22.22] ) ] ) ] },
+    control = dict( attributes = attrs( control__reads_n = 1234,
+                                        control__readlength_mean = 55555.5,
+                                        control__concordance_mean = 0.91234,
+                                        control__concordance_mode = 0.92 ) ),
+    adapter = dict( attributes = attrs( adapter_xml_report__adapter_dimers = 0.01,
+                                        adapter_xml_report__short_inserts = 0.02,
+                                        adapter_xml_report__local_base_rate_median = 2.5 ) ) )
 
 class T(unittest.TestCase):
 
@@ -46,5 +99,119 @@ class T(unittest.TestCase):
 
         self.assertEqual(lima_summary, expected)
 
+    def test_cell_record(self):
+        """The record can be saved and loaded, and gives the same result as compiling the
+           reports directly.
+        """
+        from smrtino.ParseXML import get_metadata_info2, get_sts_info
+        metadata_xml = get_metadata_info2(f"{REVIO_DIR}/1_C01/metadata/m84140_250121_185015_s3.metadata.xml")
+        sts_xml = get_sts_info(f"{REVIO_DIR}/1_A01/metadata/m84140_250121_144700_s1.sts.xml")
+
+        record = extract_cell_record(JSON_REPORTS, metadata_xml, sts_xml)
+
+        self.assertEqual(record['reports'], list(JSON_REPORTS))
+        self.assertEqual(record['attributes']['ccs2.mean_npasses'], 11)
+        self.assertEqual(record['columns']['ccs2.read_quality_summary.read_qv'], ['≥ Q20', '≥ Q30', '≥ Q40'])
+
+        # JSON round trip
+        with TemporaryDirectory() as tmp_dir:
+            with open(f"{tmp_dir}/record.json", "w") as fh:
+                json.dump(record, fh)
+            loaded = load_cell_record(f"{tmp_dir}/record.json")
+
+            with open(f"{tmp_dir}/record.json", "w") as fh:
+                json.dump(dict(record, version=0), fh)
+            with self.assertRaises(RuntimeError):
+                load_cell_record(f"{tmp_dir}/record.json")
+
+        self.assertEqual(loaded, record)
+
+        res = compile_cell_record(loaded)
+        self.assertEqual(res, compile_json_reports(JSON_REPORTS, metadata_xml, sts_xml))
+
+        self.assertEqual(res['cell_id'], 'm84140_250121_185015_s3')
+        self.assertEqual(res['reports']['Raw Data']['Polymerase Read Bases (Gb)'], '123.5')
+        self.assertEqual(res['reports']['Loading']['P1 %'], '65.00')
+        self.assertEqual(res['reports']['HiFi Length %']['≥ 15,000 bp'], '51.3')
+        self.assertEqual(res['reports']['Hifi Quality %']['≥ Q40'], '22.2')
+        self.assertEqual(res['reports']['Barcodes']['CV'], 'N/A')
+        self.assertEqual(res['reports']['Control']['Control Read Length Mean'], '55556')
+        self.assertEqual(res['reports']['Adapter']['Local Base Rate'], '2.19')
+        self.assertEqual(res['reports']['Dataset']['Data created'], '2025-01-22')
+
+        # Without the sts.xml or the tables
+        ccs_no_tables = { k: v for k, v in JSON_REPORTS['ccs'].items() if k != 'tables' }
+        res = compile_cell_record(extract_cell_record( dict(JSON_REPORTS, ccs=ccs_no_tables),
+                                                       metadata_xml ))
+        self.assertEqual(res['reports']['Adapter']['Local Base Rate'], '2.50')
+        self.assertEqual(res['reports']['HiFi Length %'], {'all': "missing table in JSON"})
+
+        # But a missing row in a table is an error, not a missing table
+        ccs_bad_row = json.loads(json.dumps(JSON_REPORTS['ccs'], ensure_ascii=False).replace('≥ 5,000', '≥ 5000'))
+        with self.assertRaises(KeyError):
+            compile_cell_record(extract_cell_record( dict(JSON_REPORTS, ccs=ccs_bad_row),
+                                                     metadata_xml ))
+
+    def test_load_reports_zip(self):
+        """Only the reports we want are loaded, and missing ones are skipped
+        """
+        with TemporaryDirectory() as tmp_dir:
+            with ZipFile(f"{tmp_dir}/reports.zip", "w") as zfh:
+                zfh.writestr("ccs.report.json", json.dumps(JSON_REPORTS['ccs']))
+                zfh.writestr("loading.report.json", json.dumps(JSON_REPORTS['loading']))
+                zfh.writestr("control.report.json", json.dumps(dict(attributes=[])))
+                zfh.writestr("ccs_plot.png", b"\x89PNG" + bytes(100000))
+            with open(f"{tmp_dir}/control.report.json", "w") as fh:
+                json.dump(JSON_REPORTS['control'], fh)
+
+            # raw_data and adapter are missing, and the PNG is ignored
+            reports = load_reports_zip(dict(reports_zip=f"{tmp_dir}/reports.zip"))
+            self.assertEqual(sorted(reports), ['ccs', 'control', 'loading'])
+            self.assertEqual(reports['ccs'], JSON_REPORTS['ccs'])
+            self.assertEqual(reports['loading'], JSON_REPORTS['loading'])
+
+            # Now override a report with a file
+            reports = load_reports_zip(dict( reports_zip = f"{tmp_dir}/reports.zip",
+                                             control_report = f"{tmp_dir}/control.report.json" ))
+            self.assertEqual(len(reports), 3)
+            self.assertEqual(reports['control'], JSON_REPORTS['control'])
+
+            # Or with no zip at all
+            reports = load_reports_zip(dict( control_report = f"{tmp_dir}/control.report.json" ))
+            self.assertEqual(reports, dict(control=JSON_REPORTS['control']))
+
+    def test_main_record(self):
+        """Running with --make_record then --record gives the same as running directly.
+        """
+        with TemporaryDirectory() as tmp_dir:
+            with ZipFile(f"{tmp_dir}/reports.zip", "w") as zfh:
+                for r, report in JSON_REPORTS.items():
+                    zfh.writestr(f"{r}.report.json", json.dumps(report))
+
+            file_args = [ '--reports_zip', f"{tmp_dir}/reports.zip",
+                          '--metaxml', f"{REVIO_DIR}/1_C01/metadata/m84140_250121_185015_s3.metadata.xml",
+                          '--stsxml', f"{REVIO_DIR}/1_A01/metadata/m84140_250121_144700_s1.sts.xml",
+                          '--lima_counts', f"{LIMA_REPORTS}/hifi_reads.lima_counts.txt" ]
+
+            with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+                compile_cell_info_main(parse_args(file_args))
+            direct_yaml = mock_stdout.getvalue()
+
+            with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+                compile_cell_info_main(parse_args(file_args + ['--make_record']))
+            with open(f"{tmp_dir}/record.json", "w") as fh:
+                fh.write(mock_stdout.getvalue())
+
+            with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+                compile_cell_info_main(parse_args(['--record', f"{tmp_dir}/record.json"]))
+            record_yaml = mock_stdout.getvalue()
+
+            with self.assertRaises(SystemExit):
+                compile_cell_info_main(parse_args( ['--record', f"{tmp_dir}/record.json"] +
+                                                   file_args[:2] ))
+
+        self.assertIn("Assigned Reads (%): '99.59'", direct_yaml)
+        self.assertEqual(record_yaml, direct_yaml)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""Test the count_dust script"""
+
+import sys, os, re
+import unittest
+import logging
+from io import BytesIO, StringIO
+from unittest.mock import NonCallableMock, patch
+from textwrap import dedent as dd
+
+VERBOSE = os.environ.get('VERBOSE', '0') != '0'
+
+from count_dust import main as count_dust_main, parse_args, read_fasta, count_masked, count_intervals
+
+# What dustmasker might make from the original sequences
+ORIG_FASTA = dd("""\
+    >m64175e_210423_165649/49/ccs
+    ACGTACGTACGTAAAAAAAAAAAAAAAAAAAAACGTNNACGT
+    ACGTACGT
+    >m64175e_210423_165649/51/ccs
+    ACGTTTGCAGCA
+    >m64175e_210423_165649/53/ccs
+    NNNN
+    """).encode()
+
+MASKED_FASTA = dd("""\
+    >lcl|m64175e_210423_165649/49/ccs
+    ACGTACGTACGTaaaaaaaaaaaaaaaaaaaaacgtnnACGT
+    ACgtacgt
+    >lcl|m64175e_210423_165649/51/ccs
+    ACGTTTGCAGCA
+    >lcl|m64175e_210423_165649/53/ccs
+    NNNN
+    """).encode()
+
+INTERVALS = dd("""\
+    >lcl|m64175e_210423_165649/49/ccs
+    12 - 37
+    44 - 49
+    >lcl|m64175e_210423_165649/51/ccs
+    >lcl|m64175e_210423_165649/53/ccs
+    """).encode()
+
+class T(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        #Prevent the logger from printing messages - I like my tests to look pretty.
+        if VERBOSE:
+            logging.getLogger().setLevel(logging.DEBUG)
+        else:
+            logging.getLogger().setLevel(logging.CRITICAL)
+
+    ### THE TESTS ###
+    def test_masked(self):
+        """Counting the masked FASTA
+        """
+        self.assertEqual( list(count_masked(read_fasta(BytesIO(MASKED_FASTA)))),
+                          [ ('m64175e_210423_165649/49/ccs', 18, 30),
+                            ('m64175e_210423_165649/51/ccs', 12, 0),
+                            ('m64175e_210423_165649/53/ccs', 0, 0) ] )
+
+    def test_intervals(self):
+        """The intervals should give the same counts
+        """
+        self.assertEqual( list(count_intervals( BytesIO(INTERVALS),
+                                                read_fasta(BytesIO(ORIG_FASTA)) )),
+                          list(count_masked(read_fasta(BytesIO(MASKED_FASTA)))) )
+
+        # But not if the sequences are in the wrong order
+        with self.assertRaises(RuntimeError):
+            list(count_intervals( BytesIO(INTERVALS),
+                                  read_fasta(BytesIO(ORIG_FASTA.replace(b'/49/', b'/50/'))) ))
+
+    def test_main(self):
+        """Check the COV output
+        """
+        mock_stdin = NonCallableMock(buffer=BytesIO(MASKED_FASTA))
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            with patch('sys.stdin', mock_stdin):
+                count_dust_main(parse_args([]))
+
+        self.assertEqual( mock_stdout.getvalue(),
+                          dd("""\
+                                ## count_dust v0.0
+                                ## Total Reads = 10000
+                                ## Mapped Reads = 10000
+                                ## Unmapped Reads = 0
+                                # contig_id\tread_cov\tbase_cov
+                                m64175e_210423_165649/49/ccs\t1\t0.237
+                                m64175e_210423_165649/51/ccs\t1\t316.228
+                                m64175e_210423_165649/53/ccs\t1\t0.003
+                             """) )
+
+if __name__ == '__main__':
+    unittest.main()
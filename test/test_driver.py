@@ -85,11 +85,12 @@ class T(unittest.TestCase):
 
         self.bm.cleanup()
 
-    def bm_rundriver(self, expected_retval=0, check_stderr=True):
+    def bm_rundriver(self, expected_retval=0, check_stderr=True, runs=()):
         """A convenience wrapper around self.bm.runscript that sets the environment
            appropriately and runs DRIVER and returns STDOUT split into an array.
+           If runs are given, these are passed to DRIVER.
         """
-        retval = self.bm.runscript(DRIVER, set_path=False, env=self.environment)
+        retval = self.bm.runscript([DRIVER, *runs], set_path=False, env=self.environment)
 
         #Where a file is missing it's always useful to see the error.
         #(status 127 is the standard shell return code for a command not found)
@@ -252,6 +253,18 @@ class T(unittest.TestCase):
         # And the list of reports uploaded should be empty
         self.assertEqual(0, os.path.getsize(f"{self.to_path}/pbpipeline/report_upload_url.txt"))
 
+    def test_named_run(self):
+        """If runs are given on the command line, the driver should just look at those.
+        """
+        self.copy_run("r84140_20231018_154254")
+        self.copy_run("r84140_20231030_134730")
+
+        self.bm_rundriver(runs=["r84140_20231030_134730"])
+
+        self.assertInStdout("r84140_20231030_134730", "NEW")
+        self.assertNotInStdout("r84140_20231018_154254")
+        self.assertTrue(os.path.isdir(self.to_path + '/pbpipeline'))
+
     def test_in_pipeline(self):
         """ Run is already processing, nothing to do
         """
@@ -415,6 +428,43 @@ class T(unittest.TestCase):
         for r in "report.started report.done".split():
             self.assertFalse(os.path.exists(f"{self.to_path}/pbpipeline/{r}"))
 
+    def test_process_run_claimed(self):
+        """ If another driver claims the cell while we wait for the lock, we should leave
+            it alone.
+        """
+        test_data = self.copy_run("r84140_20231018_154254")
+        self.bm_rundriver()
+
+        self.bm.add_mock('flock', side_effect=f"touch {self.to_path}/pbpipeline/1_D01.started")
+        self.bm_rundriver()
+
+        self.assertInStdout(self.run_name, "All the cells were claimed by another driver")
+        self.assertEqual(self.bm.last_calls['flock'], [['-w', '300', '7']])
+        self.assertEqual(self.bm.last_calls['Snakefile.process_cells'], [])
+        self.assertEqual(self.bm.last_calls['rt_runticket_manager.py'], [])
+
+    def test_process_run_no_flock(self):
+        """ If flock is not supported by the filesystem, the cells and the report are
+            claimed with noclobber touch files, as they used to be.
+        """
+        test_data = self.copy_run("r84140_20231018_154254")
+        check_call(["touch", f"{self.from_path}/1_C01/metadata/m84140_231018_155043_s3.transferdone"])
+        check_call(["touch", f"{self.from_path}/1_D01/metadata/m84140_231018_162059_s4.transferdone"])
+        self.bm_rundriver()
+
+        # flock(1) exits with EX_OSERR for ENOLCK
+        self.bm.add_mock('flock', side_effect="exit 71")
+        self.bm_rundriver()
+
+        self.assertInStdout("flock failed with status 71")
+        self.assertNotInStdout("claimed by another driver")
+        for cell in "1_C01 1_D01".split():
+            self.assertTrue(os.path.exists(f"{self.to_path}/pbpipeline/{cell}.done"))
+        self.assertEqual(self.bm.last_calls["Snakefile.report"],
+                         [ ["-R", "make_report",
+                            '--config', "cells=1_C01 1_D01", "sc_data=sc_data.DATE.XXX.yaml",
+                            "-p", "report_main"] ])
+
     def test_process_run_ok(self):
         """ Test processing a run when the cells are ready
         """
@@ -7,11 +7,20 @@
 import sys, os, re
 import unittest
 import logging
+import gzip
+import struct
+from io import BytesIO
+from unittest.mock import patch
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 
 DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/sample_fasta')
+HIFI_DIR = os.path.abspath(os.path.dirname(__file__) + '/hifi_examples')
 VERBOSE = os.environ.get('VERBOSE', '0') != '0'
 
-from fasta_stats import read_fasta, fasta_to_histo, histo_to_result, fastaline
+from fasta_stats import ( read_fasta, read_bam, fasta_to_histo, histo_to_result, fastaline,
+                          save_histo, merge_histos )
+from smrtino import bgzf
+from smrtino.bam import SEQ_CODES
 
 class T(unittest.TestCase):
 
@@ -24,22 +33,42 @@ class T(unittest.TestCase):
             logging.getLogger().setLevel(logging.CRITICAL)
 
     def load_fasta(self, filename):
-        with open(os.path.join(DATA_DIR, filename + '.fasta')) as fh:
+        with open(os.path.join(DATA_DIR, filename + '.fasta'), 'rb') as fh:
             return list(read_fasta(fh))
 
     def load_histo(self, filename):
-        with open(os.path.join(DATA_DIR, filename + '.fasta')) as fh:
+        with open(os.path.join(DATA_DIR, filename + '.fasta'), 'rb') as fh:
             return fasta_to_histo(read_fasta(fh))
 
+    def write_bam(self, fh, seqs):
+        """Write a minimal unaligned BAM file with the given sequences
+        """
+        data = b'BAM\x01' + struct.pack('<ii', 0, 0)
+        for n, seq in enumerate(seqs):
+            name = 'read{}\0'.format(n).encode()
+            packed = bytes( (SEQ_CODES.index(seq[i]) << 4) +
+                            (SEQ_CODES.index(seq[i+1]) if i+1 < len(seq) else 0)
+                            for i in range(0, len(seq), 2) )
+            record = ( struct.pack( '<iiBBHHHiiii', -1, -1, len(name), 255, 4680, 0, 4,
+                                    len(seq), -1, -1, 0 ) +
+                       name + packed + b'\xff' * len(seq) )
+            data += struct.pack('<i', len(record)) + record
+
+        for n in range(0, len(data), 30000):
+            fh.write(bgzf.deflate_block(data[n:n+30000]))
+        fh.write(bgzf.EOF_BLOCK)
+        fh.flush()
+
     ### THE TESTS ###
     def test_empty(self):
         """Test loading the empty file.
         """
         self.assertEqual(self.load_fasta('empty'), [])
 
-        self.assertEqual(self.load_histo('empty'), [])
+        empty_histo = self.load_histo('empty')
+        self.assertEqual([ len(a) for a in empty_histo ], [0, 0, 0])
 
-        self.assertEqual(dict(histo_to_result([])),
+        self.assertEqual(dict(histo_to_result(empty_histo)),
                             { '_headings': [ 'Min read length',
                                              'Max read length',
                                              'Reads',
@@ -56,7 +85,7 @@ class T(unittest.TestCase):
                               'GC %': 0.0,
                               'Mean length': 0.0 } )
 
-        self.assertEqual(dict(histo_to_result([], headings=False)),
+        self.assertEqual(dict(histo_to_result(empty_histo, headings=False)),
                             { 'Max read length': -1,
                               'Min read length': 0,
                               'non-N bases': 0,
@@ -67,6 +96,56 @@ class T(unittest.TestCase):
                               'Mean length': 0.0 } )
 
 
+    def test_trim_n(self):
+        """N's are trimmed from the ends of each line, and lower case counts the same
+        """
+        fasta = b'>a\nNNAcgTNn\nNAC \n>b\nnnnn\n>c\nNANNNG\r\n'
+
+        self.assertEqual( list(read_fasta(BytesIO(fasta))),
+                          [ fastaline(11, 3, 3), fastaline(4, 0, 0), fastaline(6, 1, 1) ] )
+        self.assertEqual( list(read_fasta(BytesIO(fasta), trim_n=True)),
+                          [ fastaline(6, 3, 3), fastaline(0, 0, 0), fastaline(5, 1, 1) ] )
+
+    def test_histo(self):
+        """The histogram is three arrays indexed by read length
+        """
+        histo = self.load_histo('foo3')
+
+        self.assertEqual( histo.tally.tolist(), [0, 0, 0, 0, 0, 2, 0, 0, 0, 0, 1] )
+        self.assertEqual( histo.at_bases.tolist(), [0, 0, 0, 0, 0, 10, 0, 0, 0, 0, 10] )
+        self.assertEqual( histo.gc_bases.tolist(), [0] * 11 )
+
+        # Adding the reads in small batches should make no difference
+        with patch('fasta_stats.BATCHSIZE', 2):
+            histo2 = self.load_histo('foo3')
+        self.assertEqual( [ a.tolist() for a in histo2 ], [ a.tolist() for a in histo ] )
+
+        # Cutoffs beyond the longest read
+        res = histo_to_result(histo, cutoffs=[11, 1000])
+        self.assertEqual( res['Reads >=11'], 0 )
+        self.assertEqual( res['N50 for reads >=1000'], 10 )
+        self.assertEqual( res['Mean length for reads >=1000'], 0.0 )
+
+    def test_merge(self):
+        """Saving histograms and merging them should be the same as reading all the
+           sequences at once.
+        """
+        all_fasta = b''
+        with TemporaryDirectory() as tmp_dir:
+            npz_files = []
+            for f in ['foo', 'foo1', 'foo2', 'foo5', 'empty']:
+                with open(os.path.join(DATA_DIR, f + '.fasta'), 'rb') as fh:
+                    all_fasta += fh.read()
+                npz_files.append(os.path.join(tmp_dir, f + '.npz'))
+                save_histo(self.load_histo(f), npz_files[-1])
+
+            merged = merge_histos(npz_files)
+
+        expected = fasta_to_histo(read_fasta(BytesIO(all_fasta)))
+        self.assertEqual( [ a.tolist() for a in merged ], [ a.tolist() for a in expected ] )
+        self.assertEqual( histo_to_result(merged, cutoffs=[0, 5]),
+                          histo_to_result(expected, cutoffs=[0, 5]) )
+
     def test_simplestats(self):
         """Test on the foo3.fasta sample file
         """
@@ -106,6 +185,30 @@ class T(unittest.TestCase):
         self.assertEqual( res4['N50 for reads >=6'], 9 )
         self.assertEqual( histo_to_result(self.load_histo('foo5'))['N50'], 11 )
 
+    def test_bam(self):
+        """Reading a BAM file should give the same answer as reading the equivalent
+           FASTA file.
+        """
+        with gzip.open(HIFI_DIR + '/example_hifi_reads.fastq.gz', 'rt') as fh:
+            seqs = [ l.rstrip('\n') for l in fh ][1::4]
+        seqs.extend(['', 'N', 'NNACGTNN', 'ACGTA', 'NACGNA', 'GCGCGNNN', ''])
+
+        fasta = ''.join( '>read{}\n{}\n'.format(n, s) for n, s in enumerate(seqs) )
+
+        for trim_n in [False, True]:
+            fasta_lines = list(read_fasta(BytesIO(fasta.encode()), trim_n=trim_n))
+
+            with NamedTemporaryFile(suffix='.bam') as tmp_fh:
+                self.write_bam(tmp_fh, seqs)
+                for threads in [1, 3]:
+                    self.assertEqual( list(read_bam(tmp_fh.name, trim_n=trim_n, threads=threads)),
+                                      fasta_lines )
+
+        # And an empty file
+        with NamedTemporaryFile(suffix='.bam') as tmp_fh:
+            self.write_bam(tmp_fh, [])
+            self.assertEqual( list(read_bam(tmp_fh.name)), [] )
+
     def test_10000(self):
         """Look at the file which is a subsample of some real PacBio data.
         """
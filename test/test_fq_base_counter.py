@@ -8,13 +8,15 @@ import unittest
 import logging
 import gzip
 from unittest.mock import NonCallableMock, patch
-from io import StringIO
+from io import StringIO, BytesIO
 from textwrap import dedent as dd
+from tempfile import NamedTemporaryFile
 
 DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/hifi_examples')
 VERBOSE = os.environ.get('VERBOSE', '0') != '0'
 
-from fq_base_counter import main as fq_base_counter_main
+from fq_base_counter import main as fq_base_counter_main, scan_fh, scan_fq
+from smrtino import bgzf
 
 class NoneMock(NonCallableMock):
     """A Mock where fetching undefined attributes returns None,
@@ -68,6 +70,77 @@ class T(unittest.TestCase):
         with open(DATA_DIR + '/example_hifi_reads.fastq.count') as fh:
             self.compare_files( fh, mock_stdout )
 
+    def test_small_blocks(self):
+        """Reads will be split across blocks. Check we always get the same answer,
+           whichever way the line ends are found.
+        """
+        with gzip.open(DATA_DIR + '/example_hifi_reads.fastq.gz', 'rb') as fq_fh:
+            fq_bytes = fq_fh.read()
+
+        expected = dict( total_reads = 200,
+                         min_read_len = 9764,
+                         max_read_len = 25524,
+                         total_bases = 3027642,
+                         n_bases = 0 )
+
+        for blocksize in [7, 1000, 12345, 1024*1024]:
+            with patch('fq_base_counter.LONG_LINE', 0):
+                self.assertEqual( scan_fh(BytesIO(fq_bytes), blocksize), expected )
+            with patch('fq_base_counter.LONG_LINE', 1e9):
+                self.assertEqual( scan_fh(BytesIO(fq_bytes), blocksize), expected )
+
+        # And with some N's added, and no newline at the end
+        fq_bytes = fq_bytes.replace(b'ACGTA', b'ACNNA').rstrip(b'\n')
+        expected['n_bases'] = 2 * fq_bytes.count(b'ACNNA')
+        self.assertEqual( scan_fh(BytesIO(fq_bytes), 1000), expected )
+
+    def test_bgzf_jobs(self):
+        """Test that splitting a BGZF file between several processes gets the expected
+           result.
+        """
+        with gzip.open(DATA_DIR + '/example_hifi_reads.fastq.gz', 'rb') as fq_fh:
+            fq_bytes = fq_fh.read()
+
+        with NamedTemporaryFile(suffix='.fastq.gz') as tmp_fh:
+            for n in range(0, len(fq_bytes), 20000):
+                tmp_fh.write(bgzf.deflate_block(fq_bytes[n:n+20000]))
+            tmp_fh.write(bgzf.EOF_BLOCK)
+            tmp_fh.flush()
+
+            mock_args = NoneMock( infile = [tmp_fh.name], jobs = 3 )
+            with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+                fq_base_counter_main(mock_args)
+
+        mock_stdout.seek(0)
+        with open(DATA_DIR + '/example_hifi_reads.fastq.count') as fh:
+            self.compare_files( [ l.replace('example_hifi_reads', os.path.basename(tmp_fh.name)[:-9])
+                                  for l in fh ],
+                                mock_stdout )
+
+    def test_quals(self):
+        """Test the quality counts against a simple pure-Python calculation, for both the
+           serial and the BGZF code paths.
+        """
+        with gzip.open(DATA_DIR + '/example_hifi_reads.fastq.gz', 'rb') as fq_fh:
+            fq_bytes = fq_fh.read()
+
+        qual_lines = fq_bytes.split(b'\n')[3::4]
+        expected = { f'q{q}_bases': sum(1 for l in qual_lines for b in l if b >= 33 + q)
+                     for q in [20, 30, 40] }
+        mean_qvs = [ (sum(l) - 33 * len(l)) // len(l) for l in qual_lines ]
+        expected['read_qv_histo'] = [ mean_qvs.count(qv) for qv in range(max(mean_qvs) + 1) ]
+
+        res = scan_fh(BytesIO(fq_bytes), blocksize=12345, quals=True)
+        self.assertEqual( { k: res[k] for k in expected }, expected )
+
+        with NamedTemporaryFile(suffix='.fastq.gz') as tmp_fh:
+            for n in range(0, len(fq_bytes), 20000):
+                tmp_fh.write(bgzf.deflate_block(fq_bytes[n:n+20000]))
+            tmp_fh.write(bgzf.EOF_BLOCK)
+            tmp_fh.flush()
+
+            self.assertEqual( scan_fq(tmp_fh.name, jobs=3, quals=True), res )
+
     def test_empty(self):
         """Test that reading a zer-line file still produces a reasonable result.
         """
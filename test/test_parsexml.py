@@ -3,8 +3,13 @@
 import unittest
 import sys, os
 import glob
+import shutil
+import json
 from pprint import pprint
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
 import logging as L
+import xml.etree.ElementTree as ET
 
 DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/revio_examples')
 DATA_DIR_OUT = os.path.abspath(os.path.dirname(__file__) + '/revio_out_examples')
@@ -14,7 +19,10 @@ L.basicConfig(level=(L.DEBUG if VERBOSE else L.ERROR))
 
 from smrtino.ParseXML import ( get_metadata_summary, get_metadata_info, get_metadata_info2,
                                get_sts_info, get_readset_info,
-                               _get_automation_parameters, _get_cellpac, _load_xml )
+                               _get_automation_parameters, _get_cellpac, _load_xml,
+                               _sidecar_name, _spec_key, SIDECAR_VERSION, _xml_cache,
+                               _get_fields, _METADATA_FIELDS,
+                               xmlfield, _text, _ns )
 
 # The three functions are:
 #  get_metadata_summary() - need to read the unmodified metadata files
@@ -83,18 +91,18 @@ class T(unittest.TestCase):
            Note that these come from two namespaces, but the names are all unique
            so we just merge them.
         """
-        root = _load_xml(revio_meta_xml[0])
+        xf = _get_fields(revio_meta_xml[0], _METADATA_FIELDS)
 
-        aps = _get_automation_parameters(root)
+        aps = _get_automation_parameters(xf)
 
         self.assertEqual(len(aps), 32)
 
     def test_get_cellpac(self):
         """Test we can get the CellPac element attribs
         """
-        root = _load_xml(revio_meta_xml[0])
+        xf = _get_fields(revio_meta_xml[0], _METADATA_FIELDS)
 
-        cellpac = _get_cellpac(root)
+        cellpac = _get_cellpac(xf)
 
         self.assertEqual(len(cellpac), 9)
 
@@ -310,6 +318,125 @@ class T(unittest.TestCase):
 
         self.assertEqual( get_readset_info( smrtlink_13_rs[1],  smrtlink_base='XXX')['_link'],
                           'XXX/sl/data-management/dataset-detail/cd81e8fd-86f7-4b24-9a9e-24b2af3413d1?type=ccsreads' )
+    def test_load_xml_cache(self):
+        """The same file should only be parsed once, unless it changes
+        """
+        with TemporaryDirectory() as tmp_dir:
+            xml_copy = shutil.copy(revio_meta_xml[0], tmp_dir)
+
+            root1 = _load_xml(xml_copy)
+            self.assertIs(_load_xml(xml_copy), root1)
+
+            # Same size but a new mtime
+            os.utime(xml_copy, ns=(0, 0))
+            root2 = _load_xml(xml_copy)
+            self.assertIsNot(root2, root1)
+            self.assertEqual(ET.tostring(root2), ET.tostring(root1))
+
+    def test_get_fields(self):
+        """The single pass through the file should find the same things as searching
+           the whole tree.
+        """
+        root = _load_xml(revio_meta_xml[0])
+        xf = _get_fields(revio_meta_xml[0], _METADATA_FIELDS)
+
+        self.assertEqual(xf.tag, root.tag)
+        self.assertEqual(xf.attrib, root.attrib)
+        for k, path in [ ('cellpac', 'pbmeta:CellPac'),
+                         ('runs_run', 'pbmodel:Runs/pbmodel:Run'),
+                         ('model_run', 'pbmodel:Run') ]:
+            self.assertEqual(xf.fields[k], root.find(f'.//{path}', _ns).attrib)
+        self.assertEqual( xf.fields['meta_aps'],
+                          [ e.attrib for e in root.findall('.//pbmeta:AutomationParameter', _ns) ] )
+        self.assertEqual( xf.fields['insert_size'],
+                          int(root.find('.//pbmeta:InsertSize', _ns).text) )
+        self.assertEqual( xf.fields['sample_barcodes'], ['bc1002--bc1002'] )
+
+        # The result is cached, so the other get_metadata_*() functions don't go
+        # back to the file.
+        with patch('smrtino.ParseXML._walk_fields', side_effect=RuntimeError):
+            self.assertIs(_get_fields(revio_meta_xml[0], _METADATA_FIELDS), xf)
+            get_metadata_info(revio_meta_xml[0])
+            get_metadata_summary(revio_meta_xml[0])
+
+    def test_get_fields_early_stop(self):
+        """If we only want the first of each thing, reading should stop once they are
+           found. The utf-16 header should still be fixed.
+        """
+        with TemporaryDirectory() as tmp_dir:
+            with open(f"{tmp_dir}/foo.xml", "w") as fh:
+                print('<?xml version="1.0" encoding="utf-16"?>', file=fh)
+                print(f'<pbps:PipeStats xmlns:pbps="{_ns["pbps"]}" xmlns:pbbase="{_ns["pbbase"]}">', file=fh)
+                print('<pbps:Foo><pbps:AdapterDimerFraction>0.005</pbps:AdapterDimerFraction></pbps:Foo>', file=fh)
+                print('<pbps:LocalBaseRateDist><pbbase:SampleMed>2.5</pbbase:SampleMed></pbps:LocalBaseRateDist>', file=fh)
+                print('<pbps:Bar>' * 10000, file=fh)
+                print('<pbps:ShortInsertFraction>0.0025</pbps:ShortInsertFraction>', file=fh)
+                # And the file is truncated
+
+            self.assertEqual( get_sts_info(f"{tmp_dir}/foo.xml"),
+                              { 'local_base_rate_median': 2.5,
+                                'adapter_dimers': 0.5,
+                                'short_inserts': 0.25 } )
+
+            # But if we want all of them we have to read to the end
+            with self.assertRaises(ET.ParseError):
+                _get_fields( f"{tmp_dir}/foo.xml",
+                             dict(sif = xmlfield('pbps:ShortInsertFraction', _text, every=True)) )
+
+    def test_sidecar(self):
+        """With SMRTINO_XML_SIDECAR set to a directory the raw fields are saved there,
+           and loaded from there next time.
+        """
+        with TemporaryDirectory() as tmp_dir:
+            xml_copy = shutil.copy(revio_meta_xml[0], tmp_dir)
+            sc_dir = f"{tmp_dir}/sidecars"
+            sidecar = _sidecar_name(xml_copy, sc_dir)
+            self.assertEqual(os.path.dirname(sidecar), sc_dir)
+            self.assertRegex( os.path.basename(sidecar),
+                              r"^m84140_231018_155043_s3\.metadata\.xml\.[0-9a-f]{12}\.fields\.json$" )
+
+            # Off by default
+            expected = get_metadata_info2(xml_copy)
+            self.assertFalse(os.path.exists(sc_dir))
+
+            with patch.dict(os.environ, {'SMRTINO_XML_SIDECAR': sc_dir}), \
+                 patch.dict('smrtino.ParseXML._xml_cache', clear=True):
+                self.assertEqual(get_metadata_info2(xml_copy), expected)
+                with open(sidecar) as sfh:
+                    sc_data = json.load(sfh)
+                self.assertEqual(sc_data['version'], SIDECAR_VERSION)
+                self.assertEqual(list(sc_data['fields']), [_spec_key(_METADATA_FIELDS)])
+
+                # Now we can read it without parsing the XML, and the warnings still happen
+                _xml_cache.clear()
+                with patch('smrtino.ParseXML._walk_fields', side_effect=RuntimeError):
+                    with self.assertLogs(level='WARNING'):
+                        self.assertEqual(get_metadata_info2(xml_copy), expected)
+                    # get_metadata_info uses the same fields
+                    get_metadata_info(xml_copy)
+
+                # But not if the XML changes
+                _xml_cache.clear()
+                os.utime(xml_copy, ns=(0, 0))
+                with patch('smrtino.ParseXML._walk_fields', side_effect=RuntimeError):
+                    with self.assertRaises(RuntimeError):
+                        get_metadata_info2(xml_copy)
+
+                # Or if the sidecar is from a different version of the code
+                _xml_cache.clear()
+                get_metadata_info2(xml_copy)
+                _xml_cache.clear()
+                with patch('smrtino.ParseXML.SIDECAR_VERSION', SIDECAR_VERSION + 1), \
+                     patch('smrtino.ParseXML._walk_fields', side_effect=RuntimeError):
+                    with self.assertRaises(RuntimeError):
+                        get_metadata_info2(xml_copy)
+
+                # Nothing is written next to the XML, no temp files are left behind, and
+                # the sidecar is as readable as the XML
+                self.assertCountEqual(os.listdir(tmp_dir), [os.path.basename(xml_copy), 'sidecars'])
+                self.assertEqual(os.listdir(sc_dir), [os.path.basename(sidecar)])
+                self.assertEqual( os.stat(sidecar).st_mode & 0o777,
+                                  os.stat(xml_copy).st_mode & 0o666 )
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+"""Test the pb_driver script"""
+
+import sys, os, re
+import unittest
+import logging
+from shutil import copytree
+from unittest.mock import patch
+from tempfile import TemporaryDirectory
+
+VERBOSE = os.environ.get('VERBOSE', '0') != '0'
+
+from pb_driver import main as pb_driver_main, parse_args, plan_jobs
+
+DATA_DIR = os.path.abspath(os.path.dirname(__file__))
+
+class T(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        #Prevent the logger from printing messages - I like my tests to look pretty.
+        if VERBOSE:
+            logging.getLogger().setLevel(logging.DEBUG)
+        else:
+            logging.getLogger().setLevel(logging.CRITICAL)
+
+    def setUp(self):
+        self.tmp_obj = TemporaryDirectory()
+        self.tmp_dir = self.tmp_obj.name
+
+        self.from_dir = os.path.join(self.tmp_dir, 'from')
+        self.to_dir = os.path.join(self.tmp_dir, 'to')
+        os.mkdir(self.from_dir)
+        os.mkdir(self.to_dir)
+
+        self.environ_sh = os.path.join(self.tmp_dir, 'environ.sh')
+        with open(self.environ_sh, 'w') as fh:
+            print(f"FROM_LOCATION={self.from_dir}", file=fh)
+            print(f"TO_LOCATION={self.to_dir}", file=fh)
+            print("STATUS_INDEX=''", file=fh)
+
+        # The fake driver logs when it starts and finishes
+        self.driver = os.path.join(self.tmp_dir, 'driver.sh')
+        self.driver_log = os.path.join(self.tmp_dir, 'driver.log')
+        with open(self.driver, 'w') as fh:
+            print( "#!/bin/sh",
+                   f"echo start $* >> {self.driver_log}",
+                   "sleep ${DRIVER_SLEEP:-0}",
+                   f"echo end $* >> {self.driver_log}",
+                   "[ \"$1\" != fail ]",
+                   sep = "\n", file = fh )
+        os.chmod(self.driver, 0o755)
+
+    def tearDown(self):
+        self.tmp_obj.cleanup()
+
+    def add_run(self, run, src='mock', pbpipeline=()):
+        """Copy a run into self.from_dir. If pbpipeline is set, make the output
+           directory too, with the touch files listed.
+        """
+        copytree( os.path.join(DATA_DIR, f"{src}_examples", run),
+                  os.path.join(self.from_dir, run) )
+        if pbpipeline:
+            pbp_dir = os.path.join(self.to_dir, run, 'pbpipeline')
+            os.makedirs(pbp_dir)
+            os.symlink(os.path.join(self.from_dir, run), os.path.join(pbp_dir, 'from'))
+            for f in pbpipeline:
+                with open(os.path.join(pbp_dir, f), 'x'):
+                    pass
+
+    def run_main(self, *args, env=()):
+        with patch.dict(os.environ, **dict(env)):
+            pb_driver_main(parse_args([ '--environ_sh', self.environ_sh,
+                                        '--driver', self.driver, *args ]))
+
+        with open(self.driver_log) as fh:
+            return [ l.rstrip('\n') for l in fh ]
+
+    ### THE TESTS ###
+    def test_plan_jobs(self):
+
+        self.assertEqual( plan_jobs([]), [] )
+
+        self.assertEqual( plan_jobs([ ('r1', 'complete'),
+                                      ('r2', 'idle_awaiting_cells'),
+                                      ('r3', 'cell_ready'),
+                                      ('r4', 'unknown'),
+                                      ('r5', 'new'),
+                                      ('r6', 'testrun') ]),
+                          [ ['r3'], ['r5'], ['r2', 'r4'] ] )
+
+    def test_main(self):
+
+        # This is a new run
+        self.add_run('r64175e_20210528_333333')
+        # This one is awaiting cells
+        self.add_run('r54041_20180518_131155', pbpipeline=['notify_run_complete.touch'])
+        # And this one is finished
+        self.add_run('r84140_20231018_154254', src='revio', pbpipeline=['testrun'])
+
+        # Busy runs go first
+        self.assertEqual( self.run_main('-j', '1'),
+                          [ 'start r64175e_20210528_333333',
+                            'end r64175e_20210528_333333',
+                            'start r54041_20180518_131155',
+                            'end r54041_20180518_131155' ] )
+
+    def test_concurrent(self):
+        """Two new runs should be processed at once, unless -j 1
+        """
+        self.add_run('r64175e_20210528_333333')
+        self.add_run('r54041_20180518_131155')
+
+        log_lines = self.run_main('-j', '2', env=dict(DRIVER_SLEEP='1'))
+        self.assertEqual( [ l.split()[0] for l in log_lines ],
+                          ['start', 'start', 'end', 'end'] )
+        self.assertCountEqual( log_lines,
+                               [ f"{se} {r}" for se in ['start', 'end']
+                                             for r in [ 'r64175e_20210528_333333',
+                                                        'r54041_20180518_131155' ] ] )
+
+        os.unlink(self.driver_log)
+        log_lines = self.run_main('-j', '1')
+        self.assertEqual( log_lines,
+                          [ 'start r54041_20180518_131155',
+                            'end r54041_20180518_131155',
+                            'start r64175e_20210528_333333',
+                            'end r64175e_20210528_333333' ] )
+
+    def test_fail(self):
+        """If a driver call fails we should exit with an error, but only after all
+           the calls are done.
+        """
+        self.add_run('r64175e_20210528_333333')
+        with patch('pb_driver.plan_jobs', return_value=[['fail'], ['r1']]):
+            with self.assertRaises(SystemExit) as e:
+                self.run_main()
+
+        self.assertEqual(str(e.exception), f"1 of 2 calls to {self.driver} failed.")
+        with open(self.driver_log) as fh:
+            self.assertEqual(len(fh.readlines()), 4)
+
+if __name__ == '__main__':
+    unittest.main()
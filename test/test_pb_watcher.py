@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+"""Test the pb_watcher script"""
+
+import sys, os, re
+import unittest
+import logging
+import time
+import json
+import errno
+from threading import Timer
+from shutil import copytree
+from unittest.mock import patch
+from tempfile import TemporaryDirectory
+
+VERBOSE = os.environ.get('VERBOSE', '0') != '0'
+
+from pb_watcher import ( parse_args, load_environ, get_lock, find_runs,
+                         get_watch_dirs, Inotify, watch )
+from pb_run_status import StatusIndex, get_json_lines
+
+DATA_DIR = os.path.abspath(os.path.dirname(__file__))
+EXAMPLE_RUN = 'r64175e_20210528_333333'
+
+class T(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        #Prevent the logger from printing messages - I like my tests to look pretty.
+        if VERBOSE:
+            logging.getLogger().setLevel(logging.DEBUG)
+        else:
+            logging.getLogger().setLevel(logging.CRITICAL)
+
+    def setUp(self):
+        self.tmp_obj = TemporaryDirectory()
+        self.tmp_dir = self.tmp_obj.name
+
+        self.from_dir = os.path.join(self.tmp_dir, 'from')
+        self.to_dir = os.path.join(self.tmp_dir, 'to')
+        os.mkdir(self.from_dir)
+        os.mkdir(self.to_dir)
+
+    def tearDown(self):
+        self.tmp_obj.cleanup()
+
+    def md(self, *dirs):
+        for d in dirs:
+            os.makedirs(os.path.join(self.from_dir, d))
+
+    ### THE TESTS ###
+    def test_load_environ(self):
+
+        environ_sh = os.path.join(self.tmp_dir, 'environ.sh')
+        with open(environ_sh, 'w') as fh:
+            print(f"FROM_LOCATION={self.from_dir}", file=fh)
+            print("TO_LOCATION=${TO_LOCATION:-./to}", file=fh)
+            print("RUN_NAME_REGEX=('r.*' 'K[0-9]+/r.*')", file=fh)
+
+        with patch.dict(os.environ, clear=True, PATH=os.environ['PATH']):
+            self.assertEqual( load_environ(environ_sh),
+                              dict( FROM_LOCATION = self.from_dir,
+                                    TO_LOCATION = './to',
+                                    STATUS_INDEX = './to/.pb_run_status.sqlite',
+                                    RUN_NAME_REGEX = ['r.*', 'K[0-9]+/r.*'] ) )
+
+            # The settings may come from the environment, as for driver.sh
+            with patch.dict(os.environ, TO_LOCATION='/to', STATUS_INDEX=''):
+                self.assertEqual( load_environ('/dev/null/nonesuch'),
+                                  dict( FROM_LOCATION = '',
+                                        TO_LOCATION = '/to',
+                                        STATUS_INDEX = '',
+                                        RUN_NAME_REGEX = ['r.*_[0-9]{8}_.*'] ) )
+
+    def test_get_lock(self):
+
+        lock_file = os.path.join(self.tmp_dir, 'lock')
+        fh1 = get_lock(lock_file)
+        self.assertTrue(fh1)
+        self.assertIsNone(get_lock(lock_file))
+
+        fh1.close()
+        fh2 = get_lock(lock_file)
+        self.assertTrue(fh2)
+        fh2.close()
+
+        # If flock is not supported we just get a warning
+        with patch('fcntl.flock', side_effect=OSError(errno.ENOLCK, "No locks available")):
+            with self.assertLogs(level='WARNING') as lc:
+                fh3 = get_lock(lock_file)
+        self.assertTrue(fh3)
+        self.assertIn("carrying on without the lock", lc.output[0])
+        fh3.close()
+
+    def test_find_runs(self):
+
+        self.md( 'r1_20210101_1', 'r2_20210101_2/1_A01', 'foo/r3_20210101_3',
+                 'K123/r4_20210101_4', 'K123/bar', 'K123/K456/r5_20210101_5',
+                 '.r6_20210101_6', 'Kxyz/r7_20210101_7' )
+        with open(os.path.join(self.from_dir, 'r8_20210101_8'), 'x'):
+            pass
+
+        self.assertEqual( find_runs(self.from_dir, ['r.*_[0-9]{8}_.*']),
+                          ['r1_20210101_1', 'r2_20210101_2'] )
+
+        self.assertEqual( find_runs(self.from_dir, ['r.*_[0-9]{8}_.*', 'K[0-9]+/r.*']),
+                          ['K123/r4_20210101_4', 'r1_20210101_1', 'r2_20210101_2'] )
+
+        self.assertEqual( find_runs(self.from_dir, ['K[0-9]+/K[0-9]+/r.*']),
+                          ['K123/K456/r5_20210101_5'] )
+
+        self.assertEqual( find_runs(os.path.join(self.tmp_dir, 'nonesuch'), ['r.*']), [] )
+
+    def test_get_watch_dirs(self):
+
+        # The run has a .xxx suffix, which is not part of the RunID
+        copytree( os.path.join(DATA_DIR, 'mock_examples', EXAMPLE_RUN),
+                  os.path.join(self.from_dir, 'K123', EXAMPLE_RUN + '.2') )
+        self.md( 'r1_20210101_1' )
+
+        # r1_20210101_1 is flagged as a testrun so it needs no watching
+        os.makedirs(os.path.join(self.to_dir, 'r1_20210101_1', 'pbpipeline'))
+        os.symlink( os.path.join(self.from_dir, 'r1_20210101_1'),
+                    os.path.join(self.to_dir, 'r1_20210101_1', 'pbpipeline', 'from') )
+        with open(os.path.join(self.to_dir, 'r1_20210101_1', 'pbpipeline', 'testrun'), 'x'):
+            pass
+
+        with patch.dict(os.environ, TO_LOCATION=self.to_dir):
+            dirs = get_watch_dirs( self.from_dir, self.to_dir,
+                                   ['K123/' + EXAMPLE_RUN + '.2', 'r1_20210101_1'] )
+
+        run_dir = os.path.join(self.from_dir, 'K123', EXAMPLE_RUN + '.2')
+        self.assertEqual( dirs, sorted(
+                            [ self.from_dir, self.to_dir, os.path.join(self.from_dir, 'K123'),
+                              run_dir, os.path.join(self.to_dir, EXAMPLE_RUN + '.2', 'pbpipeline') ] +
+                            [ d for c in ['1_A01', '2_B01', '3_C01']
+                                for d in [ os.path.join(run_dir, c),
+                                           os.path.join(run_dir, c, 'metadata') ] ] ) )
+
+    def test_inotify(self):
+
+        inotify = Inotify()
+        try:
+            self.md('a', 'b')
+            inotify.set_watches([os.path.join(self.from_dir, d) for d in ['a', 'b', 'c']])
+            self.assertCountEqual(inotify.watches, [os.path.join(self.from_dir, d) for d in 'ab'])
+
+            self.assertFalse(inotify.wait(0))
+            with open(os.path.join(self.from_dir, 'b', 'foo.transferdone'), 'x'):
+                pass
+            self.assertTrue(inotify.wait(1))
+            self.assertFalse(inotify.wait(0))
+
+            # Stop watching 'b'
+            inotify.set_watches([os.path.join(self.from_dir, 'a')])
+            os.unlink(os.path.join(self.from_dir, 'b', 'foo.transferdone'))
+            self.assertFalse(inotify.wait(0))
+        finally:
+            inotify.close()
+
+    def test_watch(self):
+        """Run the watcher for a few seconds, and the driver should be called at the start
+           and after a cell is finished, both with and without inotify.
+        """
+        copytree( os.path.join(DATA_DIR, 'mock_examples', EXAMPLE_RUN),
+                  os.path.join(self.from_dir, EXAMPLE_RUN) )
+
+        driver = os.path.join(self.tmp_dir, 'driver.sh')
+        driver_log = os.path.join(self.tmp_dir, 'driver.log')
+        with open(driver, 'w') as fh:
+            print(f"#!/bin/sh\necho called >> {driver_log}", file=fh)
+        os.chmod(driver, 0o755)
+
+        env = dict( FROM_LOCATION = self.from_dir,
+                    TO_LOCATION = self.to_dir,
+                    STATUS_INDEX = '',
+                    RUN_NAME_REGEX = ['r.*'] )
+        args = parse_args(['--driver', driver, '--min_interval', '0.2', '--timeout', '2.5'])
+
+        for inotify in [None, Inotify()]:
+            if os.path.exists(driver_log):
+                os.unlink(driver_log)
+            new_dir = os.path.join(self.from_dir, EXAMPLE_RUN, '1_A01', 'metadata')
+
+            with patch.dict(os.environ, TO_LOCATION=self.to_dir):
+                Timer(1.0, os.mkdir, [new_dir]).start()
+                calls = watch(env, args, inotify=inotify)
+
+            # Give the last call to the driver a moment to finish
+            for n in range(20):
+                with open(driver_log) as fh:
+                    if len(fh.readlines()) == calls: break
+                time.sleep(0.1)
+
+            with open(driver_log) as fh:
+                self.assertEqual(fh.readlines(), ["called\n"] * 2)
+            self.assertEqual(calls, 2)
+
+            os.rmdir(new_dir)
+            if inotify:
+                inotify.close()
+
+    def test_watch_late_cell(self):
+        """A cell that turns up on a complete run should trigger the driver when it
+           appears and again when it is finished, even with the status index.
+        """
+        run_dir = os.path.join(self.from_dir, EXAMPLE_RUN)
+        copytree(os.path.join(DATA_DIR, 'mock_examples', EXAMPLE_RUN), run_dir)
+        pbp_dir = os.path.join(self.to_dir, EXAMPLE_RUN, 'pbpipeline')
+        os.makedirs(pbp_dir)
+        os.symlink(run_dir, os.path.join(pbp_dir, 'from'))
+        for f in ['1_A01.done', '2_B01.done', '3_C01.done', 'report.done']:
+            with open(os.path.join(pbp_dir, f), 'x'):
+                pass
+
+        # Make it all old enough to go into the index
+        for d in [run_dir, pbp_dir] + [ os.path.join(run_dir, c, m) for c in ['1_A01', '2_B01', '3_C01']
+                                                                    for m in ['', 'metadata'] ]:
+            if os.path.isdir(d):
+                os.utime(d, (1e9, 1e9))
+
+        driver = os.path.join(self.tmp_dir, 'driver.sh')
+        driver_log = os.path.join(self.tmp_dir, 'driver.log')
+        with open(driver, 'w') as fh:
+            print(f"#!/bin/sh\necho called >> {driver_log}", file=fh)
+        os.chmod(driver, 0o755)
+
+        env = dict( FROM_LOCATION = self.from_dir,
+                    TO_LOCATION = self.to_dir,
+                    STATUS_INDEX = '',
+                    RUN_NAME_REGEX = ['r.*'] )
+        args = parse_args(['--driver', driver, '--min_interval', '0.2', '--timeout', '2.5'])
+
+        index = StatusIndex(os.path.join(self.tmp_dir, 'index.sqlite'))
+        with patch.dict(os.environ, TO_LOCATION=self.to_dir):
+            self.assertEqual(json.loads(next(get_json_lines([run_dir], index=index)))['PipelineStatus'],
+                             'complete')
+
+            new_dir = os.path.join(run_dir, '4_D01', 'metadata')
+            Timer(0.7, os.makedirs, [new_dir]).start()
+            Timer(1.7, open, [os.path.join(new_dir, 'm64175e_210528_999999.transferdone'), 'x']).start()
+            inotify = Inotify()
+            try:
+                calls = watch(env, args, inotify=inotify, index=index)
+            finally:
+                inotify.close()
+                index.close()
+
+        # Once at the start, once when the cell appears, and once when it is ready
+        self.assertEqual(calls, 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+"""Test the read_survey script, which does everything at once"""
+
+import sys, os, re
+import unittest
+import logging
+import gzip
+import struct
+import hashlib
+from tempfile import TemporaryDirectory
+from io import BytesIO
+
+DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/hifi_examples')
+VERBOSE = os.environ.get('VERBOSE', '0') != '0'
+
+from read_survey import main as read_survey_main, parse_args, survey_bam
+from fasta_stats import read_fasta, fasta_to_histo, histo_to_result
+from smrtino import bgzf, dump_yaml
+from smrtino.bam import SEQ_CODES
+
+class T(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        #Prevent the logger from printing messages - I like my tests to look pretty.
+        if VERBOSE:
+            logging.getLogger().setLevel(logging.DEBUG)
+        else:
+            logging.getLogger().setLevel(logging.CRITICAL)
+
+        with gzip.open(DATA_DIR + '/example_hifi_reads.fastq.gz', 'rb') as fh:
+            cls.fq_bytes = fh.read()
+
+        # Convert the FASTQ to BAM, just once
+        cls.bam_dir = TemporaryDirectory()
+        cls.bam_file = os.path.join(cls.bam_dir.name, 'example_hifi_reads.bam')
+        fq_lines = cls.fq_bytes.decode().split('\n')
+        with open(cls.bam_file, 'wb') as fh:
+            cls.write_bam(fh, zip(fq_lines[0::4], fq_lines[1::4], fq_lines[3::4]))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.bam_dir.cleanup()
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @classmethod
+    def write_bam(cls, fh, reads):
+        """Write a minimal unaligned BAM file with the given (name, seq, qual) reads
+        """
+        data = b'BAM\x01' + struct.pack('<ii', 0, 0)
+        for name, seq, qual in reads:
+            name = name[1:].encode() + b'\0'
+            packed = bytes( (SEQ_CODES.index(seq[i]) << 4) +
+                            (SEQ_CODES.index(seq[i+1]) if i+1 < len(seq) else 0)
+                            for i in range(0, len(seq), 2) )
+            record = ( struct.pack( '<iiBBHHHiiii', -1, -1, len(name), 255, 4680, 0, 4,
+                                    len(seq), -1, -1, 0 ) +
+                       name + packed + bytes( ord(q) - 33 for q in qual ) )
+            data += struct.pack('<i', len(record)) + record
+
+        for n in range(0, len(data), 30000):
+            fh.write(bgzf.deflate_block(data[n:n+30000]))
+        fh.write(bgzf.EOF_BLOCK)
+
+    def tmp(self, filename):
+        return os.path.join(self.tmp_dir.name, filename)
+
+    ### THE TESTS ###
+    def test_all_outputs(self):
+        """Everything should match what the individual tools make
+        """
+        args = parse_args([ self.bam_file,
+                            '-j', '2',
+                            '--cstats', self.tmp('out.cstats.yaml'),
+                            '--fastq', self.tmp('example_hifi_reads.fastq.gz'),
+                            '--count', self.tmp('out.fastq.count'),
+                            '--fastq_md5', self.tmp('fastq.md5'),
+                            '--bam_md5', self.tmp('bam.md5'),
+                            '-S', '10', self.tmp('sub10.fasta'),
+                            '-S', '1000', self.tmp('sub1000.fasta') ])
+        read_survey_main(args)
+
+        # The FASTQ should be just the same, and BGZF
+        with gzip.open(self.tmp('example_hifi_reads.fastq.gz'), 'rb') as fh:
+            self.assertEqual(fh.read(), self.fq_bytes)
+        self.assertTrue(bgzf.is_bgzf(self.tmp('example_hifi_reads.fastq.gz')))
+
+        # The cstats as from fasta_stats.py, which prints an extra newline
+        fasta = b''.join( b'>' + n[1:] + b'\n' + s + b'\n'
+                          for n, s in zip( self.fq_bytes.split(b'\n')[0::4],
+                                           self.fq_bytes.split(b'\n')[1::4] ) )
+        expected_cstats = dump_yaml(histo_to_result(fasta_to_histo(read_fasta(BytesIO(fasta))))) + '\n'
+        with open(self.tmp('out.cstats.yaml')) as fh:
+            self.assertEqual(fh.read(), expected_cstats)
+
+        with open(self.tmp('out.fastq.count')) as fh, \
+             open(DATA_DIR + '/example_hifi_reads.fastq.count') as cfh:
+            self.assertEqual(fh.read(), cfh.read())
+
+        for md5_file, filename in [ ('fastq.md5', self.tmp('example_hifi_reads.fastq.gz')),
+                                    ('bam.md5', self.bam_file) ]:
+            with open(filename, 'rb') as fh:
+                expected_md5 = hashlib.md5(fh.read()).hexdigest()
+            with open(self.tmp(md5_file)) as fh:
+                self.assertEqual(fh.read(), f"{expected_md5}  {os.path.basename(filename)}\n")
+
+        # With 200 reads, sub1000 should have all the reads, but with the names munged
+        with open(self.tmp('sub1000.fasta'), 'rb') as fh:
+            self.assertEqual(fh.read(), fasta.replace(b'/', b'_'))
+
+        with open(self.tmp('sub10.fasta'), 'rb') as fh:
+            sub10 = fh.read()
+        self.assertEqual(sub10.count(b'>'), 10)
+        self.assertNotEqual(sub10, fasta.replace(b'/', b'_')[:len(sub10)])
+
+    def test_subsample(self):
+        """Subsamples should be random, repeatable, and in the original order
+        """
+        sub1 = survey_bam(self.bam_file, subsample_sizes=[20])['subsamples'][20]
+        sub2 = survey_bam(self.bam_file, subsample_sizes=[20, 50])['subsamples'][20]
+        sub3 = survey_bam(self.bam_file, subsample_sizes=[20], seed=42)['subsamples'][20]
+
+        self.assertEqual(len(sub1), 20)
+        self.assertEqual(sub1, sub2)
+        self.assertNotEqual(sub1, sub3)
+
+        indexes = [ s[0] for s in sub1 ]
+        self.assertEqual(indexes, sorted(indexes))
+        self.assertTrue(indexes[-1] >= 20)
+
+        self.assertEqual(survey_bam(self.bam_file, subsample_sizes=[0])['subsamples'], {0: []})
+
+    def test_empty(self):
+        """An empty BAM file gives an empty FASTQ file
+        """
+        with open(self.tmp('empty.bam'), 'wb') as fh:
+            self.write_bam(fh, [])
+
+        with open(self.tmp('empty.fastq.gz'), 'wb') as fh:
+            res = survey_bam(self.tmp('empty.bam'), fastq_fh=fh, subsample_sizes=[10])
+
+        self.assertEqual(res['subsamples'], {10: []})
+        self.assertEqual(histo_to_result(res['histo'])['Reads'], 0)
+        with gzip.open(self.tmp('empty.fastq.gz'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'')
+
+if __name__ == '__main__':
+    unittest.main()
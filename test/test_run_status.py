@@ -8,8 +8,10 @@ from shutil import rmtree, copytree
 from pprint import pprint
 import logging as L
 
-from pb_run_status import RunStatus
+from pb_run_status import RunStatus, StatusIndex, get_json_lines
 import yaml
+import json
+from unittest.mock import patch
 
 DATA_DIR = os.path.abspath(os.path.dirname(__file__))
 VERBOSE = os.environ.get('VERBOSE', '0') != '0'
@@ -333,6 +335,139 @@ class T(T_base):
                             'StartTime': 'unknown',
                           } )
 
+    def test_json_lines(self):
+        """Batch mode should give the same info as get_yaml() for every run, and
+           carry on past a run that cannot be examined.
+        """
+        run_info = self.use_run('r64175e_20210528_333333', copy=False)
+        self.md('pbpipeline')
+        self.touch('pbpipeline/1_A01.done')
+        self.touch('pbpipeline/2_B01.started')
+
+        this_run_dir = os.path.join(self.runs_dir, self.current_run)
+        os.symlink(this_run_dir, os.path.join(self.tmp_dir, 'to', self.current_run, 'pbpipeline', 'from'))
+        new_run_dir = os.path.join(self.tmp_dir, 'r64175e_20210528_444444')
+        os.mkdir(new_run_dir)
+
+        with patch.dict(os.environ, TO_LOCATION=self.tmp_dir + '/to'):
+            jlines = [ json.loads(l) for l in get_json_lines([this_run_dir, new_run_dir]) ]
+
+        self.assertEqual([ j['RunDir'] for j in jlines ], [this_run_dir, new_run_dir])
+        self.assertEqual( { k: v for k, v in jlines[0].items() if k != 'RunDir' },
+                          { k: (v or '') for k, v in yaml.safe_load(run_info.get_yaml()).items() } )
+        self.assertEqual(jlines[0]['PipelineStatus'], 'cell_ready')
+        self.assertEqual(jlines[1]['PipelineStatus'], 'new')
+
+        # Without TO_LOCATION, RunStatus() fails on the run but we still get a line
+        with patch.dict(os.environ, TO_LOCATION=''):
+            with self.assertLogs(level='ERROR'):
+                jlines = [ json.loads(l) for l in get_json_lines([this_run_dir]) ]
+
+        self.assertEqual(jlines, [ dict( RunDir = this_run_dir,
+                                         RunID = 'unknown',
+                                         Instrument = 'unknown',
+                                         Cells = '',
+                                         CellsReady = '',
+                                         CellsProcessing = '',
+                                         CellsDone = '',
+                                         CellsAborted = '',
+                                         StartTime = 'unknown',
+                                         PipelineStatus = 'unknown' ) ])
+
+    def test_status_index(self):
+        """Runs in a terminal state should be looked up in the index until something
+           changes in the run dir, pbpipeline dir, or any cell dir.
+        """
+        self.use_run('r64175e_20210528_333333', copy=True)
+        self.md('pbpipeline')
+        for c in ['1_A01', '2_B01', '3_C01']:
+            self.touch(f"pbpipeline/{c}.done")
+        self.touch('pbpipeline/report.done')
+
+        this_run_dir = os.path.join(self.runs_dir, self.current_run)
+        os.symlink(this_run_dir, os.path.join(self.tmp_dir, 'to', self.current_run, 'pbpipeline', 'from'))
+        pbpipeline_dir = os.path.join(self.tmp_dir, 'to', self.current_run, 'pbpipeline')
+
+        def backdate(t):
+            for d in [this_run_dir, pbpipeline_dir] + glob.glob(f"{this_run_dir}/*_*/") \
+                                                    + glob.glob(f"{this_run_dir}/*_*/metadata/"):
+                os.utime(d, (t, t))
+
+        def get_status(get_record=RunStatus.get_record):
+            with patch.object(RunStatus, 'get_record', autospec=True, side_effect=get_record):
+                jlines = [ json.loads(l) for l in get_json_lines([this_run_dir], index=index) ]
+            return jlines[0]['PipelineStatus']
+
+        def not_called(*args, **kwargs):
+            raise AssertionError("get_record() was called")
+
+        with patch.dict(os.environ, TO_LOCATION=self.tmp_dir + '/to'):
+            index = StatusIndex(os.path.join(self.tmp_dir, 'index.sqlite'))
+
+            # Directories that were just modified are not trusted
+            self.assertEqual(get_status(), 'complete')
+            with self.assertLogs(level='ERROR'):
+                self.assertEqual(get_status(not_called), 'unknown')
+
+            backdate(1e9)
+            self.assertEqual(get_status(), 'complete')
+            self.assertEqual(get_status(not_called), 'complete')
+
+            # Re-opening the index should make no difference
+            index.close()
+            index = StatusIndex(os.path.join(self.tmp_dir, 'index.sqlite'))
+            self.assertEqual(get_status(not_called), 'complete')
+
+            # Now redo the report
+            self.rm('pbpipeline/report.done')
+            backdate(1e9 + 1)
+            self.assertEqual(get_status(), 'processed')
+            with self.assertLogs(level='ERROR'):
+                self.assertEqual(get_status(not_called), 'unknown')
+            index.close()
+
+    def test_status_index_late_cell(self):
+        """A cell that turns up on a complete run must be noticed, even though the
+           .transferdone file does not change the run dir or pbpipeline dir.
+        """
+        self.use_run('r64175e_20210528_333333', copy=True)
+        self.md('pbpipeline')
+        for c in ['1_A01', '2_B01', '3_C01']:
+            self.touch(f"pbpipeline/{c}.done")
+        self.touch('pbpipeline/report.done')
+
+        this_run_dir = os.path.join(self.runs_dir, self.current_run)
+        os.symlink(this_run_dir, os.path.join(self.tmp_dir, 'to', self.current_run, 'pbpipeline', 'from'))
+        pbpipeline_dir = os.path.join(self.tmp_dir, 'to', self.current_run, 'pbpipeline')
+
+        def backdate(t):
+            for d in [this_run_dir, pbpipeline_dir] + glob.glob(f"{this_run_dir}/*_*/") \
+                                                    + glob.glob(f"{this_run_dir}/*_*/metadata/"):
+                os.utime(d, (t, t))
+
+        def get_record():
+            return json.loads(next(get_json_lines([this_run_dir], index=index)))
+
+        with patch.dict(os.environ, TO_LOCATION=self.tmp_dir + '/to'):
+            index = StatusIndex(os.path.join(self.tmp_dir, 'index.sqlite'))
+
+            backdate(1e9)
+            self.assertEqual(get_record()['PipelineStatus'], 'complete')
+
+            # The new cell directory appears, which does not change the status
+            self.md('4_D01/metadata')
+            backdate(1e9 + 1)
+            self.assertEqual(get_record()['PipelineStatus'], 'complete')
+            with patch.object(RunStatus, 'get_record', side_effect=AssertionError):
+                self.assertEqual(get_record()['PipelineStatus'], 'complete')
+
+            # Then the cell finishes
+            self.touch('4_D01/metadata/m64175e_210528_999999.transferdone')
+            record = get_record()
+            self.assertEqual(record['PipelineStatus'], 'cell_ready')
+            self.assertEqual(record['CellsReady'], '4_D01')
+            index.close()
+
     def test_report_failed(self):
         """If the cells are all done but the report failed, the status
            is failed.
@@ -383,6 +518,32 @@ class T(T_base):
         # Start time should be some date (we're not sure what as it depends on the file mtime)
         self.assertEqual(len(run_info.get_start_time()), len('Thu Jan  1 01:00:00 1970'))
 
+    def test_exists_matches_glob(self):
+        """_exists() lists each directory once rather than calling glob() but it
+           should give the same answers.
+        """
+        run_info = self.use_run("r84140_20231018_154254", copy=True, src="revio")
+        self.md('pbpipeline')
+        for f in ['1_C01.done', '1_D01.started', 'report.started', '.hidden.done']:
+            self.touch(f"pbpipeline/{f}")
+        self.touch("1_D01/.hidden.transferdone")
+        os.symlink('nowhere', os.path.join(self.tmp_dir, 'to', self.current_run, 'pbpipeline', 'aborted'))
+
+        for pattern in [ 'pbpipeline', 'pbpipeline/*.done', 'pbpipeline/.*.done',
+                         'pbpipeline/1_[CD]01.*', 'pbpipeline/report.started',
+                         'pbpipeline/aborted', 'pbpipeline/failed',
+                         'nothing/*', 'pbpipeline/1_C01.done/*' ]:
+            self.assertEqual( run_info._exists_to(pattern),
+                              len(glob.glob(os.path.join(run_info.to_path, pattern))),
+                              pattern )
+
+        for pattern in [ '*/metadata/*.transferdone', '1_C01/metadata/*.transferdone',
+                         '1_D01/metadata/*.transferdone', '1_D01/*.transferdone',
+                         '1_D01/.*.transferdone', '2_A01/*.transferdone' ]:
+            self.assertEqual( run_info._exists_from(pattern),
+                              len(glob.glob(os.path.join(run_info.from_path, pattern))),
+                              pattern )
+
 def dictify(s):
     """ Very very dirty minimal YAML parser is OK for testing.
     """
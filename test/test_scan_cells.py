@@ -12,6 +12,9 @@ import sys, os, re
 import unittest
 import logging
 import yaml
+import time
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
 
 DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/revio_examples')
 ORIGINAL_CWD = os.getcwd()
@@ -75,6 +78,138 @@ class T(unittest.TestCase):
 
         self.assertEqual( self.scan_revio_run(r),
                           self.load_revio_yaml(r) )
+    def test_jobs(self):
+        """Scanning in parallel should give the same result. Make the directory listing
+           slow so the threads are likely to finish out of order.
+        """
+        real_scandir = os.scandir
+        def slow_scandir(d):
+            time.sleep(0.01 if '1_C01' in d else 0.0)
+            return real_scandir(d)
+
+        r = "r84140_20231018_154254"
+        with patch('os.scandir', slow_scandir):
+            self.assertEqual( self.scan_revio_run(r, xmltrigger=True, jobs=4),
+                              self.load_revio_yaml(r, filename="sc_data_all.yaml") )
+
+        cell = "m84140_990101_000000_s1"
+        with TemporaryDirectory() as tmp_dir:
+            run_dir, redemux = self.make_redemux_run(tmp_dir, cell)
+            self.assertEqual( self.scan_revio_run(run_dir, jobs=4),
+                              self.scan_revio_run(run_dir, jobs=1) )
+
+    def test_cache_example(self):
+        """The cached result should be just the same as the original
+        """
+        r = "r84140_20231018_154254"
+        with TemporaryDirectory() as cache_dir:
+            self.scan_revio_run(r, cache=cache_dir, xmltrigger=True)
+            self.assertEqual(sorted(os.listdir(cache_dir)), ["1_C01.yaml", "1_D01.yaml"])
+
+            with patch('scan_cells.scan_slot_revio', side_effect=RuntimeError):
+                self.assertEqual( self.scan_revio_run(r, cache=cache_dir, xmltrigger=True),
+                                  self.load_revio_yaml(r, filename="sc_data_all.yaml") )
+
+    def make_redemux_run(self, tmp_dir, cell):
+        """There is no example of a re-demultiplexed run, so make one.
+        """
+        redemux = f"pbpipeline/re-demultiplex-{cell}/"
+        files = [ f"1_A01/metadata/{cell}.transferdone",
+                  f"1_A01/metadata/{cell}.metadata.xml",
+                  f"1_A01/metadata/{cell}.sts.xml",
+                  f"1_A01/statistics/{cell}.reports.zip",
+                  f"{redemux}{cell}.hifi_reads.lima.counts",
+                  f"{redemux}{cell}.hifi_reads.unbarcoded.consensusreadset.xml" ]
+        for bc in ["bc1001/", ""]:
+            bc_name = bc.rstrip('/') or "unbarcoded"
+            for part in ["hifi_reads", "fail_reads"]:
+                files.append(f"{redemux}{bc}{cell}.{part}.{bc_name}.bam")
+                files.append(f"{redemux}{bc}{cell}.{part}.{bc_name}.bam.pbi")
+        files.append(f"{redemux}bc1001/{cell}.hifi_reads.bc1001.consensusreadset.xml")
+
+        run_dir = os.path.join(tmp_dir, "r84140_20990101_000000")
+        for f in files:
+            os.makedirs(os.path.dirname(os.path.join(run_dir, f)), exist_ok=True)
+            open(os.path.join(run_dir, f), "w").close()
+
+        return run_dir, redemux
+
+    def age_dirs(self, top_dir):
+        """Make all the directories look old, so the scan results can be cached.
+        """
+        for d, _, _ in os.walk(top_dir):
+            os.utime(d, (1e9, 1e9))
+
+    def test_redemux_run(self):
+        """Scan the re-demultiplexed run
+        """
+        cell = "m84140_990101_000000_s1"
+        with TemporaryDirectory() as tmp_dir:
+            run_dir, redemux = self.make_redemux_run(tmp_dir, cell)
+
+            # We should get all the info from listing the directories. os.path.isdir()
+            # is still used to see if the re-demultiplex dir exists.
+            with patch('os.path.exists', side_effect=RuntimeError):
+                res = self.scan_revio_run(run_dir)
+
+            cell_info = res['cells'][cell]
+            self.assertTrue(cell_info['re-demultiplex'])
+            self.assertEqual(list(cell_info['barcodes']), ['bc1001'])
+            self.assertEqual( cell_info['barcodes']['bc1001']['hifi_reads']['xml'],
+                              f"{redemux}bc1001/{cell}.hifi_reads.bc1001.consensusreadset.xml" )
+            self.assertEqual( cell_info['unassigned']['fail_reads']['pbi'],
+                              f"{redemux}{cell}.fail_reads.unbarcoded.bam.pbi" )
+            self.assertEqual(cell_info['lima_counts'], f"{redemux}{cell}.hifi_reads.lima.counts")
+            self.assertEqual(cell_info['reports_zip'], f"1_A01/statistics/{cell}.reports.zip")
+
+            # And if a file goes missing, we'll notice
+            os.unlink(os.path.join(run_dir, redemux, f"{cell}.fail_reads.unbarcoded.bam"))
+            with self.assertRaisesRegex(FileNotFoundError, "fail_reads.unbarcoded.bam$"):
+                self.scan_revio_run(run_dir)
+
+    def test_cache(self):
+        """With --cache, unchanged slots are not scanned again
+        """
+        cell = "m84140_990101_000000_s1"
+        with TemporaryDirectory() as tmp_dir:
+            run_dir, redemux = self.make_redemux_run(tmp_dir, cell)
+            cache_dir = os.path.join(run_dir, "pbpipeline", "sc_cache")
+
+            # Nothing is cached if the directories were just modified
+            res1 = self.scan_revio_run(run_dir, cache=cache_dir)
+            self.assertFalse(os.path.exists(os.path.join(cache_dir, "1_A01.yaml")))
+
+            self.age_dirs(run_dir)
+            self.assertEqual(self.scan_revio_run(run_dir, cache=cache_dir), res1)
+            self.assertTrue(os.path.exists(os.path.join(cache_dir, "1_A01.yaml")))
+
+            # Now the cached result will be used
+            with patch('scan_cells.scan_slot_revio', side_effect=RuntimeError):
+                self.assertEqual(self.scan_revio_run(run_dir, cache=cache_dir), res1)
+
+            # But a corrupt cache file is ignored, and replaced
+            with open(os.path.join(cache_dir, "1_A01.yaml"), "w") as fh:
+                print("key: [unclosed", file=fh)
+            self.assertEqual(self.scan_revio_run(run_dir, cache=cache_dir), res1)
+            self.assertEqual(os.listdir(cache_dir), ["1_A01.yaml"])
+            with patch('scan_cells.scan_slot_revio', side_effect=RuntimeError):
+                self.assertEqual(self.scan_revio_run(run_dir, cache=cache_dir), res1)
+
+            # Unless we add a new barcode
+            bc_dir = os.path.join(run_dir, redemux, "bc1002")
+            os.mkdir(bc_dir)
+            for part in ["hifi_reads", "fail_reads"]:
+                for ext in ["bam", "bam.pbi"]:
+                    open(f"{bc_dir}/{cell}.{part}.bc1002.{ext}", "w").close()
+            open(f"{bc_dir}/{cell}.hifi_reads.bc1002.consensusreadset.xml", "w").close()
+            self.age_dirs(run_dir)
+
+            res2 = self.scan_revio_run(run_dir, cache=cache_dir)
+            self.assertEqual(list(res2['cells'][cell]['barcodes']), ['bc1001', 'bc1002'])
+
+            # Or change any option that affects the scan
+            res3 = self.scan_revio_run(run_dir, cache=cache_dir, redemux=None)
+            self.assertFalse(res3['cells'][cell]['re-demultiplex'])
 
 if __name__ == '__main__':
     unittest.main()
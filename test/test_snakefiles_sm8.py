@@ -34,6 +34,8 @@ class T(unittest.TestCase):
         else:
             logging.getLogger().setLevel(logging.CRITICAL)
 
+    # The Snakefiles may set environment variables, which must not leak into other tests
+    @patch.dict(os.environ)
     @patch('sys.stderr', new_callable=StringIO)
     @patch('sys.stdout', new_callable=StringIO)
     def syntax_check(self, sf, mock_stdout, mock_stderr):
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""Test the strip_readset_resources script"""
+
+import sys, os, re
+import unittest
+import logging
+from io import BytesIO
+from tempfile import TemporaryDirectory
+
+from lxml import etree
+
+DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/revio_out_examples')
+VERBOSE = os.environ.get('VERBOSE', '0') != '0'
+
+from strip_readset_resources import main as strip_main, parse_args, strip_readset, fix_resourceid
+
+# The extra bits that should be pruned out. These are inserted into an example that
+# was already stripped, to make something like the original XML.
+NESTED_RESOURCES = b"""
+            <pbbase:ExternalResources>
+                <pbbase:ExternalResource MetaType="PacBio.SubreadFile.KineticsBamFile" ResourceId="../hifi_reads/foo.bam"/>
+            </pbbase:ExternalResources>
+            <!-- a comment -->
+"""
+SUPPLEMENTAL_RESOURCES = b"""<pbbase:SupplementalResources>
+        <pbbase:ExternalResource MetaType="PacBio.FileTypes.JsonReport" ResourceId="../statistics/foo.json"/>
+    </pbbase:SupplementalResources>"""
+
+class T(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        #Prevent the logger from printing messages - I like my tests to look pretty.
+        if VERBOSE:
+            logging.getLogger().setLevel(logging.DEBUG)
+        else:
+            logging.getLogger().setLevel(logging.CRITICAL)
+
+    def unstrip(self, xml_bytes, barcoded=True):
+        """Reverse the changes made by the script, more or less.
+        """
+        xml_bytes = xml_bytes.replace(b'</pbbase:FileIndices>',
+                                      b'</pbbase:FileIndices>' + NESTED_RESOURCES, 1)
+        xml_bytes = xml_bytes.replace(b'<pbbase:SupplementalResources/>', SUPPLEMENTAL_RESOURCES)
+        xml_bytes = xml_bytes.replace(b'ResourceId="m84140', b'ResourceId="../hifi_reads/m84140')
+        if not barcoded:
+            xml_bytes = xml_bytes.replace(b'.unassigned.bam', b'.unbarcoded.bam')
+            xml_bytes = xml_bytes.replace(b'pbmeta:DNABarcode', b'pbsample:DNABarcode')
+        return xml_bytes
+
+    def canon(self, xml_bytes):
+        """Normalise the whitespace and the order of the namespace declarations.
+           The examples have been through 'dataset relativize' which puts back an
+           empty pbbase:SupplementalResources, so discard that too.
+        """
+        xml_bytes = xml_bytes.replace(b'<pbbase:SupplementalResources/>', b'')
+        parser = etree.XMLParser(remove_blank_text=True, remove_comments=True)
+        return etree.tostring( etree.fromstring(xml_bytes, parser), method="c14n2",
+                               strip_text=True )
+
+    def run_strip(self, xml_bytes):
+        with TemporaryDirectory() as tmp_dir:
+            infile = os.path.join(tmp_dir, 'in.xml')
+            with open(infile, 'wb') as fh:
+                fh.write(xml_bytes)
+            out = BytesIO()
+            strip_readset(infile, out)
+        return out.getvalue()
+
+    ### THE TESTS ###
+    def test_fix_resourceid(self):
+
+        self.assertEqual( fix_resourceid("../hifi_reads/m1_s1.hifi_reads.bc1003.bam"),
+                          "m1_s1.hifi_reads.bc1003.bam" )
+        self.assertEqual( fix_resourceid("../hifi_reads/m1_s1.hifi_reads.bam.pbi"),
+                          "m1_s1.hifi_reads.all.bam.pbi" )
+        self.assertEqual( fix_resourceid("m1_s1.hifi_reads.unbarcoded.bam"),
+                          "m1_s1.hifi_reads.unassigned.bam" )
+        self.assertEqual( fix_resourceid("../statistics/foo.json"),
+                          "../statistics/foo.json" )
+
+    def test_barcoded(self):
+        """A regular barcode should just lose the extra resources
+        """
+        with open(f"{DATA_DIR}/r84140_20240116_162812/"
+                   "m84140_240116_183509_s2.hifi_reads.bc1003.consensusreadset.xml", 'rb') as fh:
+            expected = fh.read()
+
+        res = self.run_strip(self.unstrip(expected))
+
+        self.assertTrue(res.startswith(b'<?xml version="1.0" encoding="utf-8"?>\n<pbds:'))
+        self.assertEqual(self.canon(res), self.canon(expected))
+
+    def test_unassigned(self):
+        """The unbarcoded reads get renamed and the barcodes are moved to pbmeta
+        """
+        with open(f"{DATA_DIR}/r84140_20240116_162812/"
+                   "m84140_240116_183509_s2.hifi_reads.unassigned.consensusreadset.xml", 'rb') as fh:
+            expected = fh.read()
+
+        unstripped = self.unstrip(expected, barcoded=False)
+        self.assertIn(b'pbsample:DNABarcode ', unstripped)
+
+        res = self.run_strip(unstripped)
+        self.assertEqual(self.canon(res), self.canon(expected))
+
+    def test_main_multi(self):
+        """Several files in one go
+        """
+        ddir = f"{DATA_DIR}/r84140_20240116_162812"
+        infiles = [ f"{ddir}/m84140_240116_183509_s2.hifi_reads.{bc}.consensusreadset.xml"
+                    for bc in ["bc1003", "bc1008"] ]
+
+        with TemporaryDirectory() as tmp_dir:
+            outfiles = [ os.path.join(tmp_dir, f"out{n}.xml") for n in range(2) ]
+            strip_main(parse_args( infiles + ['-o', outfiles[0], '-o', outfiles[1]] ))
+
+            for infile, outfile in zip(infiles, outfiles):
+                with open(infile, 'rb') as ifh, open(outfile, 'rb') as ofh:
+                    self.assertEqual(self.canon(ofh.read()), self.canon(ifh.read()))
+
+            # Mismatched number of outputs
+            with self.assertRaises(SystemExit):
+                strip_main(parse_args( infiles + ['-o', outfiles[0]] ))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+"""Test the subsample_bam script, which uses the .pbi index"""
+
+import sys, os, re
+import unittest
+import logging
+import gzip
+import struct
+from tempfile import TemporaryDirectory
+
+DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/hifi_examples')
+VERBOSE = os.environ.get('VERBOSE', '0') != '0'
+
+from subsample_bam import main as subsample_bam_main, parse_args, subsample_with_pbi
+from read_survey import survey_bam
+from smrtino import bgzf
+from smrtino.bam import SEQ_CODES
+from smrtino.pbi import load_pbi, PBIError
+
+class T(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        #Prevent the logger from printing messages - I like my tests to look pretty.
+        if VERBOSE:
+            logging.getLogger().setLevel(logging.DEBUG)
+        else:
+            logging.getLogger().setLevel(logging.CRITICAL)
+
+        with gzip.open(DATA_DIR + '/example_hifi_reads.fastq.gz', 'rt') as fh:
+            fq_lines = fh.read().split('\n')
+        cls.reads = list(zip(fq_lines[0::4], fq_lines[1::4]))
+
+        cls.tmp_dir = TemporaryDirectory()
+        cls.bam_file = os.path.join(cls.tmp_dir.name, 'example_hifi_reads.bam')
+        with open(cls.bam_file, 'wb') as bfh, open(cls.bam_file + '.pbi', 'wb') as pfh:
+            cls.write_bam_and_pbi(bfh, pfh, cls.reads)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    @classmethod
+    def write_bam_and_pbi(cls, bfh, pfh, reads, block_data_size=30000):
+        """Write a minimal unaligned BAM file with the given (name, seq) reads, and
+           the matching index. The records will straddle the BGZF blocks.
+        """
+        data = b'BAM\x01' + struct.pack('<ii', 0, 0)
+        record_offsets = []
+        for name, seq in reads:
+            name = name[1:].encode() + b'\0'
+            packed = bytes( (SEQ_CODES.index(seq[i]) << 4) +
+                            (SEQ_CODES.index(seq[i+1]) if i+1 < len(seq) else 0)
+                            for i in range(0, len(seq), 2) )
+            record = ( struct.pack( '<iiBBHHHiiii', -1, -1, len(name), 255, 4680, 0, 4,
+                                    len(seq), -1, -1, 0 ) +
+                       name + packed + b'\xff' * len(seq) )
+            record_offsets.append(len(data))
+            data += struct.pack('<i', len(record)) + record
+
+        block_starts = [0]
+        for n in range(0, len(data), block_data_size):
+            block = bgzf.deflate_block(data[n:n+block_data_size])
+            bfh.write(block)
+            block_starts.append(block_starts[-1] + len(block))
+        bfh.write(bgzf.EOF_BLOCK)
+
+        # Virtual offsets are the block start shifted left 16 bits, plus the offset
+        # within the uncompressed block.
+        n_reads = len(reads)
+        pbi_data = ( b'PBI\x01' + struct.pack('<IHI', 0x030001, 0, n_reads) + b'\0' * 18 +
+                     struct.pack(f'<{n_reads}i', *[0] * n_reads) +
+                     struct.pack(f'<{n_reads}i', *[0] * n_reads) +
+                     struct.pack(f'<{n_reads}i', *[ len(s) for n, s in reads ]) +
+                     struct.pack(f'<{n_reads}i', *[ int(n.split('/')[1]) for n, s in reads ]) +
+                     struct.pack(f'<{n_reads}f', *[0.99] * n_reads) +
+                     struct.pack(f'<{n_reads}B', *[0] * n_reads) +
+                     struct.pack( f'<{n_reads}q', *[ (block_starts[o // block_data_size] << 16) +
+                                                     (o % block_data_size)
+                                                     for o in record_offsets ] ) )
+        pfh.write(bgzf.deflate_data(pbi_data) + bgzf.EOF_BLOCK)
+
+    ### THE TESTS ###
+    def test_load_pbi(self):
+        """Load the index
+        """
+        pbi = load_pbi(self.bam_file + '.pbi')
+
+        self.assertEqual(pbi.version, "3.0.1")
+        self.assertEqual(pbi.n_reads, 200)
+        self.assertEqual(pbi.hole_number[0], 49)
+        self.assertEqual(pbi.file_offset[0], 12)
+
+        with self.assertRaises(PBIError):
+            load_pbi(DATA_DIR + '/example_hifi_reads.fastq.gz')
+
+    def test_subsample(self):
+        """Check that the records we get are the right ones
+        """
+        sub = subsample_with_pbi(self.bam_file, self.bam_file + '.pbi', 50)
+
+        self.assertEqual(len(sub), 50)
+        self.assertEqual([ s[0] for s in sub ], sorted(set( s[0] for s in sub )))
+        for i, name, seq in sub:
+            self.assertEqual(name.decode(), self.reads[i][0][1:].replace('/', '_'))
+            self.assertEqual(seq.decode(), self.reads[i][1])
+
+        # Asking for more reads than we have gets them all, the same as the
+        # full scan would
+        sub_all = subsample_with_pbi(self.bam_file, self.bam_file + '.pbi', 1000)
+        self.assertEqual(sub_all, survey_bam(self.bam_file, subsample_sizes=[1000])['subsamples'][1000])
+
+    def test_main(self):
+        """Run the script end to end, and without an index it should fail
+        """
+        with TemporaryDirectory() as tmp_dir:
+            args = parse_args([ self.bam_file,
+                                '-n', '20',
+                                '-o', os.path.join(tmp_dir, 'out.fasta') ])
+            subsample_bam_main(args)
+
+            with open(os.path.join(tmp_dir, 'out.fasta')) as fh:
+                fasta_lines = fh.read().split('\n')
+
+            args = parse_args([ self.bam_file,
+                                '-n', '20',
+                                '--pbi', os.path.join(tmp_dir, 'no.pbi'),
+                                '-o', os.path.join(tmp_dir, 'out2.fasta') ])
+            with self.assertRaises(FileNotFoundError):
+                subsample_bam_main(args)
+
+        self.assertEqual(len(fasta_lines), 41)
+        self.assertTrue(all( l.startswith('>m64175e_210423_165649_') for l in fasta_lines[0::2][:-1] ))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""Test the xml_pp script"""
+
+import sys, os, re
+import unittest
+import logging
+from io import BytesIO
+from unittest.mock import NonCallableMock, patch
+from tempfile import TemporaryDirectory
+
+VERBOSE = os.environ.get('VERBOSE', '0') != '0'
+
+from xml_pp import main as xml_pp_main, parse_args, pretty_print
+
+# PacBio says this is UTF-16, but it isn't
+UGLY_XML = ( b'<?xml version="1.0" encoding="utf-16"?><a x="1"><b>caf\xc3\xa9</b>'
+             b'<!-- note --><c/></a>\n' )
+
+PRETTY_XML = b'<a x="1">\n  <b>caf&#233;</b>\n  <!-- note -->\n  <c/>\n</a>\n'
+
+class T(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        #Prevent the logger from printing messages - I like my tests to look pretty.
+        if VERBOSE:
+            logging.getLogger().setLevel(logging.DEBUG)
+        else:
+            logging.getLogger().setLevel(logging.CRITICAL)
+
+    ### THE TESTS ###
+    def test_pretty_print(self):
+
+        self.assertEqual( pretty_print(BytesIO(UGLY_XML)), PRETTY_XML )
+
+        # The declaration on a line of its own, and no declaration at all
+        self.assertEqual( pretty_print(BytesIO(UGLY_XML.replace(b'?>', b'?>\n', 1))),
+                          PRETTY_XML )
+        self.assertEqual( pretty_print(BytesIO(UGLY_XML[UGLY_XML.index(b'<a'):])),
+                          PRETTY_XML )
+
+    def test_main_stdin(self):
+
+        mock_stdin = NonCallableMock(buffer=BytesIO(UGLY_XML))
+        mock_stdout = NonCallableMock(buffer=BytesIO())
+        with patch('sys.stdin', mock_stdin), patch('sys.stdout', mock_stdout):
+            xml_pp_main(parse_args([]))
+
+        self.assertEqual( mock_stdout.buffer.getvalue(), PRETTY_XML )
+
+    def test_main_multi(self):
+
+        with TemporaryDirectory() as tmp_dir:
+            infiles = [ os.path.join(tmp_dir, f"in{n}.xml") for n in range(3) ]
+            outfiles = [ os.path.join(tmp_dir, f"out{n}.xml") for n in range(3) ]
+            for n, f in enumerate(infiles):
+                with open(f, 'wb') as fh:
+                    fh.write(UGLY_XML.replace(b'x="1"', f'x="{n}"'.encode()))
+
+            xml_pp_main(parse_args( infiles + [ a for o in outfiles for a in ['-o', o] ] ))
+
+            for n, f in enumerate(outfiles):
+                with open(f, 'rb') as fh:
+                    self.assertEqual( fh.read(),
+                                      PRETTY_XML.replace(b'x="1"', f'x="{n}"'.encode()) )
+
+            with self.assertRaises(SystemExit):
+                xml_pp_main(parse_args( infiles + ['-o', outfiles[0]] ))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,25 +1,76 @@
 #!/usr/bin/env python3
 import sys, re
-from io import StringIO
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
 from lxml import etree
 
-def main():
+""" Pretty-print XML files. Reads from stdin and writes to stdout, or else
+    processes a list of files in one go.
+"""
+
+# How much of the first line to look at for an XML declaration
+PEEK_SIZE = 1024
+CHUNKSIZE = 64 * 1024
+
+def parse_args(*args):
+    description = """Pretty-print XML, ignoring any XML declaration.
+                  """
+    argparser = ArgumentParser( description=description,
+                                formatter_class = ArgumentDefaultsHelpFormatter )
+    argparser.add_argument("xmlfile", nargs='*',
+                            help="XML files to process, or else will read from stdin.")
+    argparser.add_argument("-o", "--output", action="append",
+                            help="File to write. Give this once for each input file. If not" +
+                                 " given, the result is printed to stdout.")
+
+    return argparser.parse_args(*args)
+
+def main(args):
+
+    if not args.xmlfile:
+        if args.output:
+            exit("Output files given but no input files.")
+        sys.stdout.buffer.write(pretty_print(sys.stdin.buffer))
+        return
+
+    if not args.output:
+        for xmlfile in args.xmlfile:
+            with open(xmlfile, 'rb') as fh:
+                sys.stdout.buffer.write(pretty_print(fh))
+        return
+
+    if len(args.output) != len(args.xmlfile):
+        exit("The number of --output files must match the number of input files.")
+
+    for xmlfile, outfile in zip(args.xmlfile, args.output):
+        with open(xmlfile, 'rb') as fh:
+            res = pretty_print(fh)
+        with open(outfile, 'wb') as ofh:
+            ofh.write(res)
+
+def pretty_print(fh):
+    """Parse XML from a binary file handle and return the pretty-printed version
+       as bytes.
+    """
     parser = etree.XMLParser(remove_blank_text=True)
-    file_obj = StringIO()
 
     # Remove any XML declaration and assume the file is utf-8
     # This breaks the XML standard, but PacBio broke it first!
-    first_line = next(sys.stdin)
-    first_line = re.sub(r"<\?xml [^?>]+\?>", "", first_line)
-    if first_line.strip():
-        file_obj.write(first_line)
-    for l in sys.stdin:
-        file_obj.write(l)
-    file_obj.seek(0)
+    # The declaration must be at the start, so we only need to peek at the start of
+    # the first line.
+    prefix = fh.readline(PEEK_SIZE)
+    prefix = re.sub(rb"<\?xml [^?>]+\?>", b"", prefix)
+    if prefix.strip():
+        parser.feed(prefix)
+
+    while True:
+        chunk = fh.read(CHUNKSIZE)
+        if not chunk:
+            break
+        parser.feed(chunk)
+    root = parser.close()
 
-    tree = etree.parse(file_obj, parser)
-    sys.stdout.buffer.write(etree.tostring(tree, pretty_print=True))
+    return etree.tostring(root.getroottree(), pretty_print=True)
 
 if __name__ == '__main__':
-    main()
+    main(parse_args())